@@ -0,0 +1,167 @@
+'''
+A local stand-in for the Dahua cameras, for benchmarking the camera profile switching.
+
+One threaded HTTP/1.1 server on the loopback interface answers for all cameras, which are told apart by
+the first part of the path. It asks for digest authentication like the cameras do and checks the digest
+of every request against the user and password, answers setConfig requests with OK after a simulated
+processing delay, or with an error for the cameras in failing, and counts connections, requests and
+challenges, also per camera. check_switch() checks a switch against what the server has seen.
+'''
+import hashlib
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, Set
+from urllib.parse import parse_qsl, urlsplit
+
+from myconfig import SurveillanceConfig, WebCam
+from mysurveillance import CAMERA_PROFILES, CameraSwitcher, SwitchReport
+
+CAMERA_DELAY_SECS = 0.005 # Time a camera takes to apply a configuration
+CAMERA_REALM = 'Login to fake camera'
+
+_DIGEST_FIELD = re.compile(r'(\w+)=(?:"([^"]*)"|([^,\s]*))')
+
+def _md5(*parts: str) -> str:
+    return hashlib.md5(':'.join(parts).encode()).hexdigest()
+
+class FakeCameraServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, user: str, password: str, delay: float = CAMERA_DELAY_SECS, failing: Iterable[str] = ()):
+        super().__init__(('127.0.0.1', 0), _CameraHandler)
+        self.user = user
+        self.password = password
+        self.delay = delay
+        self.failing: Set[str] = set(failing) # Cameras that answer setConfig with an error
+        self.counts = Counter()
+        self.requests = Counter()   # Camera -> authenticated requests
+        self.challenges = Counter() # Camera -> challenges
+        self.configs: Dict[str, Dict[str, str]] = {} # Camera -> its current configuration
+        self.nonces: Set[str] = set()
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, name='FakeCameraServer', daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, what: str, camera: str = None):
+        with self._lock:
+            self.counts[what] += 1
+            if what == 'requests':
+                self.requests[camera] += 1
+            elif what == 'challenges':
+                self.challenges[camera] += 1
+
+    def new_nonce(self) -> str:
+        nonce = str(time.time_ns())
+        with self._lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def digest_valid(self, method: str, header: str) -> bool:
+        '''Whether the Authorization header is a valid digest for the user and password with a nonce of ours.'''
+        if not header.startswith('Digest '):
+            return False
+        fields = {key: quoted or bare for key, quoted, bare in _DIGEST_FIELD.findall(header[7:])}
+        with self._lock:
+            known_nonce = fields.get('nonce') in self.nonces
+        if not known_nonce or fields.get('username') != self.user or fields.get('realm') != CAMERA_REALM:
+            return False
+        ha1 = _md5(self.user, CAMERA_REALM, self.password)
+        ha2 = _md5(method, fields.get('uri', ''))
+        expected = _md5(ha1, fields['nonce'], fields.get('nc', ''), fields.get('cnonce', ''), fields.get('qop', ''), ha2)
+        return fields.get('response') == expected
+
+class _CameraHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the cameras
+    server: FakeCameraServer
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: str, headers: dict = None):
+        data = body.encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        camera = parts.path.strip('/').split('/')[0]
+        if not self.server.digest_valid('GET', self.headers.get('Authorization', '')):
+            if 'Authorization' in self.headers:
+                self.server.count('bad_digests')
+            self.server.count('challenges', camera)
+            self._reply(401, 'Unauthorized', {'WWW-Authenticate': f'Digest realm="{CAMERA_REALM}", qop="auth", nonce="{self.server.new_nonce()}", opaque=""'})
+            return
+        self.server.count('requests', camera)
+        time.sleep(self.server.delay)
+        if camera in self.server.failing:
+            self._reply(500, 'Error\r\n')
+            return
+        query = dict(parse_qsl(parts.query))
+        query.pop('action', None)
+        self.server.configs.setdefault(camera, {}).update(query)
+        self._reply(200, 'OK\r\n')
+
+class LocalCameraSwitcher(CameraSwitcher):
+    '''Switches the cameras on a FakeCameraServer instead of the real hosts.'''
+
+    def __init__(self, server: FakeCameraServer, surveillance: SurveillanceConfig, **kwargs):
+        self.server = server
+        super().__init__(surveillance, **kwargs)
+
+    def base_url(self, cam: WebCam) -> str:
+        return f'{self.server.url}/{cam.hostname}'
+
+def fake_cameras(count: int, known_profile_every: int = 4) -> SurveillanceConfig:
+    '''Cameras of which every other one has privacy masks, and every known_profile_every-th is known to have the day profile.'''
+    cams = tuple(WebCam(f'cam-{n}', f'cam{n}', True, True, n % 2 == 0, True, 'day' if n % known_profile_every == 1 else '')
+                 for n in range(count))
+    return SurveillanceConfig('cctv.invalid', 'admin', 'secret', cams)
+
+def expected_config(cam: WebCam, profile_name: str) -> Dict[str, str]:
+    '''The settings a camera should have after a switch to the profile.'''
+    profile = CAMERA_PROFILES[profile_name]
+    settings = {'VideoInMode[0].Config[0]': str(profile.video_in_mode)}
+    if cam.use_sec_mask:
+        blend = str(profile.privacy_masks).lower()
+        settings.update({'VideoWidget[0].Covers[0].EncodeBlend': blend, 'VideoWidget[0].Covers[0].PreviewBlend': blend})
+    return settings
+
+def check_switch(server: FakeCameraServer, surveillance: SurveillanceConfig, report: SwitchReport, requests_before: Counter,
+                 expected_skips: Iterable[str]):
+    '''
+    Checks a switch against the fake server: the switched cameras have the settings of the profile, the
+    cameras expected to be skipped were skipped and got no request, the failing cameras are reported as failed,
+    each camera has been challenged at most once and no request had a bad digest.
+    '''
+    expected_skips = set(expected_skips)
+    for cam in surveillance.profile_cams:
+        result = report.results[cam.shortname]
+        new_requests = server.requests[cam.hostname] - requests_before[cam.hostname]
+        if cam.hostname in server.failing:
+            assert result.outcome == 'failed', f'{cam.hostname} failed but was reported as {result.outcome}'
+        elif cam.hostname in expected_skips:
+            assert result.outcome == 'skipped', f'{cam.hostname} had [{report.profile}] but was {result.outcome}'
+            assert new_requests == 0, f'{cam.hostname} had [{report.profile}] but got {new_requests} requests'
+        else:
+            assert result.outcome == 'switched', f'{cam.hostname} was {result.outcome}: {result.detail}'
+            assert new_requests == 1, f'{cam.hostname} got {new_requests} requests for one switch'
+            expected = expected_config(cam, report.profile)
+            actual = {key: server.configs.get(cam.hostname, {}).get(key) for key in expected}
+            assert actual == expected, f'{cam.hostname} has {actual} after a switch to [{report.profile}], expected {expected}'
+        assert server.challenges[cam.hostname] <= 1, f'{cam.hostname} was challenged {server.challenges[cam.hostname]} times'
+    assert not server.counts['bad_digests'], f'{server.counts["bad_digests"]} requests had a bad digest'
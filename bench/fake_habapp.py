@@ -0,0 +1,686 @@
+'''
+A fake HABApp layer for running the rules offline.
+
+install() registers stand-ins for the HABApp modules used by lib/ and rules/, and for the third party
+clients (Pushover, Clickatell, the heat pump and Nord Pool objects), in sys.modules. Items live in an
+in-memory registry, events are dispatched synchronously on the calling thread and all scheduled jobs run
+on a virtual clock that only moves when the benchmark advances it. Everything that would leave the
+house (openHAB commands and updates, MQTT publishes, Pushover and SMS messages) is counted in `outbound`.
+'''
+import atexit
+import heapq
+import inspect
+import itertools
+import math
+import os
+import sys
+import tempfile
+import time
+import types
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAM_DIR = os.path.join(ROOT, 'param')
+DEFAULT_LIGHTING_CONFIG = {'configuration': {'lighting': {'LIGHT_LEVEL': {'BRIGHT': 4, 'SHADY': 3, 'DARK': 2, 'BLACK': 1}}}}
+
+# The times of the sun events, used by the on_sun_* and on_sunrise/on_sunset schedulers
+SUN_TIMES = {'dawn': (5, 30), 'sunrise': (6, 0), 'sunset': (20, 0), 'dusk': (20, 30)}
+
+outbound = Counter()
+_MISSING = object()
+
+# ----------------------------------------------------------------------------------------------------------
+# Virtual clock
+# ----------------------------------------------------------------------------------------------------------
+class VirtualClock:
+    def __init__(self, start: datetime):
+        self._now = start
+
+    def now(self) -> datetime:
+        return self._now
+
+    def set(self, now: datetime):
+        if now > self._now:
+            self._now = now
+
+clock = VirtualClock(datetime(2024, 7, 1, 0, 0, 0))
+
+class _VirtualDatetimeType(type):
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, datetime)
+
+class VirtualDatetime(datetime, metaclass=_VirtualDatetimeType):
+    '''Replaces datetime for the loaded modules so that now() and today() follow the virtual clock.'''
+
+    @classmethod
+    def now(cls, tz=None):
+        return clock.now() if tz is None else clock.now().astimezone(tz)
+
+    @classmethod
+    def today(cls):
+        return clock.now()
+
+# ----------------------------------------------------------------------------------------------------------
+# Callback timing
+# ----------------------------------------------------------------------------------------------------------
+callback_durations: Dict[str, List[float]] = defaultdict(list)
+
+def _callback_name(callback: Callable) -> str:
+    callback = inspect.unwrap(callback)
+    owner = getattr(callback, '__self__', None)
+    if owner is not None:
+        return f'{type(owner).__name__}.{callback.__name__}'
+    return getattr(callback, '__qualname__', repr(callback))
+
+def invoke(callback: Callable, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return callback(*args, **kwargs)
+    finally:
+        callback_durations[_callback_name(callback)].append(time.perf_counter() - start)
+
+# ----------------------------------------------------------------------------------------------------------
+# Events
+# ----------------------------------------------------------------------------------------------------------
+class ValueUpdateEvent:
+    def __init__(self, name: str, value: Any):
+        self.name = name
+        self.value = value
+
+class ValueChangeEvent:
+    def __init__(self, name: str, value: Any, old_value: Any):
+        self.name = name
+        self.value = value
+        self.old_value = old_value
+
+class RequestFileLoadEvent:
+    def __init__(self, name: str):
+        self.name = name
+
+class EventFilter:
+    def __init__(self, event_class: type, **kwargs):
+        self.event_class = event_class
+        self.attributes = kwargs
+
+    def matches(self, event) -> bool:
+        if not isinstance(event, self.event_class):
+            return False
+        return all(getattr(event, name, _MISSING) == value for name, value in self.attributes.items())
+
+class ValueUpdateEventFilter(EventFilter):
+    def __init__(self, value: Any = _MISSING):
+        super().__init__(ValueUpdateEvent, **({} if value is _MISSING else {'value': value}))
+
+class ValueChangeEventFilter(EventFilter):
+    def __init__(self, value: Any = _MISSING, old_value: Any = _MISSING):
+        attributes = {}
+        if value is not _MISSING:
+            attributes['value'] = value
+        if old_value is not _MISSING:
+            attributes['old_value'] = old_value
+        super().__init__(ValueChangeEvent, **attributes)
+
+class EventBusListener:
+    def __init__(self, bus: 'EventBus', name: str, entry: tuple):
+        self._bus = bus
+        self.name = name
+        self._entry = entry
+
+    def cancel(self):
+        listeners = self._bus.listeners.get(self.name, [])
+        if self._entry in listeners:
+            listeners.remove(self._entry)
+
+class EventBus:
+    def __init__(self):
+        self.listeners: Dict[str, List[tuple]] = defaultdict(list)
+        self.posted = 0
+
+    def listen(self, name: str, callback: Callable, event_filter: Optional[EventFilter] = None) -> EventBusListener:
+        entry = (callback, event_filter)
+        self.listeners[name].append(entry)
+        return EventBusListener(self, name, entry)
+
+    def post(self, name: str, event):
+        self.posted += 1
+        for callback, event_filter in list(self.listeners.get(name, ())):
+            if event_filter is None or event_filter.matches(event):
+                invoke(callback, event)
+
+bus = EventBus()
+
+# ----------------------------------------------------------------------------------------------------------
+# Scheduler
+# ----------------------------------------------------------------------------------------------------------
+class Job:
+    def __init__(self, scheduler: 'Scheduler', due: Optional[datetime], interval: Optional[timedelta], callback: Callable, args: tuple, kwargs: dict):
+        self.scheduler = scheduler
+        self.due = due
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.countdown: Optional[timedelta] = None
+
+    def get_next_run(self) -> Optional[datetime]:
+        return self.due
+
+    def cancel(self):
+        self.cancelled = True
+
+    # Countdown jobs
+    def reset(self):
+        self.cancelled = False
+        self.scheduler.push(self, clock.now() + self.countdown)
+
+    def stop(self):
+        self.cancelled = True
+
+class Scheduler:
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def push(self, job: Job, due: datetime):
+        job.due = due
+        heapq.heappush(self._heap, (due, next(self._sequence), job))
+
+    def pending(self) -> int:
+        return sum(1 for _, _, job in self._heap if not job.cancelled)
+
+    def next_due(self) -> Optional[datetime]:
+        while self._heap and (self._heap[0][2].cancelled or self._heap[0][2].due != self._heap[0][0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def run_until(self, until: datetime):
+        '''Runs all jobs that are due up to until, moving the virtual clock along, and leaves the clock at until.'''
+        while True:
+            due = self.next_due()
+            if due is None or due > until:
+                break
+            _, _, job = heapq.heappop(self._heap)
+            clock.set(due)
+            if job.interval is not None:
+                self.push(job, due + job.interval)
+            invoke(job.callback, *job.args, **job.kwargs)
+        clock.set(until)
+
+    def advance(self, delta: timedelta):
+        self.run_until(clock.now() + delta)
+
+    def jump(self, until: datetime):
+        '''
+        Moves the virtual clock to until without running the jobs in between: the repeating jobs go on from their
+        first run after until, and the other jobs that were due run once, at until.
+        '''
+        overdue = []
+        while True:
+            due = self.next_due()
+            if due is None or due > until:
+                break
+            _, _, job = heapq.heappop(self._heap)
+            if job.interval is not None:
+                self.push(job, due + ((until - due) // job.interval + 1) * job.interval)
+            else:
+                overdue.append(job)
+        clock.set(until)
+        for job in overdue:
+            invoke(job.callback, *job.args, **job.kwargs)
+
+scheduler = Scheduler()
+
+def _to_datetime(value) -> datetime:
+    if value is None:
+        return clock.now()
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, timedelta):
+        return clock.now() + value
+    return clock.now() + timedelta(seconds=value)
+
+def _to_timedelta(value) -> timedelta:
+    return value if isinstance(value, timedelta) else timedelta(seconds=value)
+
+class RuleScheduler:
+    '''The self.run object of a rule.'''
+
+    def _schedule(self, due: datetime, interval: Optional[timedelta], callback: Callable, args: tuple, kwargs: dict) -> Job:
+        job = Job(scheduler, due, interval, callback, args, kwargs)
+        scheduler.push(job, due)
+        return job
+
+    def soon(self, callback: Callable, *args, **kwargs) -> Job:
+        return self._schedule(clock.now(), None, callback, args, kwargs)
+
+    def at(self, time, callback: Callable, *args, **kwargs) -> Job:
+        return self._schedule(_to_datetime(time), None, callback, args, kwargs)
+
+    def every(self, start_time, interval, callback: Callable, *args, **kwargs) -> Job:
+        return self._schedule(_to_datetime(start_time), _to_timedelta(interval), callback, args, kwargs)
+
+    def every_minute(self, callback: Callable, *args, **kwargs) -> Job:
+        next_minute = (clock.now() + timedelta(minutes=1)).replace(second=0, microsecond=0)
+        return self._schedule(next_minute, timedelta(minutes=1), callback, args, kwargs)
+
+    def every_hour(self, callback: Callable, *args, **kwargs) -> Job:
+        next_hour = (clock.now() + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        return self._schedule(next_hour, timedelta(hours=1), callback, args, kwargs)
+
+    def countdown(self, expire_time, callback: Callable, *args, **kwargs) -> Job:
+        job = Job(scheduler, None, None, callback, args, kwargs)
+        job.countdown = _to_timedelta(expire_time)
+        job.cancelled = True # Started by reset()
+        return job
+
+    def _daily(self, sun_event: str, callback: Callable, args: tuple, kwargs: dict) -> Job:
+        hour, minute = SUN_TIMES[sun_event]
+        due = clock.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if due <= clock.now():
+            due += timedelta(days=1)
+        return self._schedule(due, timedelta(days=1), callback, args, kwargs)
+
+    def on_sun_dawn(self, callback: Callable, *args, **kwargs) -> Job:
+        return self._daily('dawn', callback, args, kwargs)
+
+    def on_sunrise(self, callback: Callable, *args, **kwargs) -> Job:
+        return self._daily('sunrise', callback, args, kwargs)
+
+    def on_sunset(self, callback: Callable, *args, **kwargs) -> Job:
+        return self._daily('sunset', callback, args, kwargs)
+
+    def on_sun_dusk(self, callback: Callable, *args, **kwargs) -> Job:
+        return self._daily('dusk', callback, args, kwargs)
+
+# ----------------------------------------------------------------------------------------------------------
+# Items
+# ----------------------------------------------------------------------------------------------------------
+class ItemNotFoundException(Exception):
+    pass
+
+class PersistenceData:
+    def __init__(self, data: Dict[float, Any]):
+        self.data = data
+
+    def get_data(self, start_date=None, end_date=None) -> Dict[float, Any]:
+        return self.data
+
+    def average(self) -> Optional[float]:
+        return sum(self.data.values()) / len(self.data) if self.data else None
+
+    def min(self) -> Optional[float]:
+        return min(self.data.values()) if self.data else None
+
+    def max(self) -> Optional[float]:
+        return max(self.data.values()) if self.data else None
+
+class PersistenceStore:
+    def __init__(self):
+        self.series: Dict[str, Dict[float, Any]] = defaultdict(dict)
+        self.queries = 0
+
+    def record(self, name: str, value: Any, when: Optional[datetime] = None):
+        if isinstance(value, (int, float)):
+            self.series[name][(when or clock.now()).timestamp()] = value
+
+    def query(self, name: str, start: datetime, end: datetime) -> PersistenceData:
+        self.queries += 1
+        start_timestamp, end_timestamp = start.timestamp(), end.timestamp()
+        return PersistenceData({timestamp: value for timestamp, value in self.series[name].items() if start_timestamp <= timestamp <= end_timestamp})
+
+persistence = PersistenceStore()
+_items: Dict[str, 'Item'] = {}
+
+class Item:
+    def __init__(self, name: str, initial_value: Any = None):
+        self.name = name
+        self.value = initial_value
+        self.last_update = clock.now()
+        self.last_change = clock.now()
+
+    @classmethod
+    def get_item(cls, name: str) -> 'Item':
+        # Missing items are created on demand so that the rules load without a full item setup
+        item = _items.get(name)
+        if item is None:
+            item = _items[name] = cls(name)
+        return item
+
+    @classmethod
+    def get_create_item(cls, name: str, initial_value: Any = None) -> 'Item':
+        item = _items.get(name)
+        if item is None:
+            item = _items[name] = cls(name, initial_value)
+        return item
+
+    def get_value(self, default_value: Any = None) -> Any:
+        return default_value if self.value is None else self.value
+
+    def set_value(self, new_value: Any) -> bool:
+        self.last_update = clock.now()
+        if new_value == self.value:
+            return False
+        self.value = new_value
+        self.last_change = clock.now()
+        persistence.record(self.name, new_value)
+        return True
+
+    def post_value(self, new_value: Any) -> bool:
+        old_value = self.value
+        changed = self.set_value(new_value)
+        bus.post(self.name, ValueUpdateEvent(self.name, new_value))
+        if changed:
+            bus.post(self.name, ValueChangeEvent(self.name, new_value, old_value))
+        return changed
+
+    def listen_event(self, callback: Callable, event_filter: Optional[EventFilter] = None):
+        # Like HABApp, the listener is registered with the rule that is being created, but not through its listen_event
+        if _current_rule is None:
+            return bus.listen(self.name, callback, event_filter)
+        return Rule.listen_event(_current_rule, self.name, callback, event_filter)
+
+class OpenhabItem(Item):
+    def oh_send_command(self, value: Any = _MISSING):
+        outbound['openhab_command'] += 1
+        self.post_value(self.value if value is _MISSING else value)
+
+    def oh_post_update(self, value: Any = _MISSING):
+        outbound['openhab_update'] += 1
+        self.post_value(self.value if value is _MISSING else value)
+
+    def oh_post_update_if(self, new_value: Any, *, equal: Any = _MISSING, not_equal: Any = _MISSING) -> bool:
+        if equal is not _MISSING and self.value != equal:
+            return False
+        if not_equal is not _MISSING and self.value == not_equal:
+            return False
+        self.oh_post_update(new_value)
+        return True
+
+    def command_value(self, value: Any):
+        self.oh_send_command(value)
+
+    def get_persistence_data(self, persistence: Optional[str] = None, start_time: Optional[datetime] = None, end_time: Optional[datetime] = None) -> PersistenceData:
+        return globals()['persistence'].query(self.name, start_time or datetime.min, end_time or clock.now())
+
+class NumberItem(OpenhabItem):
+    pass
+
+class StringItem(OpenhabItem):
+    pass
+
+class DatetimeItem(OpenhabItem):
+    pass
+
+class ContactItem(OpenhabItem):
+    pass
+
+class SwitchItem(OpenhabItem):
+    def is_on(self) -> bool:
+        return self.value == 'ON'
+
+    def is_off(self) -> bool:
+        return self.value == 'OFF'
+
+    def on(self):
+        self.oh_send_command('ON')
+
+    def off(self):
+        self.oh_send_command('OFF')
+
+class DimmerItem(SwitchItem):
+    pass
+
+class ColorItem(OpenhabItem):
+    pass
+
+class GroupItem(OpenhabItem):
+    def __init__(self, name: str, initial_value: Any = None):
+        super().__init__(name, initial_value)
+        self.member_names: List[str] = []
+
+    @property
+    def members(self):
+        return tuple(_items[name] for name in self.member_names)
+
+class ItemRegistry:
+    '''The part of HABApp.core.Items the lib modules use.'''
+
+    @staticmethod
+    def item_exists(name: str) -> bool:
+        return name in _items
+
+    @staticmethod
+    def pop_item(name: str) -> Item:
+        return _items.pop(name)
+
+class MqttItem(Item):
+    def publish(self, payload: Any, qos: Optional[int] = None, retain: Optional[bool] = None):
+        outbound['mqtt_publish'] += 1
+        return True
+
+def create_item(cls: type, name: str, value: Any = None, history: Optional[Dict[datetime, Any]] = None) -> Item:
+    '''Creates (or replaces) an item with the given value and persisted history.'''
+    item = _items[name] = cls(name, value)
+    for when, history_value in (history or {}).items():
+        persistence.record(name, history_value, when)
+    return item
+
+def create_group(name: str, members: List[Item]) -> GroupItem:
+    group = create_item(GroupItem, name)
+    group.member_names = [member.name for member in members]
+    return group
+
+# ----------------------------------------------------------------------------------------------------------
+# Rules and parameters
+# ----------------------------------------------------------------------------------------------------------
+rules: List['Rule'] = []
+_current_rule: Optional['Rule'] = None
+
+class Rule:
+    def __init__(self):
+        global _current_rule
+        self.rule_name = type(self).__name__
+        self.run = RuleScheduler()
+        rules.append(self)
+        _current_rule = self
+
+    def listen_event(self, name, callback: Callable, event_filter: Optional[EventFilter] = None) -> EventBusListener:
+        return bus.listen(name if isinstance(name, str) else name.name, callback, event_filter)
+
+    def get_items(self, type: Optional[type] = None) -> List['Item']:
+        return [item for item in _items.values() if type is None or isinstance(item, type)]
+
+class DictParameter:
+    def __init__(self, filename: str, *keys, default_value: Any = None):
+        self.filename = filename
+        self.keys = keys
+        self.default_value = default_value
+
+    @property
+    def value(self) -> Any:
+        path = os.path.join(PARAM_DIR, f'{self.filename}.yml')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                value = yaml.safe_load(file)
+        elif self.filename == 'lighting_config':
+            value = DEFAULT_LIGHTING_CONFIG
+        else:
+            return self.default_value
+        if self.filename == 'my_config':
+            # Keeps the day-ahead prices fetched during a run out of the repository
+            value['configuration']['entsoe']['STORE_FILE'] = PRICE_STORE_FILE
+            # The light_noise scenario runs the LightLevel rule, which is off in the shipped configuration
+            value['configuration']['light_level']['ENABLED'] = True
+        for key in self.keys:
+            value = value[key]
+        return value
+
+# ----------------------------------------------------------------------------------------------------------
+# Third party clients
+# ----------------------------------------------------------------------------------------------------------
+class PushoverClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def send(self, message):
+        outbound['pushover'] += 1
+
+class PushoverMessage:
+    def __init__(self, message, **kwargs):
+        self.message = message
+        self.kwargs = kwargs
+
+class ClickatellHttp:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def sendMessage(self, to, message, extra=None):
+        outbound['sms'] += 1
+        return [{'id': str(n), 'destination': number, 'error': False} for n, number in enumerate(to)]
+
+class NibeF750HeatPump:
+    pass
+
+class NordPoolMarketData:
+    pass
+
+PRICE_STORE_FILE = os.path.join(tempfile.gettempdir(), f'bench_day_ahead_prices_{os.getpid()}.npy')
+PRICE_PUBLISH_HOUR = 13 # The virtual hour tomorrow's day-ahead prices are published
+
+def day_ahead_document(period_start: str, period_end: str) -> str:
+    '''
+    An ENTSO-E publication document with hourly prices that follow a daily curve, cheap at night and
+    expensive in the morning and evening, for the part of the period that has been published by now.
+    '''
+    start = datetime.strptime(period_start, '%Y%m%d%H%M').replace(tzinfo=timezone.utc)
+    end = datetime.strptime(period_end, '%Y%m%d%H%M').replace(tzinfo=timezone.utc)
+    now = clock.now()
+    published = datetime.combine(now.date() + timedelta(days=2 if now.hour >= PRICE_PUBLISH_HOUR else 1), datetime.min.time())
+    end = min(end, datetime.fromtimestamp(published.timestamp(), timezone.utc))
+    hours = int((end - start).total_seconds() // 3600)
+    if hours <= 0:
+        return '<Acknowledgement_MarketDocument><Reason><text>No matching data found</text></Reason></Acknowledgement_MarketDocument>'
+    points = ''.join(
+        f'<Point><position>{n + 1}</position><price.amount>{_price_of_hour(start + timedelta(hours=n)):.2f}</price.amount></Point>'
+        for n in range(hours)
+    )
+    return (f'<Publication_MarketDocument><TimeSeries><Period><timeInterval><start>{start:%Y-%m-%dT%H:%MZ}</start>'
+            f'<end>{end:%Y-%m-%dT%H:%MZ}</end></timeInterval><resolution>PT60M</resolution>{points}</Period></TimeSeries>'
+            '</Publication_MarketDocument>')
+
+def _price_of_hour(when: datetime) -> float:
+    hour = datetime.fromtimestamp(when.timestamp()).hour
+    return 40 + 35 * math.sin((hour - 4) * math.pi / 12) ** 2 + 10 * (hour in (7, 8, 17, 18, 19)) - 45 * (hour in (2, 3))
+
+class FakeResponse:
+    status_code = 200
+    ok = True
+
+    def __init__(self, url: str, params: Optional[dict] = None):
+        self.url = url
+        self.params = params or {}
+
+    @property
+    def text(self) -> str:
+        if 'entsoe' in self.url:
+            return day_ahead_document(self.params['periodStart'], self.params['periodEnd'])
+        return ''
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'uri': f'http://tts.invalid/cache/{abs(hash(self.url))}.mp3', 'duration': 2000}
+
+    def iter_lines(self, decode_unicode: bool = False):
+        return iter(())
+
+_online_request = None
+
+def _offline_request(session, method, url, *args, **kwargs):
+    if url.startswith(('http://127.0.0.1:', 'http://localhost:', 'https://127.0.0.1:')):
+        # Local fake servers are real
+        return _online_request(session, method, url, *args, **kwargs)
+    outbound['http_request'] += 1
+    return FakeResponse(url, kwargs.get('params'))
+
+# ----------------------------------------------------------------------------------------------------------
+# Installation
+# ----------------------------------------------------------------------------------------------------------
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = sys.modules.get(name) or types.ModuleType(name)
+    module.__dict__.update(attributes)
+    if '.' not in name:
+        module.__path__ = []
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        sys.modules[parent].__path__ = getattr(sys.modules[parent], '__path__', [])
+        setattr(sys.modules[parent], child, module)
+    return module
+
+class OnOffValue:
+    ON = 'ON'
+    OFF = 'OFF'
+
+class OpenClosedValue:
+    OPEN = 'OPEN'
+    CLOSED = 'CLOSED'
+
+class UpDownValue:
+    UP = 'UP'
+    DOWN = 'DOWN'
+
+def install():
+    '''Registers the fake modules and puts lib/ on the path. Network access through requests is replaced.'''
+    _module('HABApp', DictParameter=DictParameter, Rule=Rule)
+    _module('HABApp.core', Items=ItemRegistry)
+    _module('HABApp.core.items', Item=Item, BaseValueItem=Item)
+    _module('HABApp.core.events', ValueUpdateEvent=ValueUpdateEvent, ValueChangeEvent=ValueChangeEvent, EventFilter=EventFilter,
+            ValueUpdateEventFilter=ValueUpdateEventFilter, ValueChangeEventFilter=ValueChangeEventFilter)
+    _module('HABApp.core.events.habapp_events', RequestFileLoadEvent=RequestFileLoadEvent)
+    _module('HABApp.core.errors', ItemNotFoundException=ItemNotFoundException)
+    _module('HABApp.openhab')
+    _module('HABApp.openhab.definitions', OnOffValue=OnOffValue, OpenClosedValue=OpenClosedValue, UpDownValue=UpDownValue)
+    _module('HABApp.openhab.items', OpenhabItem=OpenhabItem, NumberItem=NumberItem, StringItem=StringItem, DatetimeItem=DatetimeItem,
+            ContactItem=ContactItem, SwitchItem=SwitchItem, DimmerItem=DimmerItem, ColorItem=ColorItem, GroupItem=GroupItem)
+    _module('HABApp.mqtt')
+    _module('HABApp.mqtt.items', MqttItem=MqttItem)
+    _module('pushover', Client=PushoverClient, Message=PushoverMessage)
+    _module('clickatell')
+    _module('clickatell.http', Http=ClickatellHttp)
+    _module('nibe_f750_heat_pump', NibeF750HeatPump=NibeF750HeatPump)
+    _module('nord_pool_market_data', NordPoolMarketData=NordPoolMarketData)
+
+    import requests
+    global _online_request
+    _online_request = _online_request or requests.Session.request
+    requests.Session.request = _offline_request
+    atexit.register(lambda: os.path.exists(PRICE_STORE_FILE) and os.remove(PRICE_STORE_FILE))
+
+    # Modules do 'from datetime import datetime' when they are loaded, so the class is replaced at the source
+    import datetime as datetime_module
+    datetime_module.datetime = VirtualDatetime
+
+    lib_dir = os.path.join(ROOT, 'lib')
+    if lib_dir not in sys.path:
+        sys.path.insert(0, lib_dir)
+
+def load_rules(rule_dir: str = os.path.join(ROOT, 'rules')) -> List[types.ModuleType]:
+    '''Loads the rule files in the order HABApp would (alphabetically) and returns their modules.'''
+    import importlib.util
+    modules = []
+    for filename in sorted(os.listdir(rule_dir)):
+        if not filename.endswith('.py'):
+            continue
+        spec = importlib.util.spec_from_file_location(f'rules.{filename[:-3]}', os.path.join(rule_dir, filename))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        modules.append(module)
+    return modules
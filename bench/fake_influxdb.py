@@ -0,0 +1,125 @@
+'''
+A local stand-in for InfluxDB 2 and the openHAB persistence REST API, for testing and benchmarking the
+bulk history reader in lib/myinfluxdb.py against per item persistence calls.
+
+The InfluxDB side replays recorded responses: POST /api/v2/query answers a Flux query with the CSV body
+recorded for exactly that query, after checking the token, the org and the content type, and answers an
+unknown query with an InfluxDB error. Recordings are {query: CSV body} and are kept as JSON; record() captures
+one from a real InfluxDB, and series_csv() writes one for made up series in the format InfluxDB answers with.
+The openHAB side answers GET /rest/persistence/items/<item> with the same series, in the JSON openHAB uses.
+'''
+import json
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import requests
+
+Series = Tuple[np.ndarray, np.ndarray] # UTC times as datetime64[s], values
+
+def series_csv(series: Dict[str, Series]) -> bytes:
+    '''
+    The CSV InfluxDB answers a query that keeps _time, _value and _measurement with: a header row, then one
+    table per measurement, numbered in the table column.
+    '''
+    lines = [',result,table,_time,_value,_measurement']
+    for table, (name, (times, values)) in enumerate(series.items()):
+        stamps = np.datetime_as_string(times.astype('datetime64[s]'), unit='s')
+        lines += [f',_result,{table},{stamp}Z,{value!r},{name}' for stamp, value in zip(stamps.tolist(), values.tolist())]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+def record(url: str, token: str, org: str, query: str) -> bytes:
+    '''The CSV body a real InfluxDB answers the Flux query with, to be kept in a recording.'''
+    response = requests.post(f'{url.rstrip("/")}/api/v2/query', params={'org': org}, data=query.encode(), timeout=60,
+                             headers={'Authorization': f'Token {token}', 'Content-Type': 'application/vnd.flux', 'Accept': 'application/csv'})
+    response.raise_for_status()
+    return response.content
+
+def save_recordings(path: str, recordings: Dict[str, bytes]):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({query: body.decode() for query, body in recordings.items()}, file)
+
+def load_recordings(path: str) -> Dict[str, bytes]:
+    with open(path, encoding='utf-8') as file:
+        return {query: body.encode() for query, body in json.load(file).items()}
+
+class FakeInfluxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, token: str, org: str, recordings: Optional[Dict[str, bytes]] = None, series: Optional[Dict[str, Series]] = None):
+        super().__init__(('127.0.0.1', 0), _InfluxHandler)
+        self.token = token
+        self.org = org
+        self.recordings = dict(recordings or {})
+        self.series = dict(series or {}) # Served by the openHAB persistence API
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, name='FakeInfluxServer', daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, what: str, amount: int = 1):
+        with self._lock:
+            self.counts[what] += amount
+
+class _InfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # The headers and the body are written separately
+    server: FakeInfluxServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes', len(body))
+
+    def _error(self, status: int, code: str, message: str):
+        self.server.count('errors')
+        self._reply(status, json.dumps({'code': code, 'message': message}).encode(), 'application/json')
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        query = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        if parts.path != '/api/v2/query':
+            self._error(404, 'not found', 'path not found')
+        elif self.headers.get('Authorization') != f'Token {self.server.token}':
+            self._error(401, 'unauthorized', 'unauthorized access')
+        elif parse_qs(parts.query).get('org') != [self.server.org]:
+            self._error(404, 'not found', f'organization name "{parse_qs(parts.query).get("org")}" not found')
+        elif self.headers.get('Content-Type') != 'application/vnd.flux':
+            self._error(400, 'invalid', 'unsupported content type')
+        elif query not in self.server.recordings:
+            self._error(400, 'invalid', 'no recorded response for the query')
+        else:
+            self.server.count('queries')
+            self._reply(200, self.server.recordings[query], 'text/csv; charset=utf-8')
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        prefix = '/rest/persistence/items/'
+        name = unquote(parts.path[len(prefix):]) if parts.path.startswith(prefix) else None
+        if name not in self.server.series:
+            self._reply(404, b'{"error":{"message":"Item not found","http-code":404}}', 'application/json')
+            return
+        self.server.count('persistence_calls')
+        times, values = self.server.series[name]
+        milliseconds = times.astype('datetime64[ms]').astype(np.int64).tolist()
+        data = [{'time': time, 'state': str(value)} for time, value in zip(milliseconds, values.tolist())]
+        body = json.dumps({'name': name, 'datapoints': str(len(data)), 'data': data}).encode()
+        self._reply(200, body, 'application/json')
+
+def utc_minutes(start: datetime, count: int) -> np.ndarray:
+    '''count times a minute apart from start, as UTC datetime64[s].'''
+    first = np.datetime64(int(start.astimezone(timezone.utc).timestamp()), 's')
+    return first + np.arange(count) * np.timedelta64(60, 's')
@@ -0,0 +1,112 @@
+'''
+A local stand-in for the LaMetric device, for benchmarking the notification paths.
+
+A threaded HTTPS/1.1 server on the loopback interface with a self signed certificate, made with the
+openssl command when the server starts, like the device has. It checks the basic authentication of the
+dev user and the notification payload, answers with the id of the notification after a simulated
+processing delay, and counts connections, each a TLS handshake, notifications and rejected requests.
+Clients that close a connection without ending the TLS session, as curl and the connection pool do, are
+counted as eof_disconnects rather than reported with a traceback.
+'''
+import base64
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMETRIC_DELAY_SECS = 0.002 # Time the device takes to accept a notification
+LAMETRIC_PATH = '/api/v2/device/notifications'
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+    '''A server context with a new self signed certificate for 127.0.0.1, kept in directory.'''
+    key, cert = os.path.join(directory, 'key.pem'), os.path.join(directory, 'cert.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=127.0.0.1'], check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+class FakeLaMetricServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api_key: str, delay: float = LAMETRIC_DELAY_SECS):
+        super().__init__(('127.0.0.1', 0), _LaMetricHandler)
+        self.authorization = 'Basic ' + base64.b64encode(f'dev:{api_key}'.encode()).decode()
+        self.delay = delay
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._directory = tempfile.TemporaryDirectory()
+        self.socket = self_signed_context(self._directory.name).wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        threading.Thread(target=self.serve_forever, name='FakeLaMetricServer', daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f'https://127.0.0.1:{self.port}{LAMETRIC_PATH}'
+
+    def count(self, what: str):
+        with self._lock:
+            self.counts[what] += 1
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ssl.SSLEOFError, ssl.SSLZeroReturnError, ConnectionResetError, BrokenPipeError)):
+            self.count('eof_disconnects')
+            return
+        super().handle_error(request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self._directory.cleanup()
+
+class _LaMetricHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the device
+    disable_nagle_algorithm = True # The headers and the body are written separately
+    server: FakeLaMetricServer
+
+    def setup(self):
+        super().setup()
+        # The handshake is done here, on the connection's own thread, rather than in the accepting thread
+        self.connection.do_handshake()
+        self.server.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != LAMETRIC_PATH:
+            self.server.count('rejected')
+            self._reply(404, {'errors': [{'message': 'Not found'}]})
+            return
+        if self.headers.get('Authorization') != self.server.authorization:
+            self.server.count('rejected')
+            self._reply(401, {'errors': [{'message': 'Authorization is required'}]})
+            return
+        try:
+            json.loads(body)['model']['frames'][0]['text']
+        except (ValueError, KeyError, IndexError, TypeError):
+            self.server.count('rejected')
+            self._reply(400, {'errors': [{'message': 'Invalid notification'}]})
+            return
+        time.sleep(self.server.delay)
+        with self.server._lock:
+            self.server.counts['notifications'] += 1
+            notification_id = self.server.counts['notifications']
+        self._reply(201, {'success': {'id': str(notification_id)}})
@@ -0,0 +1,121 @@
+'''
+Replays an event log recorded by the EventRecorder rule (rules/event_log_routines.py) against the rules, offline.
+
+Creates the items of the log with their first recorded values, loads the real rules/*.py on top of the fake
+HABApp layer and posts the events through the fake event bus at their recorded times on the virtual clock,
+so the scheduled jobs of the rules, e.g. the self.run.every timers, run at their times in between. The
+replay runs as fast as it can, or at a multiple of real time of up to MAX_SPEED with --speed. The log is
+read from its memory map a chunk at a time, so a long log doesn't have to fit in memory.
+
+    python bench/replay.py events.evlog               # As fast as possible
+    python bench/replay.py events.evlog --speed 60    # An hour of events a minute
+'''
+import argparse
+import logging
+import math
+import os
+import resource
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_habapp as fake # noqa: E402
+
+fake.install()
+
+from myeventlog import DATETIME, FLOAT, INTEGER, STRING, TUPLE, EventLogReader # noqa: E402
+
+MAX_SPEED = 1000 # Times real time
+
+class ReplayResult(NamedTuple):
+    events: int
+    virtual_secs: float
+    wall_secs: float
+
+def item_class(log: EventLogReader, name: str, kinds: Tuple[int, ...]) -> type:
+    '''The item type that fits the kinds of value of the item in the log.'''
+    if set(kinds) & {INTEGER, FLOAT}:
+        return fake.NumberItem
+    if DATETIME in kinds:
+        return fake.DatetimeItem
+    if TUPLE in kinds:
+        return fake.ColorItem
+    if STRING in kinds:
+        values = set(log.string_values(name))
+        if values <= {'ON', 'OFF'}:
+            return fake.SwitchItem
+        if values <= {'OPEN', 'CLOSED'}:
+            return fake.ContactItem
+    return fake.StringItem
+
+def create_items(log: EventLogReader):
+    '''Creates the items of the log that don't exist, with their first value in the log.'''
+    kinds = log.item_kinds()
+    name_ids, first = np.unique(log.records['name'], return_index=True)
+    for name_id, index in zip(name_ids.tolist(), first.tolist()):
+        name = log.names[name_id]
+        if name not in fake._items:
+            record = log.records[index]
+            fake.create_item(item_class(log, name, kinds[name]), name, log.decode(int(record['kind']), float(record['value'])))
+
+def start_time(log: EventLogReader) -> datetime:
+    '''When the log starts on the virtual clock: when it was recorded, or the same time of day on a later day if the clock is past that.'''
+    start, now = log.start, fake.clock.now()
+    if start < now:
+        start += timedelta(days=math.ceil((now - start) / timedelta(days=1)))
+    return start
+
+def replay(log: EventLogReader, start: datetime, speed: Optional[float] = None) -> ReplayResult:
+    '''
+    Posts the events of the log from start on the virtual clock, running the jobs that are due in between.
+    With a speed the replay is held back to that multiple of real time.
+    '''
+    fake.scheduler.jump(start)
+    wall_start = time.perf_counter()
+    events = 0
+    for event in log:
+        if speed:
+            ahead = event.time_secs / speed - (time.perf_counter() - wall_start)
+            if ahead > 0:
+                time.sleep(ahead)
+        fake.scheduler.run_until(start + timedelta(seconds=event.time_secs))
+        fake._items[event.name].post_value(event.value)
+        events += 1
+    fake.scheduler.run_until(start + timedelta(seconds=log.duration_secs))
+    return ReplayResult(events, log.duration_secs, time.perf_counter() - wall_start)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='The event log, e.g. events.evlog')
+    parser.add_argument('-s', '--speed', type=float, help=f'Times real time, 1 to {MAX_SPEED} (default: as fast as possible)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the log output of the rules')
+    args = parser.parse_args()
+    if args.speed is not None and not 1 <= args.speed <= MAX_SPEED:
+        parser.error(f'The speed must be from 1 to {MAX_SPEED}')
+    from run import report_callbacks
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    log = EventLogReader(args.log)
+    start = start_time(log)
+    fake.scheduler.jump(start)
+    create_items(log)
+    fake.load_rules()
+    outbound_before = fake.outbound.copy()
+    fake.callback_durations.clear()
+    result = replay(log, start, args.speed)
+    print(f'Replayed {result.events} events of {len(log.item_kinds())} items from {start}, covering '
+          f'{result.virtual_secs / 3600:.1f} hours, in {result.wall_secs:.2f} s '
+          f'({result.virtual_secs / result.wall_secs if result.wall_secs else 0:,.0f} times real time), '
+          f'max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.1f} MiB')
+    report_callbacks(result.events, Counter(fake.outbound - outbound_before))
+
+if __name__ == '__main__':
+    main()
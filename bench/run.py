@@ -0,0 +1,672 @@
+'''
+Offline benchmark of the rules.
+
+Loads the real rules/*.py on top of the fake HABApp layer in fake_habapp.py, drives event storms and
+simulated days through them on a virtual clock, and reports per callback latency percentiles, memory
+allocations and outbound messages (openHAB commands/updates, MQTT, Pushover, SMS, HTTP) per event.
+The scenarios that compare ways of sending also report the messages per second of each way.
+
+    python bench/run.py                       # All scenarios
+    python bench/run.py humidity_storm -n 5000
+'''
+import argparse
+import gc
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import timedelta
+from typing import Callable, Dict, NamedTuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_habapp as fake # noqa: E402
+
+fake.install()
+
+SETTLE_SECS = 0.1 # Real time given to the background publishers to flush after a scenario
+
+class ScenarioResult(NamedTuple):
+    name: str
+    events: int
+    wall_secs: float
+    outbound: Counter
+    allocated_kib: float
+    peak_kib: float
+    rates: Dict[str, float]
+
+rates: Dict[str, float] = {} # Messages per second of the paths a scenario compares, e.g. 'lametric client'
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+# ----------------------------------------------------------------------------------------------------------
+# Items and scenarios
+# ----------------------------------------------------------------------------------------------------------
+HUM_SENSORS = ('Bathroom_Humidity', 'Shower_Humidity', 'Bathroom_Fan_Humidity')
+LIGHT_SENSORS = ('Pws_Light', 'Node7_Light')
+
+def create_items():
+    '''Creates the items the rules read, with plausible values and two days of humidity history.'''
+    now = fake.clock.now()
+    sensors = []
+    for name in HUM_SENSORS:
+        history = {now - timedelta(minutes=10 * n): 45 + (n % 12) for n in range(1, 48 * 6)}
+        sensors.append(fake.create_item(fake.NumberItem, name, 45, history))
+    fake.create_group('G_Bathroom_Hum_Control', sensors)
+    fake.create_item(fake.SwitchItem, 'Flatulence_Button', 'OFF')
+    fake.create_item(fake.SwitchItem, 'Flatulence_Extra_Vent', 'OFF')
+    fake.create_item(fake.SwitchItem, 'Excess_Hum_Extra_Vent', 'OFF')
+    fake.create_item(fake.DatetimeItem, 'Bathroom_Block_Fan_Until', now - timedelta(hours=1))
+    fake.create_item(fake.SwitchItem, 'Summer_Extra_Vent', 'OFF')
+    fake.create_item(fake.NumberItem, 'Particle_Concentration_PM2_5', 5)
+    fake.create_item(fake.NumberItem, 'Temp_Hallway', 26)
+    fake.create_item(fake.NumberItem, 'Nibe_40004', 18)
+    fake.create_item(fake.StringItem, 'SPC_Area_1_Mode', 'unset')
+    fake.create_item(fake.NumberItem, 'Pws_Temp', 2.5)
+    fake.create_item(fake.NumberItem, 'Sys_LightLevel', 3)
+    for name in LIGHT_SENSORS:
+        fake.create_item(fake.NumberItem, name, 400)
+    fake.create_item(fake.StringItem, 'Energy_Spending_Level', None)
+    fake.create_item(fake.StringItem, 'Energy_Spending_Plan', None)
+    fake.create_item(fake.SwitchItem, 'EV_Charge_Planned', 'OFF')
+    fake.create_item(fake.NumberItem, 'EV_Charge_Need', 20)
+    fake.create_item(fake.DatetimeItem, 'EV_Charge_Deadline', now + timedelta(hours=31))
+    for name, hour in (('V_CivilDawn', 5), ('V_Sunrise', 6), ('V_CivilDuskStart', 20), ('V_CivilDuskEnd', 21)):
+        fake.create_item(fake.DatetimeItem, name, now.replace(hour=hour, minute=0))
+
+def humidity_storm(events: int) -> int:
+    '''Humidity sensors reporting at 10 Hz while the bathroom is in use, with the rule timers running.'''
+    rng = random.Random(1)
+    sensors = [fake._items[name] for name in HUM_SENSORS]
+    step = timedelta(milliseconds=100)
+    for n in range(events):
+        fake.scheduler.advance(step)
+        sensors[n % len(sensors)].post_value(round(55 + 30 * rng.random(), 1))
+    return events
+
+def button_storm(events: int) -> int:
+    '''Someone keeps pushing the flatulence button, once a second.'''
+    button = fake._items['Flatulence_Button']
+    for n in range(events):
+        fake.scheduler.advance(timedelta(milliseconds=500))
+        button.post_value('ON' if n % 2 == 0 else 'OFF')
+    return events
+
+def simulated_days(events: int) -> int:
+    '''Runs the virtual clock through whole days so that the time of day and polling rules fire on their timers.'''
+    days = max(1, events // 1000)
+    fired = sum(len(durations) for durations in fake.callback_durations.values())
+    fake.scheduler.advance(timedelta(days=days))
+    return sum(len(durations) for durations in fake.callback_durations.values()) - fired
+
+CAMERAS = 32 # Cameras on the fake camera server
+FAILING_CAMERA = 'cam-3' # The camera that answers with an error
+
+def camera_switch(events: int) -> int:
+    '''
+    Alternates the profile of CAMERAS cameras on a local fake camera server between day, night and armed,
+    asking for every profile twice so that half of the switches find the cameras already switched. Some
+    cameras are known to have the day profile from the start, and FAILING_CAMERA answers with an error.
+    Each switch is checked against the server with check_switch().
+    The switch latencies are reported as the callback CameraSwitcher.switch_profile.
+    '''
+    from fake_camera import FakeCameraServer, LocalCameraSwitcher, check_switch, fake_cameras
+    surveillance = fake_cameras(CAMERAS)
+    server = FakeCameraServer(surveillance.cam_user, surveillance.cam_login, failing=[FAILING_CAMERA])
+    switcher = LocalCameraSwitcher(server, surveillance)
+    known = {cam.hostname: cam.last_profile for cam in surveillance.profile_cams if cam.last_profile}
+    profiles = ('day', 'day', 'night', 'night', 'night_armed', 'night_armed')
+    switches = max(1, events // CAMERAS)
+    latencies = fake.callback_durations['CameraSwitcher.switch_profile']
+    for n in range(switches):
+        profile = profiles[n % len(profiles)]
+        requests_before = server.requests.copy()
+        report = switcher.switch_profile(profile).result()
+        latencies.append(report.elapsed_secs)
+        check_switch(server, surveillance, report, requests_before, [host for host, known_profile in known.items() if known_profile == profile])
+        known.update({cam.hostname: profile for cam in surveillance.profile_cams if cam.hostname not in server.failing})
+    server.shutdown()
+    server.server_close()
+    fake.outbound.update({f'camera_{what}': count for what, count in server.counts.items()})
+    return switches * CAMERAS
+
+AREAS = 500         # Areas in the area trigger scenario
+AREAS_PER_DOOR = 10 # Areas that share a door contact
+
+def area_storm(events: int) -> int:
+    '''
+    Motion sensors of AREAS areas going on and off at random, with the lux changing every 20th event and the
+    lighting mode every 500th, through an area trigger engine of its own. The areas acted on are counted
+    as the outbound area_evaluated.
+    '''
+    from myareatriggers import AreaTriggerEngine
+    from myconfig import AreaConfig, AreaLevels, config
+    rng = random.Random(3)
+    levels = AreaLevels(30, 100, 60, 50.0)
+    areas = []
+    for n in range(AREAS):
+        fake.create_item(fake.SwitchItem, f'Bench_Area_{n}', 'OFF')
+        for sensor in range(2):
+            fake.create_item(fake.SwitchItem, f'Bench_Motion_{n}_{sensor}', 'OFF')
+        fake.create_item(fake.ContactItem, f'Bench_Door_{n // AREAS_PER_DOOR}', 'CLOSED')
+        fake.create_item(fake.DimmerItem, f'Bench_Dimmer_{n}', 0)
+        fake.create_item(fake.ColorItem, f'Bench_Color_{n}', (0, 0, 0))
+        areas.append(AreaConfig(
+            f'Bench_Area_{n}', (f'Bench_Motion_{n}_0', f'Bench_Motion_{n}_1', f'Bench_Door_{n // AREAS_PER_DOOR}'),
+            (f'Bench_Dimmer_{n}', f'Bench_Color_{n}'), (), levels._replace(low_lux_trigger=float(rng.randrange(10, 200))),
+            {'Natt': levels._replace(brightness=10)}, ('generic_light_action', 'generic_action_function')))
+    fake.create_item(fake.NumberItem, 'Bench_Lux', 100)
+    fake.create_item(fake.StringItem, 'Bench_Mode', 'Dag')
+    area_triggers = config.area_triggers._replace(lux_item_name='Bench_Lux', lighting_mode_item_name='Bench_Mode',
+                                                  mode_or_lux_change_item_name='Bench_Area_Reevaluate', areas=tuple(areas))
+
+    class BenchAreaTriggers(fake.Rule):
+        pass
+
+    engine = AreaTriggerEngine(area_triggers)
+    engine.attach(BenchAreaTriggers())
+    evaluated = engine.evaluated
+    for n in range(events):
+        fake.scheduler.advance(timedelta(milliseconds=200))
+        if n % 500 == 499:
+            fake._items['Bench_Mode'].post_value('Natt' if n % 1000 == 499 else 'Dag')
+        elif n % 20 == 19:
+            fake._items['Bench_Lux'].post_value(rng.randrange(0, 250))
+        elif n % 10 == 9:
+            door = fake._items[f'Bench_Door_{rng.randrange(AREAS // AREAS_PER_DOOR)}']
+            door.post_value('CLOSED' if door.value == 'OPEN' else 'OPEN')
+        else:
+            sensor = fake._items[f'Bench_Motion_{rng.randrange(AREAS)}_{rng.randrange(2)}']
+            sensor.post_value('OFF' if sensor.value == 'ON' else 'ON')
+    fake.outbound['area_evaluated'] += engine.evaluated - evaluated
+    return events
+
+def light_noise(events: int) -> int:
+    '''
+    The light sensors reporting every 5 seconds through an evening, with the lux drifting down past the
+    SHADY and DARK edges and noise of up to 40 % on Pws_Light and 10 % on Node7_Light. Counted as outbound:
+    light_level_posted, the level changes posted, light_level_per_sample, the changes a band lookup of each
+    sample would have posted, and light_level_avoided, the changes of the smoothed lux's band that the
+    hysteresis and dwell time held back.
+    '''
+    from bisect import bisect_right
+    from myconfig import config
+    from mylightlevel import light_level_fusion
+    rng = random.Random(4)
+    sensors = [fake._items[name] for name in LIGHT_SENSORS]
+    edges = sorted(config.lighting.light_level_lux.values())
+    posted, avoided = light_level_fusion.posted, light_level_fusion.avoided_changes
+    band = None
+    for n in range(events):
+        fake.scheduler.advance(timedelta(seconds=5))
+        lux = 600 * 0.5 ** (n / (events / 8)) + 5 # Down from 600 lux, past 300 and 10 lux
+        noise = 0.4 if n % 2 == 0 else 0.1
+        sample = max(lux * (1 + rng.uniform(-noise, noise)), 0)
+        fake.outbound['light_level_per_sample'] += band is not None and bisect_right(edges, sample) != band
+        band = bisect_right(edges, sample)
+        sensors[n % 2].post_value(sample)
+    fake.outbound['light_level_posted'] += light_level_fusion.posted - posted
+    fake.outbound['light_level_avoided'] += light_level_fusion.avoided_changes - avoided
+    return events
+
+def log_overhead(events: int) -> int:
+    '''
+    The time a rule thread spends per log call, reported as the callbacks log ...: a disabled debug call with
+    an f-string and with arguments, an info call written to a file on the calling thread, and info calls
+    through a LogPipeline of its own, whose writer writes them to the same kind of file. The records the
+    pipeline dropped are counted as the outbound log_dropped.
+    '''
+    import tempfile
+    from mylogging import Fields, LogPipeline
+    disabled = logging.root.manager.disable
+    logging.disable(logging.NOTSET)
+    with tempfile.TemporaryDirectory() as directory:
+        direct = logging.getLogger('BenchDirect')
+        direct.addHandler(logging.FileHandler(os.path.join(directory, 'direct.log')))
+        queued_parent = logging.getLogger('BenchQueued')
+        queued_parent.addHandler(logging.FileHandler(os.path.join(directory, 'queued.log')))
+        queued = logging.getLogger('BenchQueued.Rule')
+        for logger in (direct, queued_parent):
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        pipeline = LogPipeline('BenchQueued')
+        pipeline.install()
+        calls = {
+            'debug, disabled, f-string': lambda n: direct.debug(f'Current hum: {n}, Avg hum: {n // 2}, Target hum: {n + 5}'),
+            'debug, disabled, arguments': lambda n: direct.debug('Current hum: %s, Avg hum: %s, Target hum: %s', n, n // 2, n + 5),
+            'info, written on the calling thread': lambda n: direct.info('Current hum: %s, Avg hum: %s, Target hum: %s', n, n // 2, n + 5),
+            'info, queued': lambda n: queued.info('Current hum: %s, Avg hum: %s, Target hum: %s', n, n // 2, n + 5),
+            'info, queued, Fields': lambda n: queued.info(Fields('Humidity', current=n, average=n // 2, target=n + 5)),
+        }
+        for label, call in calls.items():
+            durations = fake.callback_durations[f'log {label}']
+            for n in range(events):
+                start = time.perf_counter()
+                call(n)
+                durations.append(time.perf_counter() - start)
+        pipeline.uninstall()
+        for logger in (direct, queued_parent):
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+                handler.close()
+    logging.disable(disabled)
+    fake.outbound['log_dropped'] += pipeline.dropped
+    return events * len(calls)
+
+def event_replay(events: int) -> int:
+    '''
+    Records a day of sensor events, spread evenly over it, with an EventLogWriter, and replays the log through
+    the rules with replay.py as fast as it can: noisy humidity and light sensors and an outdoor temperature
+    that follows the day in tenths of a degree.
+    '''
+    import math
+    import tempfile
+    from myeventlog import EventLogReader, EventLogWriter
+    from replay import replay
+    rng = random.Random(5)
+    sensors = [(name, 45, 15) for name in HUM_SENSORS] + [(name, 300, 250) for name in LIGHT_SENSORS] + [('Pws_Temp', 15, 0)]
+    day_ns = 24 * 3600 * 10**9
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.evlog')
+        writer = EventLogWriter(path, 1 << 30)
+        for n in range(events):
+            name, level, noise = sensors[n % len(sensors)]
+            value = level - 5 * math.cos(2 * math.pi * n / events) + rng.uniform(-noise, noise)
+            writer.append(name, round(value, 1), n * day_ns // events)
+        writer.close()
+        return replay(EventLogReader(path), fake.clock.now()).events
+
+LAMETRIC_CURL_MAX = 100 # Notifications sent through curl, which takes a while per notification
+
+def lametric_send(events: int) -> int:
+    '''
+    Notifications to a local HTTPS stand-in for the LaMetric device, through a curl subprocess per notification,
+    the way they were sent before, and through a LaMetricClient of its own. Reported as the callbacks
+    lametric curl (the caller waits for curl), lametric client, caller (queuing the notification),
+    lametric client, delivered (from queuing until the device accepted it) and its two parts, lametric client,
+    queue wait (until a sender thread took it) and lametric client, send (the request), and as the rates of
+    the two paths. The notifications are queued at once, so the delivered times are mostly queue wait.
+    '''
+    import json
+    import subprocess
+    from fake_lametric import FakeLaMetricServer
+    from mylametric import LAMETRIC_DEFAULT_DEADLINE, LaMetricClient
+
+    queue_wait = fake.callback_durations['lametric client, queue wait']
+    send = fake.callback_durations['lametric client, send']
+
+    class TimedLaMetricClient(LaMetricClient):
+        def _post(self, payload, deadline):
+            post_start = time.monotonic()
+            queue_wait.append(post_start - (deadline - LAMETRIC_DEFAULT_DEADLINE))
+            try:
+                return super()._post(payload, deadline)
+            finally:
+                send.append(time.monotonic() - post_start)
+
+    api_key = 'bench-key'
+    server = FakeLaMetricServer(api_key)
+    payload = {'priority': 'critical', 'icon_type': 'info', 'lifeTime': 120000, 'model': {'frames': [{'icon': 'i1', 'text': 'Tvättmaskinen är klar'}], 'cycles': 1}}
+
+    curl_durations = fake.callback_durations['lametric curl']
+    curl_count = min(events, LAMETRIC_CURL_MAX)
+    start = time.perf_counter()
+    for _ in range(curl_count):
+        call_start = time.perf_counter()
+        subprocess.run(['curl', '-X', 'POST', '-u', f'dev:{api_key}', '-H', 'Content-Type: application/json',
+                        '-d', json.dumps(payload), server.url, '--insecure'], capture_output=True)
+        curl_durations.append(time.perf_counter() - call_start)
+    rates['lametric curl'] = curl_count / (time.perf_counter() - start)
+
+    client = TimedLaMetricClient('127.0.0.1', server.port, api_key, queue_size=events)
+    caller = fake.callback_durations['lametric client, caller']
+    delivered = fake.callback_durations['lametric client, delivered']
+    futures = []
+    start = time.perf_counter()
+    for _ in range(events):
+        call_start = time.perf_counter()
+        future = client.send(payload)
+        caller.append(time.perf_counter() - call_start)
+        future.add_done_callback(lambda future, call_start=call_start: delivered.append(time.perf_counter() - call_start))
+        futures.append(future)
+    accepted = sum(future.result() for future in futures)
+    rates['lametric client'] = events / (time.perf_counter() - start)
+    client.session.close()
+    server.shutdown()
+    server.server_close()
+    fake.outbound.update({f'lametric_{what}': count for what, count in server.counts.items()})
+    fake.outbound['lametric_failed'] += events - accepted
+    return curl_count + events
+
+SMS_MESSAGES_MAX = 200          # Messages per path in the SMS scenario, each to SMS_SUBSCRIBERS
+SMS_SUBSCRIBERS = ('Default', 'Friendsname1', '46700000003')
+SMS_GATEWAY_DELAY_SECS = 0.005  # The round trip of a sendMessage call to the gateway
+SMS_BENCH_MERGE_WINDOW = 0.05   # Seconds the outbox waits for more recipients, shorter than in production
+
+class StubSmsGateway:
+    '''A stand-in for the Clickatell gateway that takes SMS_GATEWAY_DELAY_SECS per request and counts the requests and recipients.'''
+
+    def __init__(self, *args):
+        self.lock = threading.Lock()
+
+    def sendMessage(self, to, message, extra=None):
+        time.sleep(SMS_GATEWAY_DELAY_SECS)
+        with self.lock:
+            fake.outbound['sms_requests'] += 1
+            fake.outbound['sms_recipients'] += len(to)
+        return [{'id': str(n), 'destination': number, 'error': False} for n, number in enumerate(to)]
+
+def sms_broadcast(events: int) -> int:
+    '''
+    Messages to SMS_SUBSCRIBERS through a stub gateway, the way they were sent before, with a new client, a
+    character by character encoding and a blocking request per recipient, and through an SmsOutbox of its own,
+    which merges the recipients of a message into one request. Reported as the callbacks sms direct and
+    sms outbox, caller (the time the caller is held up per recipient) and sms outbox, delivered (from queuing
+    until the gateway accepted the message), and as the messages per second of the two paths.
+    '''
+    from myconfig import config
+    from mysms import SmsOutbox
+    messages = min(events, SMS_MESSAGES_MAX)
+    numbers = [config.clickatell.phonebook.get(subscriber, subscriber) for subscriber in SMS_SUBSCRIBERS]
+
+    direct = fake.callback_durations['sms direct']
+    start = time.perf_counter()
+    for n in range(messages):
+        for number in numbers:
+            call_start = time.perf_counter()
+            gateway = StubSmsGateway(config.clickatell.user, config.clickatell.password, config.clickatell.apiid)
+            unicode_message = ''.join(r'{:04X}'.format(ord(char)) for char in f'Larm i zon {n % 8}: rörelse i hallen')
+            gateway.sendMessage([number], unicode_message, extra={'from': config.clickatell.sender, 'unicode': 1})
+            direct.append(time.perf_counter() - call_start)
+    rates['sms direct'] = messages / (time.perf_counter() - start)
+
+    outbox = SmsOutbox(StubSmsGateway(), SMS_BENCH_MERGE_WINDOW)
+    caller = fake.callback_durations['sms outbox, caller']
+    delivered = fake.callback_durations['sms outbox, delivered']
+    futures = []
+    start = time.perf_counter()
+    for n in range(messages):
+        for number in numbers:
+            call_start = time.perf_counter()
+            future = outbox.send(f'Larm i zon {n % 8}: rörelse i hallen ({n})', number)
+            caller.append(time.perf_counter() - call_start)
+            future.add_done_callback(lambda future, call_start=call_start: delivered.append(time.perf_counter() - call_start))
+            futures.append(future)
+    fake.outbound['sms_failed'] += sum(not future.result() for future in futures)
+    rates['sms outbox'] = messages / (time.perf_counter() - start)
+    return 2 * messages * len(numbers)
+
+INFLUX_ITEMS = 10 # Items in the history scenario, each with a value a minute
+INFLUX_DAYS = 7   # Days of history read
+INFLUX_READS_PER_EVENTS = 200 # One read of all items per this many events
+
+def influx_history(events: int) -> int:
+    '''
+    Reads INFLUX_DAYS days of history of INFLUX_ITEMS items and aggregates it (count, mean, min, max, percentiles
+    and an hourly series) with one Flux query through an InfluxDBReader against a recorded-response InfluxDB
+    stand-in, and with a persistence call per item against the openHAB stand-in, parsed and aggregated the
+    same way. The two are checked to give the same aggregates. Reported as the callbacks influx bulk query and
+    persistence per item, per read of all items, and as the reads per second of the two paths.
+    '''
+    import numpy as np
+    import requests
+    from fake_influxdb import FakeInfluxServer, series_csv, utc_minutes
+    from myinfluxdb import InfluxDBReader, aggregate
+    rng = np.random.default_rng(6)
+    stop = fake.clock.now()
+    start = stop - timedelta(days=INFLUX_DAYS)
+    minutes = INFLUX_DAYS * 24 * 60
+    series = {f'Bench_Sensor_{n}': (utc_minutes(start, minutes), np.round(20 + 5 * rng.standard_normal(minutes), 2)) for n in range(INFLUX_ITEMS)}
+    names = list(series)
+    every = timedelta(hours=1)
+    server = FakeInfluxServer('bench-token', 'bench-org', series=series)
+    reader = InfluxDBReader(server.url, 'bench-token', 'bench-org', 'openhab')
+    server.recordings[reader.build_query(names, start, stop)] = series_csv(series)
+    reads = max(1, events // INFLUX_READS_PER_EVENTS)
+
+    bulk_durations = fake.callback_durations['influx bulk query']
+    for _ in range(reads):
+        read_start = time.perf_counter()
+        bulk = reader.read_aggregates(names, start, stop, every=every)
+        bulk_durations.append(time.perf_counter() - read_start)
+    rates['influx bulk query'] = reads / sum(bulk_durations)
+
+    session = requests.Session()
+    item_durations = fake.callback_durations['persistence per item']
+    for _ in range(reads):
+        read_start = time.perf_counter()
+        per_item = {}
+        for name in names:
+            response = session.get(f'{server.url}/rest/persistence/items/{name}', timeout=60,
+                                   params={'serviceId': 'influxdb', 'starttime': start.isoformat(), 'endtime': stop.isoformat()})
+            data = response.json()['data']
+            times = np.array([point['time'] for point in data], dtype='datetime64[ms]').astype('datetime64[s]')
+            values = np.array([float(point['state']) for point in data])
+            per_item[name] = aggregate(times, values, every=every)
+        item_durations.append(time.perf_counter() - read_start)
+    rates['persistence per item'] = reads / sum(item_durations)
+    session.close()
+
+    for name in names:
+        assert bulk[name].count == per_item[name].count == minutes, f'{name}: {bulk[name].count} and {per_item[name].count} values of {minutes}'
+        assert np.allclose(bulk[name].values, per_item[name].values) and bulk[name].percentiles == per_item[name].percentiles, f'{name} aggregates differ'
+    server.shutdown()
+    server.server_close()
+    fake.outbound.update({f'influx_{what}': count for what, count in server.counts.items() if what != 'bytes'})
+    fake.outbound['influx_kib'] += server.counts['bytes'] // 1024
+    return 2 * reads
+
+FORECAST_HOURS = 10 * 24 # An SMHI forecast: ten days, a value an hour
+
+def compass_direction_before(degrees):
+    # get_compass_direction as it was before the lookup tables, for comparison
+    COMPASS_DIRECTIONS = {
+        (0, 22.5): 'N',
+        (22.5, 67.5): 'NNO',
+        (67.5, 112.5): 'O',
+        (112.5, 157.5): 'OSO',
+        (157.5, 202.5): 'S',
+        (202.5, 247.5): 'SSO',
+        (247.5, 292.5): 'V',
+        (292.5, 337.5): 'VNV',
+        (337.5, 360): 'N'
+    }
+    for degree_range, direction in COMPASS_DIRECTIONS.items():
+        if degree_range[0] <= degrees < degree_range[1]:
+            return direction
+    return None
+
+def weather_forecast(events: int) -> int:
+    '''
+    Converts the wind directions, wind speeds and weather codes of ten day hourly forecasts to compass
+    directions, wind texts and weather texts. Reported as the callbacks, per forecast: weather compass, before
+    (the directions through the compass function as it was), weather compass, array, weather forecast,
+    scalar calls (all three, a value at a time) and weather forecast, arrays (all three, a call each). The
+    arrays are checked to give the same texts as the scalar calls.
+    '''
+    import numpy as np
+    from myweather import compass_direction, smhi_weather_text, wind_text
+    rng = np.random.default_rng(7)
+    forecasts = max(1, events // FORECAST_HOURS)
+    durations = {label: fake.callback_durations[f'weather {label}'] for label in ('compass, before', 'compass, array', 'forecast, scalar calls', 'forecast, arrays')}
+    for _ in range(forecasts):
+        directions = np.round(rng.uniform(0, 360, FORECAST_HOURS), 1)
+        speeds = np.round(rng.gamma(2.0, 3.0, FORECAST_HOURS), 1)
+        codes = rng.integers(1, 28, FORECAST_HOURS).astype(float) # As the forecast items hold them, e.g. 3.0
+        values = (directions.tolist(), speeds.tolist(), codes.tolist())
+
+        start = time.perf_counter()
+        before = [compass_direction_before(degrees) for degrees in values[0]]
+        durations['compass, before'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        compass_direction(directions)
+        durations['compass, array'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        scalar = ([compass_direction(degrees) for degrees in values[0]], [wind_text(speed) for speed in values[1]],
+                  [smhi_weather_text(code) for code in values[2]])
+        durations['forecast, scalar calls'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        arrays = (compass_direction(directions), wind_text(speeds), smhi_weather_text(codes))
+        durations['forecast, arrays'].append(time.perf_counter() - start)
+
+        assert before == scalar[0], 'The compass directions differ from the compass function as it was'
+        for scalar_texts, array_texts in zip(scalar, arrays):
+            assert scalar_texts == array_texts.tolist(), 'The array conversion differs from the scalar one'
+    return forecasts * FORECAST_HOURS
+
+MQTT_BROKER_DELAY_SECS = 0.0001 # The time a publish takes to hand a message to the broker connection
+MQTT_STATE_TOPIC = 'bench/power' # The one coalesced topic of the MQTT scenario
+MQTT_ROOMS = ('Kitchen', 'Vardagsrummet', 'TV-Rummet')
+
+def mqtt_publish(events: int) -> int:
+    '''
+    Publishes Sonos speak commands to three rooms and, every other message, a power reading to a state topic,
+    to a stand-in for the broker that takes MQTT_BROKER_DELAY_SECS per message. The messages are published
+    the way mqtt_pub did before, encoding the JSON, looking up the MQTT item and publishing on the calling thread,
+    and through an MqttPublisher of its own that coalesces the state topic and encodes the payloads in its
+    batches. The MQTT item of one room is removed halfway. Reported as the callbacks mqtt direct and mqtt
+    publisher, caller, as the messages per second of the two paths, and as the messages and batches the broker
+    got. The publisher is checked to keep the commands of each room in order and to end with the last state.
+    '''
+    import json
+    from mymqtt import MqttPublisher
+    received = []
+    lock = threading.Lock()
+
+    def broker_publish(item, payload, qos=None, retain=None):
+        time.sleep(MQTT_BROKER_DELAY_SECS)
+        with lock:
+            received.append((item.name, payload))
+        return True
+
+    messages = [(MQTT_STATE_TOPIC, {'power': n}) if n % 2 else (f'sonos/set/{MQTT_ROOMS[n % 3]}/speak', {'text': f'Meddelande {n}'})
+                for n in range(events)]
+    original_publish = fake.MqttItem.publish
+    fake.MqttItem.publish = broker_publish
+    try:
+        direct = fake.callback_durations['mqtt direct']
+        start = time.perf_counter()
+        for topic, payload in messages:
+            call_start = time.perf_counter()
+            fake.MqttItem.get_create_item(topic).publish(json.dumps(payload))
+            direct.append(time.perf_counter() - call_start)
+        rates['mqtt direct'] = events / (time.perf_counter() - start)
+        fake.outbound['mqtt_broker_direct'] += len(received)
+        received.clear()
+
+        publisher = MqttPublisher([MQTT_STATE_TOPIC])
+        caller = fake.callback_durations['mqtt publisher, caller']
+        start = time.perf_counter()
+        for n, (topic, payload) in enumerate(messages):
+            if n == events // 2:
+                fake.ItemRegistry.pop_item(f'sonos/set/{MQTT_ROOMS[0]}/speak')
+            call_start = time.perf_counter()
+            publisher.publish(topic, payload)
+            caller.append(time.perf_counter() - call_start)
+        while publisher.published + publisher.coalesced < events:
+            time.sleep(0.001)
+        rates['mqtt publisher'] = events / (time.perf_counter() - start)
+        fake.outbound['mqtt_broker_publisher'] += len(received)
+        fake.outbound['mqtt_publisher_batches'] += publisher.batches
+    finally:
+        fake.MqttItem.publish = original_publish
+
+    for room in MQTT_ROOMS:
+        topic = f'sonos/set/{room}/speak'
+        assert [json.loads(payload) for name, payload in received if name == topic] == [payload for name, payload in messages if name == topic], \
+            f'The commands to {topic} were lost or reordered'
+    states = [json.loads(payload) for name, payload in received if name == MQTT_STATE_TOPIC]
+    assert not states or states[-1] == messages[-1 if events % 2 == 0 else -2][1], 'The last state was not published last'
+    return 2 * events
+
+SCENARIOS: Dict[str, Callable[[int], int]] = {
+    'humidity_storm': humidity_storm,
+    'button_storm': button_storm,
+    'simulated_days': simulated_days,
+    'camera_switch': camera_switch,
+    'area_storm': area_storm,
+    'light_noise': light_noise,
+    'log_overhead': log_overhead,
+    'event_replay': event_replay,
+    'lametric_send': lametric_send,
+    'sms_broadcast': sms_broadcast,
+    'influx_history': influx_history,
+    'weather_forecast': weather_forecast,
+    'mqtt_publish': mqtt_publish,
+}
+
+# ----------------------------------------------------------------------------------------------------------
+# Running and reporting
+# ----------------------------------------------------------------------------------------------------------
+def run_scenario(name: str, events: int) -> ScenarioResult:
+    scenario = SCENARIOS[name]
+    fake.callback_durations.clear()
+    rates.clear()
+    outbound_before = fake.outbound.copy()
+
+    gc.collect()
+    start = time.perf_counter()
+    handled = scenario(events)
+    wall_secs = time.perf_counter() - start
+    time.sleep(SETTLE_SECS)
+    outbound = fake.outbound - outbound_before
+    durations = {callback: list(values) for callback, values in fake.callback_durations.items()}
+    measured_rates = dict(rates)
+
+    # A second, traced run for the allocations, so that tracing doesn't distort the latencies
+    tracemalloc.start()
+    scenario(events)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fake.callback_durations.clear()
+    fake.callback_durations.update(durations)
+    return ScenarioResult(name, handled, wall_secs, outbound, current / 1024, peak / 1024, measured_rates)
+
+def report_callbacks(events: int, outbound: Counter):
+    print(f'   {"callback":<44}{"calls":>8}{"p50 µs":>10}{"p95 µs":>10}{"p99 µs":>10}{"max µs":>10}')
+    for callback, values in sorted(fake.callback_durations.items(), key=lambda entry: -sum(entry[1])):
+        values = sorted(values)
+        print(f'   {callback:<44}{len(values):>8}' + ''.join(
+            f'{percentile(values, fraction) * 1e6:>10.1f}' for fraction in (0.5, 0.95, 0.99, 1.0)))
+    per_event = ', '.join(f'{kind} {count / events:.3f}' for kind, count in sorted(outbound.items()) if events)
+    print(f'   outbound per event: {per_event or "none"}')
+
+def report(result: ScenarioResult):
+    print(f'\n== {result.name}: {result.events} events in {result.wall_secs:.3f} s '
+          f'({result.events / result.wall_secs if result.wall_secs else 0:,.0f} events/s), '
+          f'allocated {result.allocated_kib:,.1f} KiB (peak {result.peak_kib:,.1f} KiB)')
+    report_callbacks(result.events, result.outbound)
+    if result.rates:
+        print('   rates: ' + ', '.join(f'{path} {rate:,.0f}/s' for path, rate in result.rates.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help=f'Scenarios to run: {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('-n', '--events', type=int, default=2000, help='Events per scenario (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the log output of the rules')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'Unknown scenario: {name}')
+    logging.basicConfig(level=logging.INFO)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    create_items()
+    load_start = time.perf_counter()
+    fake.load_rules()
+    print(f'Loaded {len(fake.rules)} rules in {(time.perf_counter() - load_start) * 1000:.1f} ms')
+    fake.scheduler.advance(timedelta(seconds=1)) # Run the startup jobs
+
+    for name in args.scenarios or SCENARIOS:
+        report(run_scenario(name, args.events))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from HABApp import Rule
+from HABApp.core.errors import ItemNotFoundException
+from HABApp.core.events import ValueChangeEventFilter, ValueUpdateEventFilter
+from HABApp.core.items import Item
+from HABApp.openhab.items import ColorItem, DimmerItem, SwitchItem
+from myconfig import AreaLevels, AreaTriggersConfig, ConfigError, config
+
+log = logging.getLogger(f'{config.system.logger_name}.myareatriggers')
+log.setLevel(logging.INFO)
+
+ACTIVE_STATES = ('ON', 'OPEN') # Trigger item values that make an area active
+
+class AreaContext(NamedTuple):
+    '''What an action function gets to know besides the area and whether it's active.'''
+    lux: Optional[float]
+    mode: Optional[str]
+    dark: bool          # The lux is below the low lux trigger of the area
+    levels: AreaLevels  # The levels of the area in the current lighting mode
+    manual_dimmer_lock_level: int
+
+ActionFunction = Callable[['Area', bool, AreaContext], None]
+ACTION_FUNCTIONS: Dict[str, ActionFunction] = {}
+
+def action_function(function: ActionFunction) -> ActionFunction:
+    '''Makes the function available to the areas by its name.'''
+    ACTION_FUNCTIONS[function.__name__] = function
+    return function
+
+def _light_target(item: Item, levels: AreaLevels, on: bool) -> Any:
+    if not on:
+        return 0 if isinstance(item, DimmerItem) else 'OFF'
+    if isinstance(item, ColorItem):
+        return (levels.hue, levels.saturation, levels.brightness)
+    if isinstance(item, DimmerItem):
+        return levels.brightness
+    return 'ON'
+
+@action_function
+def generic_light_action(area: 'Area', active: bool, context: AreaContext):
+    '''Turns the lights of the area on at its levels while it's active and dark, and off when it's not active.'''
+    for light in area.lights:
+        if not active and isinstance(light, DimmerItem) and 0 <= context.manual_dimmer_lock_level <= (light.value or 0) \
+                and (light.value or 0) > context.levels.brightness:
+            continue # Turned up by hand, so it's left on
+        if active and not context.dark:
+            continue # Lights that are on stay on until the area is no longer active
+        target = _light_target(light, context.levels, active)
+        current = tuple(light.value) if isinstance(light.value, (list, tuple)) else light.value
+        if current != target:
+            light.oh_send_command(','.join(str(part) for part in target) if isinstance(target, tuple) else target)
+
+@action_function
+def generic_action_function(area: 'Area', active: bool, context: AreaContext):
+    '''Switches the action items of the area, e.g. fans, on while it's active and off when it's not.'''
+    state = 'ON' if active else 'OFF'
+    for item in area.actions:
+        if item.value != state:
+            item.oh_send_command(state)
+
+class Area:
+    '''An area compiled for the engine: its items and action functions are resolved once, when it's loaded.'''
+    __slots__ = ('index', 'name', 'item', 'lights', 'actions', 'functions')
+
+    def __init__(self, index: int, name: str, item: Optional[SwitchItem], lights: Tuple[Item, ...], actions: Tuple[Item, ...],
+                 functions: Tuple[ActionFunction, ...]):
+        self.index = index
+        self.name = name
+        self.item = item
+        self.lights = lights
+        self.actions = actions
+        self.functions = functions
+
+def _resolve_items(names: Tuple[str, ...], area: str) -> Tuple[Item, ...]:
+    items = []
+    for name in names:
+        try:
+            items.append(Item.get_item(name))
+        except ItemNotFoundException:
+            log.error('The item [%s] of the area [%s] does not exist', name, area)
+    return tuple(items)
+
+class CompiledAreas:
+    '''
+    The areas as arrays for the engine:
+    - the inverted index from each trigger item to the indexes of the areas it triggers,
+    - the levels of each area per lighting mode, one row per mode with row 0 for modes without levels of their own.
+    Raises ConfigError for action functions that don't exist.
+    '''
+
+    def __init__(self, area_triggers: AreaTriggersConfig):
+        self.areas: List[Area] = []
+        self.index_of: Dict[str, int] = {}
+        triggers: Dict[str, List[int]] = {}
+        modes = sorted({mode for area in area_triggers.areas for mode in area.mode_levels})
+        self.mode_rows = {mode: row for row, mode in enumerate(modes, 1)}
+        levels = np.empty((len(modes) + 1, len(area_triggers.areas), len(AreaLevels._fields)))
+        for index, area in enumerate(area_triggers.areas):
+            unknown = [name for name in area.action_functions if name not in ACTION_FUNCTIONS]
+            if unknown:
+                raise ConfigError(f'[area_triggers.areas.{area.name}] has unknown action functions {unknown}')
+            try:
+                item = SwitchItem.get_item(area.name)
+            except ItemNotFoundException:
+                item = None
+            self.areas.append(Area(index, area.name, item, _resolve_items(area.lights, area.name), _resolve_items(area.actions, area.name),
+                                   tuple(ACTION_FUNCTIONS[name] for name in area.action_functions)))
+            self.index_of[area.name] = index
+            for trigger in dict.fromkeys(area.triggers):
+                triggers.setdefault(trigger, []).append(index)
+            levels[0, index] = area.levels
+            for mode, row in self.mode_rows.items():
+                levels[row, index] = area.mode_levels.get(mode, area.levels)
+        self.trigger_index = {trigger: np.array(indexes, dtype=np.intp) for trigger, indexes in triggers.items()}
+        self.levels = levels
+        self.low_lux_triggers = np.ascontiguousarray(levels[:, :, AreaLevels._fields.index('low_lux_trigger')])
+
+    def __len__(self) -> int:
+        return len(self.areas)
+
+    def levels_of(self, index: int, mode_row: int) -> AreaLevels:
+        hue, saturation, brightness, low_lux_trigger = self.levels[mode_row, index]
+        return AreaLevels(int(hue), int(saturation), int(brightness), float(low_lux_trigger))
+
+class AreaTriggerEngine:
+    '''
+    Runs the action functions of the areas whose state changed, and only those:
+    - a trigger item change looks up the areas it triggers in the inverted index and updates their count
+      of active triggers; the areas that became active or inactive are acted on,
+    - a lux or lighting mode change compares the lux with the low lux trigger of all areas in one
+      vectorized pass, and the active areas that became dark or light are acted on, as are the active
+      areas whose levels differ in the new mode,
+    - an update of the mode or lux change item acts on all active areas.
+    '''
+
+    def __init__(self, area_triggers: AreaTriggersConfig):
+        self._lock = threading.RLock()
+        self._rule: Optional[Rule] = None
+        self.evaluated = 0 # Areas acted on
+        self.compile(area_triggers)
+
+    def compile(self, area_triggers: AreaTriggersConfig):
+        compiled = CompiledAreas(area_triggers)
+        with self._lock:
+            self.area_triggers = area_triggers
+            self.compiled = compiled
+            self._trigger_active: Dict[str, bool] = {}
+            self._active_counts = np.zeros(len(compiled), dtype=np.int32)
+            self._active = np.zeros(len(compiled), dtype=bool)
+            self._dark = np.ones(len(compiled), dtype=bool)
+            self.lux: Optional[float] = None
+            self.mode: Optional[str] = None
+            self._mode_row = 0
+        log.info('Compiled %d areas with %d trigger items', len(compiled), len(compiled.trigger_index))
+
+    def on_config_changed(self, old: AreaTriggersConfig, new: AreaTriggersConfig):
+        try:
+            self.compile(new)
+        except ConfigError as e:
+            log.error('Keeping the previous areas: %s', e)
+            return
+        if self._rule is not None:
+            log.warning('The area trigger items are subscribed to when HABApp loads the rule, reload it to follow new trigger items')
+            self.refresh()
+
+    def attach(self, rule: Rule):
+        '''Subscribes to the trigger, lux and mode items through the given rule and reads their current values.'''
+        self._rule = rule
+        for trigger in self.compiled.trigger_index:
+            rule.listen_event(trigger, self._on_trigger_change, ValueChangeEventFilter())
+        for item_name, callback, event_filter in ((self.area_triggers.lux_item_name, self._on_lux_change, ValueChangeEventFilter()),
+                                                  (self.area_triggers.lighting_mode_item_name, self._on_mode_change, ValueChangeEventFilter()),
+                                                  (self.area_triggers.mode_or_lux_change_item_name, self._on_reevaluate, ValueUpdateEventFilter())):
+            if item_name: # Not configured without an area_triggers section
+                rule.listen_event(item_name, callback, event_filter)
+        self.refresh()
+
+    def refresh(self):
+        '''Reads all trigger, lux and mode items and acts on all areas.'''
+        with self._lock:
+            self._active_counts[:] = 0
+            for trigger, indexes in self.compiled.trigger_index.items():
+                try:
+                    active = Item.get_item(trigger).value in ACTIVE_STATES
+                except ItemNotFoundException:
+                    log.error('The trigger item [%s] does not exist', trigger)
+                    active = False
+                self._trigger_active[trigger] = active
+                self._active_counts[indexes] += active
+            self._active = self._active_counts > 0
+            self._set_mode(self._read(self.area_triggers.lighting_mode_item_name))
+            self.lux = self._read(self.area_triggers.lux_item_name)
+            self._dark = self._dark_areas()
+            self._act(np.arange(len(self.compiled)))
+
+    @staticmethod
+    def _read(item_name: str) -> Any:
+        try:
+            return Item.get_item(item_name).value
+        except ItemNotFoundException:
+            return None
+
+    def is_active(self, area_name: str) -> bool:
+        index = self.compiled.index_of.get(area_name)
+        return index is not None and bool(self._active[index])
+
+    def _set_mode(self, mode: Optional[str]):
+        self.mode = mode
+        self._mode_row = self.compiled.mode_rows.get(mode, 0)
+
+    def _dark_areas(self) -> np.ndarray:
+        if self.lux is None:
+            return np.ones(len(self.compiled), dtype=bool)
+        return self.lux < self.compiled.low_lux_triggers[self._mode_row]
+
+    def _on_trigger_change(self, event):
+        active = event.value in ACTIVE_STATES
+        with self._lock:
+            indexes = self.compiled.trigger_index.get(event.name)
+            if indexes is None:
+                return # No longer a trigger since a config reload, the listener stays until the rule is reloaded
+            if self._trigger_active.get(event.name, False) == active:
+                return
+            self._trigger_active[event.name] = active
+            self._active_counts[indexes] += 1 if active else -1
+            now_active = self._active_counts[indexes] > 0
+            changed = indexes[now_active != self._active[indexes]]
+            self._active[indexes] = now_active
+            self._act(changed)
+
+    def _on_lux_change(self, event):
+        with self._lock:
+            self.lux = event.value
+            dark = self._dark_areas()
+            changed = np.flatnonzero(self._active & (dark != self._dark))
+            self._dark = dark
+            self._act(changed)
+
+    def _on_mode_change(self, event):
+        with self._lock:
+            old_row = self._mode_row
+            self._set_mode(event.value)
+            dark = self._dark_areas()
+            levels_changed = (self.compiled.levels[self._mode_row] != self.compiled.levels[old_row]).any(axis=1)
+            changed = np.flatnonzero(self._active & ((dark != self._dark) | levels_changed))
+            self._dark = dark
+            self._act(changed)
+
+    def _on_reevaluate(self, event):
+        with self._lock:
+            self._dark = self._dark_areas()
+            self._act(np.flatnonzero(self._active))
+
+    def _act(self, indexes: np.ndarray):
+        # Called with the lock held
+        for index in indexes.tolist():
+            area = self.compiled.areas[index]
+            active = bool(self._active[index])
+            context = AreaContext(self.lux, self.mode, bool(self._dark[index]), self.compiled.levels_of(index, self._mode_row),
+                                  self.area_triggers.default_manual_dimmer_lock_level)
+            if area.item is not None:
+                state = 'ON' if active else 'OFF'
+                area.item.oh_post_update_if(state, not_equal=state)
+            for function in area.functions:
+                try:
+                    function(area, active, context)
+                except Exception:
+                    log.exception('The action function [%s] of the area [%s] failed', function.__name__, area.name)
+        self.evaluated += len(indexes)
+
+area_trigger_engine = AreaTriggerEngine(config.area_triggers)
+config.subscribe('area_triggers', area_trigger_engine.on_config_changed)
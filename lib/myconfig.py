@@ -0,0 +1,560 @@
+import logging
+import threading
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from HABApp import DictParameter
+
+class ConfigError(ValueError):
+    pass
+
+_MISSING = object()
+
+def _get(section: Mapping, key: str, expected_type, path: str, default: Any = _MISSING) -> Any:
+    if not isinstance(section, Mapping):
+        raise ConfigError(f'[{path}] should be a mapping')
+    if key not in section:
+        if default is _MISSING:
+            raise ConfigError(f'[{path}.{key}] is missing')
+        return default
+    value = section[key]
+    # YAML's true and false are bools, which are ints in Python, so they only pass where a bool is expected
+    expected_types = expected_type if isinstance(expected_type, tuple) else (expected_type,)
+    if not isinstance(value, expected_type) or (isinstance(value, bool) and bool not in expected_types):
+        raise ConfigError(f'[{path}.{key}] has the value {value!r}, expected {expected_type}')
+    return value
+
+def _frozen(mapping: Mapping) -> Mapping:
+    return MappingProxyType(dict(mapping))
+
+class SystemConfig(NamedTuple):
+    logger_name: str
+    local_time_zone: str
+    admin_email: str
+    metrics_file: str  # The Prometheus text file the rule metrics are written to, empty to not write it
+    metrics_item: str  # The openHAB string item that gets a summary of the rule metrics, empty to not post it
+
+class TimeOfDayConfig(NamedTuple):
+    solar: Tuple[str, ...]  # Gryning, Dag, Skymning, Natt
+    clock: Tuple[str, ...]  # Morgon, Dag, Kväll, Natt
+
+class LightingConfig(NamedTuple):
+    light_level: Mapping[str, int]
+    light_level_enabled: bool             # The LightLevel rule derives the light level from the light sensors
+    light_level_lux: Mapping[str, float]  # The lux each light level starts at
+    hysteresis: float                     # How far past a band edge, as a fraction of the edge, the lux has to go to change level
+    dwell_secs: int                       # How long a new level has to hold before it's posted
+
+class ItemNamesConfig(NamedTuple):
+    clock_time_of_day: str
+    solar_time_of_day: str
+    sys_light_level: str
+    light_sensors: Tuple[str, ...]
+    all: Mapping[str, Any]  # All custom item names by their key in the configuration file
+
+class LametricConfig(NamedTuple):
+    host: str
+    port: int
+    api_key: str
+    default_lifetime: int
+    default_notification_sound: str
+    default_icon: str
+
+class PushoverConfig(NamedTuple):
+    prio: Mapping[str, int]
+    default_device: str
+    user_token: str
+    api_token: str
+    workers: int
+    queue_size: int
+    overflow_policy: str
+
+class ClickatellConfig(NamedTuple):
+    sender: str
+    user: str
+    password: str
+    apiid: int
+    phonebook: Mapping[str, str]
+
+class TtsProfile(NamedTuple):
+    language: str
+    voice: Optional[str]
+    gender: str
+    engine: str
+
+DEFAULT_TTS_PROFILE = TtsProfile(language='sv-SE', voice='Elin', gender='female', engine='neural')
+
+class SonosConfig(NamedTuple):
+    tts_host: str
+    tts_cache_size: int
+    rooms: Mapping[str, TtsProfile]
+
+    @property
+    def generator_url(self) -> str:
+        return f'http://{self.tts_host}:5601/api/generate'
+
+    def profile(self, room: str) -> TtsProfile:
+        '''Returns the TTS profile of the room, or the default profile for rooms that aren't configured.'''
+        return self.rooms.get(room, DEFAULT_TTS_PROFILE)
+
+class InfluxDBConfig(NamedTuple):
+    url: str
+    token: str
+    org: str
+    bucket: str
+
+class MqttConfig(NamedTuple):
+    coalesced_topics: Tuple[str, ...] # State topics where only the latest waiting message is published, + and # are wildcards
+
+class WeatherConfig(NamedTuple):
+    wind_speed_limits: Tuple[float, ...]  # The upper limit (exclusive) of each wind class in m/s, ascending
+    wind_speed_names: Tuple[str, ...]
+    wind_texts: Tuple[str, ...]           # Description of each wind class
+    smhi_weather: Tuple[str, ...]         # Description of each SMHI weather symbol, indexed by the symbol code
+
+class EntsoeConfig(NamedTuple):
+    country_code: str
+    area: int                # The bidding zone within the country, e.g. 4 for SE4
+    api_key: str
+    api_time_tzinfo: str     # The time zone of the times in the API responses
+    arrive_time_hour: int    # Local time the day-ahead prices of tomorrow are normally published
+    arrive_time_minute: int
+    store_file: str          # The file the day-ahead prices are kept in between restarts
+
+ENERGY_SPENDING_LEVEL_NAMES = ('Spara', 'Normal', 'Slösa', 'Bränn')
+DEFAULT_ENERGY_SPENDING_LEVELS = {'Spara': -1, 'Normal': 0, 'Slösa': 1, 'Bränn': 2}
+PHASE_VOLTAGE = 230 # V
+
+class EnergyConfig(NamedTuple):
+    spending_levels: Mapping[str, int]        # The value of each energy spending level by its name
+    max_grid_feed_in_power: int               # W, 0 if there is no limit
+    block_electrical_addon_above_temp: float  # The heat pump's electrical addon may only run at or below this outdoor temperature
+    temp_forecast_item: str                   # Name of the hourly forecast temperature items, {hour} being the hours from now, empty to plan with the current temperature
+    temp_forecast_hours: int
+    ev_charger_max_current: int               # A per phase, the limits of the EV charger (OpenEVSE)
+    ev_charger_min_current: int
+    ev_charger_phases: int
+
+    @property
+    def ev_charger_max_kw(self) -> float:
+        return self.ev_charger_max_current * self.ev_charger_phases * PHASE_VOLTAGE / 1000
+
+    @property
+    def ev_charger_min_kw(self) -> float:
+        return self.ev_charger_min_current * self.ev_charger_phases * PHASE_VOLTAGE / 1000
+
+class WebCam(NamedTuple):
+    hostname: str
+    shortname: str
+    enabled: bool
+    outdoors: bool
+    use_sec_mask: bool     # The camera has privacy masks that follow the profile
+    switch_profiles: bool  # The camera follows the day/night and armed profiles
+    last_profile: str      # The profile the camera is known to have, empty if unknown
+
+class SurveillanceConfig(NamedTuple):
+    cam_domain: str
+    cam_user: str
+    cam_login: str
+    web_cams: Tuple[WebCam, ...]
+
+    @property
+    def profile_cams(self) -> Tuple[WebCam, ...]:
+        '''The enabled cameras that follow the profiles.'''
+        return tuple(cam for cam in self.web_cams if cam.enabled and cam.switch_profiles)
+
+class AreaLevels(NamedTuple):
+    hue: int
+    saturation: int
+    brightness: int
+    low_lux_trigger: float # The lights are only turned on when the lux is below this
+
+class AreaConfig(NamedTuple):
+    name: str                           # Also the name of the switch item that shows whether the area is active
+    triggers: Tuple[str, ...]           # Items that make the area active while any of them is ON or OPEN
+    lights: Tuple[str, ...]
+    actions: Tuple[str, ...]            # Switch items that follow the area, e.g. fans
+    levels: AreaLevels
+    mode_levels: Mapping[str, AreaLevels]  # The levels by the value of the lighting mode item, where they differ
+    action_functions: Tuple[str, ...]
+
+class AreaTriggersConfig(NamedTuple):
+    lux_item_name: str
+    mode_or_lux_change_item_name: str   # An update of this item re-evaluates all areas
+    lighting_mode_item_name: str
+    default_levels: AreaLevels
+    default_action_function: str
+    default_action_functions: Tuple[str, ...]
+    default_manual_dimmer_lock_level: int  # A dimmer set at or above this isn't turned off with its area, -1 to always turn off
+    areas: Tuple[AreaConfig, ...]
+
+DEFAULT_DEDUP_WINDOWS = {'sonos': 120, 'lametric': 300, 'pushover': 900}
+
+class NotificationDedupConfig(NamedTuple):
+    windows: Mapping[str, int]  # Seconds an identical message is suppressed after it was sent, per channel
+    max_entries: int            # Max number of messages remembered at a time
+
+class EventLogConfig(NamedTuple):
+    enabled: bool
+    file: str                   # Relative to the HABApp configuration folder; the interned names are kept in <file>.names
+    item_names: Tuple[str, ...] # Items recorded, all openHAB items if empty
+    max_mb: int                 # Recording stops when the log reaches this size
+
+class Config(NamedTuple):
+    system: SystemConfig
+    time_of_day: TimeOfDayConfig
+    lighting: LightingConfig
+    item_names: ItemNamesConfig
+    lametric: LametricConfig
+    pushover: PushoverConfig
+    clickatell: ClickatellConfig
+    sonos: SonosConfig
+    influxdb: InfluxDBConfig
+    mqtt: MqttConfig
+    weather: WeatherConfig
+    notification_dedup: NotificationDedupConfig
+    entsoe: EntsoeConfig
+    energy: EnergyConfig
+    surveillance: SurveillanceConfig
+    area_triggers: AreaTriggersConfig
+    event_log: EventLogConfig
+
+def _parse_room(room: Mapping, path: str) -> TtsProfile:
+    return TtsProfile(
+        language=_get(room, 'tts_lang', str, path, DEFAULT_TTS_PROFILE.language),
+        voice=_get(room, 'tts_voice', str, path, DEFAULT_TTS_PROFILE.voice),
+        gender=_get(room, 'tts_gender', str, path, DEFAULT_TTS_PROFILE.gender),
+        engine=_get(room, 'tts_engine', str, path, DEFAULT_TTS_PROFILE.engine)
+    )
+
+def _parse_web_cam(cam: Mapping, path: str) -> WebCam:
+    return WebCam(
+        hostname=_get(cam, 'hostname', str, path),
+        shortname=_get(cam, 'shortname', str, path),
+        enabled=_get(cam, 'enabled', bool, path, True),
+        outdoors=_get(cam, 'outDoors', bool, path, False),
+        use_sec_mask=_get(cam, 'useSecMask', bool, path, False),
+        switch_profiles=_get(cam, 'switchProfiles', bool, path, False),
+        last_profile=_get(cam, 'lastProfile', str, path, '')
+    )
+
+def _parse_levels(levels: Mapping, path: str, defaults: AreaLevels) -> AreaLevels:
+    return AreaLevels(
+        hue=_get(levels, 'hue', int, path, defaults.hue),
+        saturation=_get(levels, 'saturation', int, path, defaults.saturation),
+        brightness=_get(levels, 'brightness', int, path, defaults.brightness),
+        low_lux_trigger=float(_get(levels, 'low_lux_trigger', (int, float), path, defaults.low_lux_trigger))
+    )
+
+def _parse_area(name: str, area: Mapping, path: str, default_levels: AreaLevels, default_functions: Tuple[str, ...]) -> AreaConfig:
+    levels_section = _get(area, 'levels', Mapping, path, {})
+    levels = _parse_levels(levels_section, f'{path}.levels', default_levels)
+    modes = _get(levels_section, 'modes', Mapping, f'{path}.levels', {})
+    return AreaConfig(
+        name=name,
+        triggers=tuple(_get(area, 'triggers', list, path)),
+        lights=tuple(_get(area, 'lights', list, path, [])),
+        actions=tuple(_get(area, 'actions', list, path, [])),
+        levels=levels,
+        mode_levels=_frozen({mode: _parse_levels(mode_levels, f'{path}.levels.modes.{mode}', levels) for mode, mode_levels in modes.items()}),
+        action_functions=tuple(_get(area, 'action_functions', list, path, list(default_functions)))
+    )
+
+def parse_config(configuration: Mapping, lighting_configuration: Mapping) -> Config:
+    '''
+    Validates the raw configuration and compiles it into typed, immutable sections. Raises ConfigError.
+    The sections only read by the optional features (entsoe, energy, surveillance, area_triggers, weather,
+    influxdb, mqtt, light_level, notification_dedup and event_log) may be left out, which leaves the feature idle.
+    '''
+    system = _get(configuration, 'system', Mapping, 'configuration')
+    time_of_day = _get(configuration, 'time_of_day', Mapping, 'configuration')
+    lighting = _get(lighting_configuration, 'lighting', Mapping, 'lighting_config')
+    item_names = _get(configuration, 'custom_item_names', Mapping, 'configuration')
+    lametric = _get(configuration, 'lametric', Mapping, 'configuration')
+    pushover = _get(configuration, 'pushover', Mapping, 'configuration')
+    clickatell = _get(configuration, 'clickatell', Mapping, 'configuration')
+    sonos = _get(configuration, 'sonos', Mapping, 'configuration')
+    influxdb = _get(configuration, 'influxdb', Mapping, 'configuration', {})
+    mqtt = _get(configuration, 'mqtt', Mapping, 'configuration', {})
+    light_level_section = _get(configuration, 'light_level', Mapping, 'configuration', {})
+    weather = _get(configuration, 'weather', Mapping, 'configuration', {})
+    notification_dedup = _get(configuration, 'notification_dedup', Mapping, 'configuration', {})
+    entsoe = _get(configuration, 'entsoe', Mapping, 'configuration', {})
+    energy = _get(configuration, 'energy', Mapping, 'configuration', {})
+    surveillance = _get(configuration, 'surveillance', Mapping, 'configuration', {})
+    area_triggers = _get(configuration, 'area_triggers', Mapping, 'configuration', {})
+    event_log = _get(configuration, 'event_log', Mapping, 'configuration', {})
+
+    solar = tuple(_get(time_of_day, 'SOLAR_TIME_OF_DAY', list, 'time_of_day'))
+    clock = tuple(_get(time_of_day, 'CLOCK_TIME_OF_DAY', list, 'time_of_day'))
+    if len(solar) != 4 or len(clock) != 4:
+        raise ConfigError('[time_of_day.SOLAR_TIME_OF_DAY] and [time_of_day.CLOCK_TIME_OF_DAY] should have four periods each')
+    light_level = _get(lighting, 'LIGHT_LEVEL', Mapping, 'lighting')
+    for level in ('BRIGHT', 'SHADY', 'DARK', 'BLACK'):
+        _get(light_level, level, (int, float), 'lighting.LIGHT_LEVEL')
+    light_level_enabled = _get(light_level_section, 'ENABLED', bool, 'light_level', False)
+    light_level_lux = _get(light_level_section, 'LUX', Mapping, 'light_level') if light_level_enabled else \
+        _get(light_level_section, 'LUX', Mapping, 'light_level', {})
+    for level in light_level_lux:
+        if level not in light_level:
+            raise ConfigError(f'[light_level.LUX.{level}] is not one of the levels of [lighting.LIGHT_LEVEL]')
+        _get(light_level_lux, level, (int, float), 'light_level.LUX')
+    rooms = _get(sonos, 'rooms', Mapping, 'sonos', {})
+    wind_speeds = sorted(_get(weather, 'WIND_SPEEDS', Mapping, 'weather', {}).items(), key=lambda entry: entry[1])
+    wind_texts = _get(weather, 'WIND_TEXTS', Mapping, 'weather', {})
+    if sorted(wind_texts) != list(range(len(wind_speeds))):
+        raise ConfigError('[weather.WIND_TEXTS] should have one text per wind speed, numbered from 0')
+    spending_levels = _get(energy, 'ENERGY_SPENDING_LEVELS', Mapping, 'energy', DEFAULT_ENERGY_SPENDING_LEVELS)
+    for level in ENERGY_SPENDING_LEVEL_NAMES:
+        _get(spending_levels, level, int, 'energy.ENERGY_SPENDING_LEVELS')
+    default_levels = _parse_levels(_get(area_triggers, 'default_levels', Mapping, 'area_triggers', {}), 'area_triggers.default_levels',
+                                   AreaLevels(0, 0, 100, float('inf')))
+    default_action_function = _get(area_triggers, 'default_action_function', str, 'area_triggers', 'generic_light_action')
+    default_action_functions = tuple(_get(area_triggers, 'default_action_functions', list, 'area_triggers', []))
+    default_area_functions = tuple(dict.fromkeys((default_action_function,) + default_action_functions))
+    dedup_windows = _get(notification_dedup, 'WINDOWS', Mapping, 'notification_dedup', {})
+    for channel in dedup_windows:
+        _get(dedup_windows, channel, int, 'notification_dedup.WINDOWS')
+
+    return Config(
+        system=SystemConfig(
+            logger_name=_get(system, 'MY_LOGGER_NAME', str, 'system'),
+            local_time_zone=_get(system, 'LOCAL_TIME_ZONE', str, 'system'),
+            admin_email=_get(system, 'ADMIN_EMAIL', str, 'system', ''),
+            metrics_file=_get(system, 'METRICS_FILE', str, 'system', ''),
+            metrics_item=_get(system, 'METRICS_ITEM', str, 'system', 'Sys_Rule_Metrics')
+        ),
+        time_of_day=TimeOfDayConfig(solar=solar, clock=clock),
+        lighting=LightingConfig(
+            light_level=_frozen(light_level),
+            light_level_enabled=light_level_enabled,
+            light_level_lux=_frozen(light_level_lux),
+            hysteresis=float(_get(light_level_section, 'HYSTERESIS', (int, float), 'light_level', 0.2)),
+            dwell_secs=_get(light_level_section, 'DWELL_SECS', int, 'light_level', 120)
+        ),
+        item_names=ItemNamesConfig(
+            clock_time_of_day=_get(item_names, 'clock_time_of_day_item', str, 'custom_item_names'),
+            solar_time_of_day=_get(item_names, 'solar_time_of_day_item', str, 'custom_item_names'),
+            sys_light_level=_get(item_names, 'sysLightLevel', str, 'custom_item_names'),
+            light_sensors=tuple(_get(item_names, 'lightSensors', list, 'custom_item_names', [])),
+            all=_frozen(item_names)
+        ),
+        lametric=LametricConfig(
+            host=_get(lametric, 'HOST', str, 'lametric'),
+            port=_get(lametric, 'PORT', int, 'lametric'),
+            api_key=_get(lametric, 'API_KEY', str, 'lametric'),
+            default_lifetime=_get(lametric, 'DEFAULT_LIFETIME', int, 'lametric'),
+            default_notification_sound=_get(lametric, 'DEFAULT_NOTIFICATION_SOUND', str, 'lametric'),
+            default_icon=_get(lametric, 'DEFAULT_ICON', str, 'lametric')
+        ),
+        pushover=PushoverConfig(
+            prio=_frozen(_get(pushover, 'PUSHOVER_PRIO', Mapping, 'pushover')),
+            default_device=_get(pushover, 'PUSHOVER_DEF_DEV', str, 'pushover'),
+            user_token=_get(pushover, 'user_token', str, 'pushover'),
+            api_token=_get(pushover, 'api_token', str, 'pushover'),
+            workers=_get(pushover, 'WORKERS', int, 'pushover', 2),
+            queue_size=_get(pushover, 'QUEUE_SIZE', int, 'pushover', 20),
+            overflow_policy=_get(pushover, 'OVERFLOW_POLICY', str, 'pushover', 'merge')
+        ),
+        clickatell=ClickatellConfig(
+            sender=_get(clickatell, 'sender', str, 'clickatell'),
+            user=_get(clickatell, 'user', str, 'clickatell'),
+            password=_get(clickatell, 'password', str, 'clickatell'),
+            apiid=_get(clickatell, 'apiid', int, 'clickatell'),
+            phonebook=_frozen({name: str(number) for name, number in _get(clickatell, 'phonebook', Mapping, 'clickatell').items()})
+        ),
+        sonos=SonosConfig(
+            tts_host=_get(sonos, 'TTS_HOST', str, 'sonos'),
+            tts_cache_size=_get(sonos, 'TTS_CACHE_SIZE', int, 'sonos', 100),
+            rooms=_frozen({name: _parse_room(room, f'sonos.rooms.{name}') for name, room in rooms.items()})
+        ),
+        influxdb=InfluxDBConfig(
+            url=_get(influxdb, 'URL', str, 'influxdb', ''),
+            token=_get(influxdb, 'TOKEN', str, 'influxdb', ''),
+            org=_get(influxdb, 'ORG', str, 'influxdb', ''),
+            bucket=_get(influxdb, 'BUCKET', str, 'influxdb', '')
+        ),
+        mqtt=MqttConfig(
+            coalesced_topics=tuple(_get(mqtt, 'COALESCED_TOPICS', list, 'mqtt', []))
+        ),
+        weather=WeatherConfig(
+            wind_speed_limits=tuple(float(limit) for _, limit in wind_speeds),
+            wind_speed_names=tuple(name for name, _ in wind_speeds),
+            wind_texts=tuple(wind_texts[wind_class] for wind_class in range(len(wind_speeds))),
+            smhi_weather=tuple(_get(weather, 'SMHI_WEATHER', list, 'weather', []))
+        ),
+        notification_dedup=NotificationDedupConfig(
+            windows=_frozen({**DEFAULT_DEDUP_WINDOWS, **dedup_windows}),
+            max_entries=_get(notification_dedup, 'MAX_ENTRIES', int, 'notification_dedup', 1000)
+        ),
+        entsoe=EntsoeConfig(
+            country_code=_get(entsoe, 'COUNTRY_CODE', str, 'entsoe', ''),
+            area=_get(entsoe, 'AREA', int, 'entsoe', 0),
+            api_key=_get(entsoe, 'API_KEY', str, 'entsoe', ''),
+            api_time_tzinfo=_get(entsoe, 'API_TIME_TZINFO', str, 'entsoe', 'UTC'),
+            arrive_time_hour=_get(entsoe, 'DAY_AHEAD_PRICES_ARRIVE_TIME_HOUR', int, 'entsoe', 13),
+            arrive_time_minute=_get(entsoe, 'DAY_AHEAD_PRICES_ARRIVE_TIME_MINUTE', int, 'entsoe', 0),
+            store_file=_get(entsoe, 'STORE_FILE', str, 'entsoe', 'day_ahead_prices.npy')
+        ),
+        energy=EnergyConfig(
+            spending_levels=_frozen(spending_levels),
+            max_grid_feed_in_power=_get(energy, 'MAX_GRID_FEED_IN_POWER', int, 'energy', 0),
+            block_electrical_addon_above_temp=float(_get(energy, 'BLOCK_ELECTRICAL_ADDON_ABOVE_TEMP', (int, float), 'energy', float('inf'))),
+            temp_forecast_item=_get(energy, 'TEMP_FORECAST_ITEM', str, 'energy', ''),
+            temp_forecast_hours=_get(energy, 'TEMP_FORECAST_HOURS', int, 'energy', 24),
+            ev_charger_max_current=_get(energy, 'EV_CHARGER_MAX_CURRENT', int, 'energy', 32),
+            ev_charger_min_current=_get(energy, 'EV_CHARGER_MIN_CURRENT', int, 'energy', 6),
+            ev_charger_phases=_get(energy, 'EV_CHARGER_PHASES', int, 'energy', 1)
+        ),
+        surveillance=SurveillanceConfig(
+            cam_domain=_get(surveillance, 'CAM_DOMAIN', str, 'surveillance', ''),
+            cam_user=_get(surveillance, 'CAM_USER', str, 'surveillance', 'admin'),
+            cam_login=_get(surveillance, 'CAM_LOGIN', str, 'surveillance', ''),
+            web_cams=tuple(_parse_web_cam(cam, f'surveillance.WEB_CAMS.{n}')
+                           for n, cam in enumerate(_get(surveillance, 'WEB_CAMS', list, 'surveillance', [])))
+        ),
+        area_triggers=AreaTriggersConfig(
+            lux_item_name=_get(area_triggers, 'lux_item_name', str, 'area_triggers', ''),
+            mode_or_lux_change_item_name=_get(area_triggers, 'area_trigger_mode_or_lux_change_item_name', str, 'area_triggers', ''),
+            lighting_mode_item_name=_get(area_triggers, 'lighting_mode_item_name', str, 'area_triggers', ''),
+            default_levels=default_levels,
+            default_action_function=default_action_function,
+            default_action_functions=default_action_functions,
+            default_manual_dimmer_lock_level=_get(area_triggers, 'default_manual_dimmer_lock_level', int, 'area_triggers', -1),
+            areas=tuple(_parse_area(name, area, f'area_triggers.areas.{name}', default_levels, default_area_functions)
+                        for name, area in _get(area_triggers, 'areas', Mapping, 'area_triggers', {}).items())
+        ),
+        event_log=EventLogConfig(
+            enabled=_get(event_log, 'ENABLED', bool, 'event_log', False),
+            file=_get(event_log, 'FILE', str, 'event_log', 'events.evlog'),
+            item_names=tuple(_get(event_log, 'ITEMS', list, 'event_log', [])),
+            max_mb=_get(event_log, 'MAX_MB', int, 'event_log', 512)
+        )
+    )
+
+class ConfigLoader:
+    '''
+    Parses my_config.yml once into typed, immutable sections that all modules share.
+    Sections are read as attributes, e.g. config.sonos.profile('Vardagsrummet').
+    When the file is reloaded only the subscribers of the sections that changed are called,
+    with the old and the new section as arguments.
+    '''
+
+    def __init__(self):
+        self._configuration = DictParameter('my_config', 'configuration', default_value=None)
+        self._lighting_configuration = DictParameter('lighting_config', 'configuration', default_value=None)
+        self._subscribers: Dict[str, List[Callable[[Any, Any], None]]] = {}
+        self._lock = threading.Lock()
+        self._current = parse_config(self._configuration.value, self._lighting_configuration.value)
+
+    @property
+    def raw(self) -> Mapping:
+        '''The configuration as read from the file, for sections that have no typed counterpart.'''
+        return self._configuration.value
+
+    @property
+    def current(self) -> Config:
+        return self._current
+
+    @property
+    def system(self) -> SystemConfig:
+        return self._current.system
+
+    @property
+    def time_of_day(self) -> TimeOfDayConfig:
+        return self._current.time_of_day
+
+    @property
+    def lighting(self) -> LightingConfig:
+        return self._current.lighting
+
+    @property
+    def item_names(self) -> ItemNamesConfig:
+        return self._current.item_names
+
+    @property
+    def lametric(self) -> LametricConfig:
+        return self._current.lametric
+
+    @property
+    def pushover(self) -> PushoverConfig:
+        return self._current.pushover
+
+    @property
+    def clickatell(self) -> ClickatellConfig:
+        return self._current.clickatell
+
+    @property
+    def sonos(self) -> SonosConfig:
+        return self._current.sonos
+
+    @property
+    def influxdb(self) -> InfluxDBConfig:
+        return self._current.influxdb
+
+    @property
+    def mqtt(self) -> MqttConfig:
+        return self._current.mqtt
+
+    @property
+    def weather(self) -> WeatherConfig:
+        return self._current.weather
+
+    @property
+    def notification_dedup(self) -> NotificationDedupConfig:
+        return self._current.notification_dedup
+
+    @property
+    def entsoe(self) -> EntsoeConfig:
+        return self._current.entsoe
+
+    @property
+    def energy(self) -> EnergyConfig:
+        return self._current.energy
+
+    @property
+    def surveillance(self) -> SurveillanceConfig:
+        return self._current.surveillance
+
+    @property
+    def area_triggers(self) -> AreaTriggersConfig:
+        return self._current.area_triggers
+
+    @property
+    def event_log(self) -> EventLogConfig:
+        return self._current.event_log
+
+    def subscribe(self, section: str, callback: Callable[[Any, Any], None]):
+        '''Calls callback(old section, new section) when the section has changed after a reload.'''
+        if section not in Config._fields:
+            raise ConfigError(f'Unknown configuration section [{section}]')
+        with self._lock:
+            self._subscribers.setdefault(section, []).append(callback)
+
+    def reload(self) -> Tuple[str, ...]:
+        '''
+        Parses the configuration again and notifies the subscribers of the sections that changed.
+        An invalid configuration is logged and the previous one is kept. Returns the names of the changed sections.
+        '''
+        try:
+            new = parse_config(self._configuration.value, self._lighting_configuration.value)
+        except ConfigError as e:
+            log.error('Invalid configuration, keeping the previous one: %s', e)
+            return ()
+        with self._lock:
+            old, self._current = self._current, new
+            changed = tuple(section for section in Config._fields if getattr(old, section) != getattr(new, section))
+            callbacks = [(section, callback) for section in changed for callback in self._subscribers.get(section, ())]
+        if changed:
+            log.info('The configuration sections %s have changed', list(changed))
+        for section, callback in callbacks:
+            try:
+                callback(getattr(old, section), getattr(new, section))
+            except Exception:
+                log.exception('Failed to apply the changed configuration section [%s]', section)
+        return changed
+
+config = ConfigLoader()
+
+log = logging.getLogger(f'{config.system.logger_name}.myconfig')
+log.setLevel(logging.INFO)
@@ -0,0 +1,77 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from HABApp import Rule
+from HABApp.core.events import ValueChangeEventFilter
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.mydebounce')
+log.setLevel(logging.INFO)
+
+class DebouncedTrigger:
+    '''
+    Runs a callback of a rule once the value changes of the watched items have been quiet for the quiet period,
+    so a burst of changes leads to one run. A steady stream of changes doesn't hold the run back for longer
+    than max_delay_secs after the first change of the burst, since a deadline timer is started with the burst.
+    The watched items can be replaced, e.g. when the members of a group have changed.
+    The counters show the changes seen and the runs they led to.
+    '''
+
+    def __init__(self, rule: Rule, callback: Callable[[], None], item_names: Iterable[str], quiet_secs: float,
+                 max_delay_secs: Optional[float] = None):
+        self._callback = callback
+        self.quiet_secs = quiet_secs
+        self.max_delay_secs = max_delay_secs
+        self.changes = 0
+        self.runs = 0
+        self._burst_start: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._rule = rule
+        self._job = rule.run.countdown(quiet_secs, self._run)
+        self._deadline_job = rule.run.countdown(max_delay_secs, self._run) if max_delay_secs is not None else None
+        self._listeners: Dict[str, Any] = {} # The event listener of each watched item
+        self.item_names: Tuple[str, ...] = ()
+        self.set_item_names(item_names)
+
+    def set_item_names(self, item_names: Iterable[str]):
+        '''Watches the given items instead of the ones watched so far.'''
+        item_names = tuple(dict.fromkeys(item_names))
+        if item_names == self.item_names:
+            return
+        for item_name in set(self._listeners) - set(item_names):
+            self._listeners.pop(item_name).cancel()
+        for item_name in item_names:
+            if item_name not in self._listeners:
+                self._listeners[item_name] = self._rule.listen_event(item_name, self._on_change, ValueChangeEventFilter())
+        log.debug('%s watches %s', self._callback.__name__, item_names)
+        self.item_names = item_names
+
+    @property
+    def coalesced(self) -> int:
+        '''Changes that didn't lead to a run of their own.'''
+        return max(self.changes - self.runs, 0)
+
+    def _on_change(self, event):
+        now = datetime.now()
+        with self._lock:
+            self.changes += 1
+            if self._burst_start is None:
+                self._burst_start = now
+                if self._deadline_job is not None:
+                    self._deadline_job.reset()
+            self._job.reset()
+        log.debug('[%s] changed to [%s], running %s in %s s', event.name, event.value, self._callback.__name__, self.quiet_secs)
+
+    def _run(self):
+        # Run by the quiet timer or the deadline timer, whichever expires first
+        with self._lock:
+            if self._burst_start is None:
+                return
+            self._burst_start = None
+            self._job.stop()
+            if self._deadline_job is not None:
+                self._deadline_job.stop()
+            self.runs += 1
+        self._callback()
@@ -0,0 +1,176 @@
+import hashlib
+import heapq
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+
+from myconfig import NotificationDedupConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.mydedup')
+log.setLevel(logging.INFO)
+
+DEDUP_BUCKET_SECS = 10 # Resolution of the suppression windows; expired messages are handled a bucket at a time
+
+class _Suppressed:
+    '''
+    The result of a send that was skipped since a similar message was sent recently. It's falsy, so a caller
+    that tests the result of a send doesn't take it for a delivery; compare with `is SUPPRESSED` to tell it apart.
+    '''
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'SUPPRESSED'
+
+SUPPRESSED = _Suppressed()
+
+_NUMBER = re.compile(r'[-+]?\d+(?:[.,:]\d+)*')
+
+def fingerprint(message: Any, fold_numbers: bool = False) -> int:
+    '''
+    Returns a 64 bit fingerprint of the message that is the same for messages that only differ in letter case
+    or whitespace, e.g. "Dörr 1 öppen" and "dörr  1 Öppen". With fold_numbers, messages that only differ in
+    numbers have the same fingerprint too, e.g. "Temp 21.5 C" and "temp 22 C".
+    '''
+    text = str(message).casefold()
+    normalized = ' '.join((_NUMBER.sub('#', text) if fold_numbers else text).split())
+    return int.from_bytes(hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class _Entry:
+    __slots__ = ('channel', 'expires', 'bucket', 'suppressed', 'last_message', 'context')
+
+    def __init__(self, channel: str, expires: float, bucket: int, message: str, context: Any):
+        self.channel = channel
+        self.expires = expires
+        self.bucket = bucket
+        self.suppressed = 0
+        self.last_message = message
+        self.context = context
+
+class NotificationDeduplicator:
+    '''
+    Suppresses messages that are similar to one already sent on the same channel within the channel's window.
+    When the window of a message expires and similar messages were suppressed, a summary with the latest of
+    them and the number collapsed is sent through the summary sender of the channel, if it has one.
+    The messages are kept in buckets by the time their window expires, so expired messages are dropped a
+    bucket at a time, and at most max_entries messages are remembered: beyond that the buckets that expire
+    first are dropped early.
+    '''
+
+    def __init__(self, dedup: NotificationDedupConfig, bucket_secs: float = DEDUP_BUCKET_SECS):
+        self.windows = dedup.windows
+        self.max_entries = dedup.max_entries
+        self.bucket_secs = bucket_secs
+        self.admitted = 0
+        self.suppressed = 0
+        self.summaries = 0
+        self._entries: Dict[Tuple[str, int], _Entry] = {}
+        self._buckets: Dict[int, List[Tuple[str, int]]] = {} # Expiry bucket -> keys
+        self._bucket_heap: List[int] = []
+        self._summary_senders: Dict[str, Callable[[str, Any], Any]] = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._worker, name='NotificationDedup', daemon=True).start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'admitted': self.admitted, 'suppressed': self.suppressed, 'summaries': self.summaries}
+
+    def on_config_changed(self, old: NotificationDedupConfig, new: NotificationDedupConfig):
+        self.windows = new.windows
+        self.max_entries = new.max_entries
+
+    def register_summary_sender(self, channel: str, sender: Callable[[str, Any], Any]):
+        '''sender(summary text, context of the first message) sends a summary on the channel.'''
+        self._summary_senders[channel] = sender
+
+    def admit(self, channel: str, message: Any, context: Any = None, fold_numbers: bool = False) -> bool:
+        '''
+        Returns True if the message should be sent on the channel, False if a similar message was sent within the
+        channel's window. Channels without a window are never suppressed. context is kept for the summary sender.
+        Messages are similar if they only differ in letter case or whitespace, and with fold_numbers in numbers too.
+        '''
+        window = self.windows.get(channel, 0)
+        if window <= 0:
+            return True
+        key = (channel, fingerprint(message, fold_numbers))
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                entry.suppressed += 1
+                entry.last_message = str(message)
+                self.suppressed += 1
+                log.debug("Suppressed '%s' on [%s], %d similar so far", message, channel, entry.suppressed)
+                return False
+            if entry is not None:
+                # Expired but not dropped yet
+                expired.append(self._entries.pop(key))
+            bucket = int((now + window) // self.bucket_secs) + 1 # The bucket is done when all its windows have expired
+            self._entries[key] = _Entry(channel, now + window, bucket, str(message), context)
+            self._add_to_bucket(bucket, key)
+            if len(self._entries) > self.max_entries:
+                expired += self._drop_buckets(float('inf'), len(self._entries) - self.max_entries)
+            self.admitted += 1
+        self._send_summaries(expired)
+        return True
+
+    def _add_to_bucket(self, bucket: int, key: Tuple[str, int]):
+        keys = self._buckets.get(bucket)
+        if keys is None:
+            keys = self._buckets[bucket] = []
+            heapq.heappush(self._bucket_heap, bucket)
+        keys.append(key)
+
+    def _drop_buckets(self, now: float, at_least: int = 0) -> List[_Entry]:
+        '''Drops the buckets that have expired, and more if needed to drop at least the given number of entries.'''
+        dropped = []
+        while self._bucket_heap and (self._bucket_heap[0] * self.bucket_secs <= now or len(dropped) < at_least):
+            bucket = heapq.heappop(self._bucket_heap)
+            for key in self._buckets.pop(bucket):
+                entry = self._entries.get(key)
+                # The key may have been admitted again since, into a later bucket
+                if entry is not None and entry.bucket == bucket:
+                    dropped.append(self._entries.pop(key))
+        return dropped
+
+    def _send_summaries(self, entries: List[_Entry]):
+        for entry in entries:
+            if not entry.suppressed:
+                continue
+            sender = self._summary_senders.get(entry.channel)
+            if sender is None:
+                continue
+            summary = f'{entry.last_message} ({entry.suppressed} similar collapsed)'
+            self.summaries += 1
+            try:
+                sender(summary, entry.context)
+            except Exception:
+                log.exception('Failed to send the summary on [%s]', entry.channel)
+
+    def flush(self):
+        '''Drops the expired messages and sends their summaries.'''
+        with self._lock:
+            expired = self._drop_buckets(time.monotonic())
+        self._send_summaries(expired)
+
+    def _worker(self):
+        while True:
+            time.sleep(self.bucket_secs)
+            self.flush()
+
+def suppressed() -> Future:
+    '''A Future that has resolved to SUPPRESSED, for a send that admit() turned down.'''
+    future: Future = Future()
+    future.set_result(SUPPRESSED)
+    return future
+
+notification_dedup = NotificationDeduplicator(config.notification_dedup)
+config.subscribe('notification_dedup', notification_dedup.on_config_changed)
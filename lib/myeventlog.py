@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.myeventlog')
+log.setLevel(logging.INFO)
+
+EVENT_LOG_MAGIC = b'HABEVLOG'
+EVENT_LOG_VERSION = 1
+EVENT_LOG_HEADER_BYTES = 64   # The records start here
+EVENT_LOG_CHUNK = 1 << 16     # Records the file grows by at a time
+EVENT_LOG_READ_CHUNK = 1 << 16 # Records decoded at a time when reading
+
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4'), ('start_epoch', '<f8'), ('count', '<u8')])
+RECORD = np.dtype([('time', '<i8'), ('value', '<f8'), ('name', '<u4'), ('kind', 'u1'), ('_', 'V3')]) # 24 bytes
+
+# Kinds of value; the value of a string or tuple is the id of the interned string
+NONE, INTEGER, FLOAT, STRING, DATETIME, TUPLE = range(6)
+
+class Event(NamedTuple):
+    time_secs: float  # Since the start of the log
+    name: str
+    value: Any
+
+def _names_path(path: str) -> str:
+    return path + '.names'
+
+def _read_names(path: str) -> List[str]:
+    if not os.path.exists(_names_path(path)):
+        return []
+    with open(_names_path(path), encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.endswith('\n')] # A line cut off by a crash is left out
+
+def _drop_partial_name(path: str):
+    # A crash can leave the last interned string cut off, which would run into the next one
+    with open(_names_path(path), 'rb+') as file:
+        data = file.read()
+        if data and not data.endswith(b'\n'):
+            file.truncate(data.rfind(b'\n') + 1)
+
+class EventLogWriter:
+    '''
+    Appends item events to a compact binary log, memory mapped, for replaying them offline (see bench/replay.py).
+    A record is 24 bytes: the monotonic time in ns since the log was started, the item name and, for strings,
+    the value as ids of interned strings, the kind of value and the value. The interned strings are appended
+    to <path>.names, one JSON string per line, so that the log can be read while it's written. A new string is
+    written out before a record refers to it, and the count in the header only takes in the records at a flush,
+    so after a crash the log ends at the last flush and every id in it has its string.
+    A log that exists is appended to, with the time continuing from the wall clock time since it was started.
+    '''
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_records = (max_bytes - EVENT_LOG_HEADER_BYTES) // RECORD.itemsize
+        self.dropped = 0
+        self._lock = threading.Lock()
+        if os.path.exists(_names_path(path)):
+            _drop_partial_name(path)
+        self._ids: Dict[str, int] = {text: string_id for string_id, text in enumerate(_read_names(path))}
+        self._names_file = open(_names_path(path), 'a', encoding='utf-8')
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                header = np.zeros((), HEADER)
+                header['magic'], header['version'], header['record_size'] = EVENT_LOG_MAGIC, EVENT_LOG_VERSION, RECORD.itemsize
+                header['start_epoch'] = time.time()
+                file.write(header.tobytes().ljust(EVENT_LOG_HEADER_BYTES, b'\0'))
+        self._header = np.memmap(path, HEADER, 'r+', shape=(1,))
+        if bytes(self._header['magic'][0]) != EVENT_LOG_MAGIC or int(self._header['record_size'][0]) != RECORD.itemsize:
+            raise ValueError(f'{path} is not an event log of version {EVENT_LOG_VERSION}')
+        self.count = int(self._header['count'][0])
+        self._map(max(self.count, 1))
+        last_ns = int(self._records['time'][self.count - 1]) if self.count else 0
+        since_start_ns = int((time.time() - float(self._header['start_epoch'][0])) * 1e9)
+        self._base_ns = time.monotonic_ns() - max(since_start_ns, last_ns)
+
+    def _map(self, records: int):
+        capacity = -(-records // EVENT_LOG_CHUNK) * EVENT_LOG_CHUNK
+        size = EVENT_LOG_HEADER_BYTES + capacity * RECORD.itemsize
+        if os.path.getsize(self.path) < size:
+            os.truncate(self.path, size)
+        self._records = np.memmap(self.path, RECORD, 'r+', offset=EVENT_LOG_HEADER_BYTES, shape=(capacity,))
+
+    def _intern(self, text: str) -> int:
+        string_id = self._ids.get(text)
+        if string_id is None:
+            string_id = self._ids[text] = len(self._ids)
+            self._names_file.write(json.dumps(text) + '\n')
+            self._names_file.flush()
+        return string_id
+
+    def _encode(self, value: Any) -> Tuple[int, float]:
+        if value is None:
+            return NONE, 0.0
+        if isinstance(value, bool):
+            return STRING, self._intern('ON' if value else 'OFF')
+        if isinstance(value, int):
+            return INTEGER, float(value)
+        if isinstance(value, float):
+            return FLOAT, value
+        if isinstance(value, datetime):
+            return DATETIME, value.timestamp()
+        if isinstance(value, (tuple, list)):
+            return TUPLE, self._intern(json.dumps(list(value)))
+        return STRING, self._intern(str(value))
+
+    def append(self, name: str, value: Any, time_ns: Optional[int] = None):
+        '''Appends an event of the item. The time is in ns since the start of the log, by default now.'''
+        with self._lock:
+            if self.count >= self.max_records:
+                if not self.dropped:
+                    log.warning('The event log %s is full, the events are no longer recorded', self.path)
+                self.dropped += 1
+                return
+            if self.count >= len(self._records):
+                self._records.flush()
+                self._map(self.count + 1)
+            kind, encoded = self._encode(value)
+            time_ns = time.monotonic_ns() - self._base_ns if time_ns is None else time_ns
+            self._records[self.count] = (time_ns, encoded, self._intern(name), kind, b'')
+            self.count += 1
+
+    def flush(self):
+        '''Writes the interned strings, then the records, then the count that takes them in, so that a reader never finds an unknown id.'''
+        with self._lock:
+            self._names_file.flush()
+            os.fsync(self._names_file.fileno())
+            self._records.flush()
+            self._header['count'] = self.count
+            self._header.flush()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._names_file.close()
+
+class EventLogReader:
+    '''Reads an event log, in chunks of records from the memory map, so a long log doesn't have to fit in memory.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        header = np.fromfile(path, HEADER, count=1)[0]
+        if bytes(header['magic']) != EVENT_LOG_MAGIC or int(header['record_size']) != RECORD.itemsize:
+            raise ValueError(f'{path} is not an event log of version {EVENT_LOG_VERSION}')
+        self.start = datetime.fromtimestamp(float(header['start_epoch']))
+        self.names = _read_names(path)
+        count = int(header['count'])
+        self.records = np.memmap(path, RECORD, 'r', offset=EVENT_LOG_HEADER_BYTES, shape=(count,)) if count else np.empty(0, RECORD)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def duration_secs(self) -> float:
+        return float(self.records['time'][-1]) / 1e9 if len(self.records) else 0.0
+
+    def decode(self, kind: int, value: float) -> Any:
+        if kind == INTEGER:
+            return int(value)
+        if kind == FLOAT:
+            return value
+        if kind == STRING:
+            return self.names[int(value)]
+        if kind == DATETIME:
+            return datetime.fromtimestamp(value)
+        if kind == TUPLE:
+            return tuple(json.loads(self.names[int(value)]))
+        return None
+
+    def item_kinds(self) -> Dict[str, Tuple[int, ...]]:
+        '''The kinds of value each item has in the log.'''
+        kinds: Dict[str, set] = {}
+        for name, kind in np.unique(np.stack([self.records['name'], self.records['kind']], axis=1), axis=0).tolist():
+            kinds.setdefault(self.names[name], set()).add(kind)
+        return {name: tuple(sorted(item_kinds)) for name, item_kinds in kinds.items()}
+
+    def string_values(self, name: str) -> List[str]:
+        '''The distinct string values the item has in the log.'''
+        name_id = self.names.index(name)
+        values = self.records['value'][(self.records['name'] == name_id) & (self.records['kind'] == STRING)]
+        return [self.names[int(value)] for value in np.unique(values)]
+
+    def __iter__(self) -> Iterator[Event]:
+        for start in range(0, len(self.records), EVENT_LOG_READ_CHUNK):
+            chunk = self.records[start:start + EVENT_LOG_READ_CHUNK]
+            for time_ns, value, name, kind in zip(chunk['time'].tolist(), chunk['value'].tolist(), chunk['name'].tolist(), chunk['kind'].tolist()):
+                yield Event(time_ns / 1e9, self.names[name], self.decode(kind, value))
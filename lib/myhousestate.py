@@ -0,0 +1,135 @@
+import logging
+import threading
+from typing import NamedTuple, Optional
+
+from HABApp import Rule
+from HABApp.core.events import ValueChangeEvent, ValueChangeEventFilter
+from HABApp.openhab.items import NumberItem, StringItem
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.myhousestate')
+log.setLevel(logging.INFO)
+
+SPC_AREA_MODE = {'unset': 0, 'partset_a': 1, 'partset_b': 2, 'set': 3}
+SPC_AREA_ITEM_NAME = 'SPC_Area_1_Mode'
+
+class HouseSnapshot(NamedTuple):
+    '''An immutable view of the house state at one moment.'''
+    light_level: Optional[float] = None
+    clock_time_of_day: Optional[str] = None
+    solar_time_of_day: Optional[str] = None
+    spc_area_mode: Optional[str] = None
+    is_light_level_bright: bool = False
+    is_light_level_shady: bool = False
+    is_light_level_dark: bool = False
+    is_light_level_black: bool = False
+    is_clock_night: bool = False
+    is_solar_night: bool = False
+    spc_area_is_set: bool = False
+    spc_area_is_fully_set: bool = False
+    spc_area_is_partially_set: bool = False
+
+def _derive(light_level, clock_time_of_day, solar_time_of_day, spc_area_mode) -> HouseSnapshot:
+    LIGHT_LEVEL = config.lighting.light_level
+    spc_mode_level = SPC_AREA_MODE.get(spc_area_mode, 0) if spc_area_mode is not None else 0
+    return HouseSnapshot(
+        light_level=light_level,
+        clock_time_of_day=clock_time_of_day,
+        solar_time_of_day=solar_time_of_day,
+        spc_area_mode=spc_area_mode,
+        is_light_level_bright=light_level == LIGHT_LEVEL['BRIGHT'] if light_level is not None else False,
+        is_light_level_shady=light_level <= LIGHT_LEVEL['SHADY'] if light_level is not None else False,
+        is_light_level_dark=light_level <= LIGHT_LEVEL['DARK'] if light_level is not None else False,
+        is_light_level_black=light_level <= LIGHT_LEVEL['BLACK'] if light_level is not None else False,
+        is_clock_night=clock_time_of_day == config.time_of_day.clock[3],
+        is_solar_night=solar_time_of_day == config.time_of_day.solar[3],
+        spc_area_is_set=spc_mode_level > 0,
+        spc_area_is_fully_set=spc_mode_level == 3,
+        spc_area_is_partially_set=spc_mode_level == 1
+    )
+
+class HouseState:
+    '''
+    Keeps the state derived from a few frequently checked items up to date from their change events,
+    so that checks like "is it night" are plain attribute reads.
+    The state is held in an immutable HouseSnapshot that is replaced on every change, so a rule that needs
+    several values that are consistent with each other should read them from snapshot().
+    '''
+    __slots__ = ('_snapshot', '_lock', '_item_fields')
+
+    def __init__(self):
+        self._snapshot: Optional[HouseSnapshot] = None
+        self._lock = threading.Lock()
+        self._item_fields = {
+            config.item_names.sys_light_level: 'light_level',
+            config.item_names.clock_time_of_day: 'clock_time_of_day',
+            config.item_names.solar_time_of_day: 'solar_time_of_day',
+            SPC_AREA_ITEM_NAME: 'spc_area_mode'
+        }
+
+    def attach(self, rule: Rule):
+        '''Subscribes to the items through the given rule and reads their current values.'''
+        for item_name in self._item_fields:
+            rule.listen_event(item_name, self._on_change, ValueChangeEventFilter())
+        self.refresh()
+
+    def refresh(self):
+        '''Reads the current values of all items.'''
+        light_level = NumberItem.get_item(config.item_names.sys_light_level).value
+        clock_time_of_day = StringItem.get_item(config.item_names.clock_time_of_day).value
+        solar_time_of_day = StringItem.get_item(config.item_names.solar_time_of_day).value
+        spc_area_mode = StringItem.get_item(SPC_AREA_ITEM_NAME).value
+        with self._lock:
+            self._snapshot = _derive(light_level, clock_time_of_day, solar_time_of_day, spc_area_mode)
+
+    def _on_change(self, event: ValueChangeEvent):
+        field = self._item_fields.get(event.name)
+        if field is None:
+            return
+        with self._lock:
+            values = (self._snapshot or HouseSnapshot())._replace(**{field: event.value})
+            self._snapshot = _derive(values.light_level, values.clock_time_of_day, values.solar_time_of_day, values.spc_area_mode)
+        log.debug('[%s] changed to [%s]', event.name, event.value)
+
+    def snapshot(self) -> HouseSnapshot:
+        if self._snapshot is None:
+            self.refresh()
+        return self._snapshot
+
+    @property
+    def is_light_level_bright(self) -> bool:
+        return self.snapshot().is_light_level_bright
+
+    @property
+    def is_light_level_shady(self) -> bool:
+        return self.snapshot().is_light_level_shady
+
+    @property
+    def is_light_level_dark(self) -> bool:
+        return self.snapshot().is_light_level_dark
+
+    @property
+    def is_light_level_black(self) -> bool:
+        return self.snapshot().is_light_level_black
+
+    @property
+    def is_clock_night(self) -> bool:
+        return self.snapshot().is_clock_night
+
+    @property
+    def is_solar_night(self) -> bool:
+        return self.snapshot().is_solar_night
+
+    @property
+    def spc_area_is_set(self) -> bool:
+        return self.snapshot().spc_area_is_set
+
+    @property
+    def spc_area_is_fully_set(self) -> bool:
+        return self.snapshot().spc_area_is_fully_set
+
+    @property
+    def spc_area_is_partially_set(self) -> bool:
+        return self.snapshot().spc_area_is_partially_set
+
+house_state = HouseState()
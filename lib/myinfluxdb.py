@@ -0,0 +1,142 @@
+import csv
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+
+import numpy as np
+import requests
+from HABApp.openhab.items import GroupItem
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.myinfluxdb')
+log.setLevel(logging.INFO)
+
+INFLUXDB_CHUNK_ROWS = 10000   # Rows parsed into NumPy arrays at a time
+INFLUXDB_QUERY_TIMEOUT = 60   # Seconds
+DEFAULT_PERCENTILES = (50, 90, 95)
+
+class SeriesAggregate(NamedTuple):
+    count: int
+    mean: float
+    min: float
+    max: float
+    percentiles: Dict[float, float]
+    times: np.ndarray    # datetime64[s] in UTC, the start of each downsampling interval
+    values: np.ndarray   # The mean value of each downsampling interval
+
+def _flux_time(time: Union[datetime, timedelta]) -> str:
+    if isinstance(time, timedelta):
+        return f'-{int(time.total_seconds())}s'
+    return time.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _flux_string(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+class InfluxDBReader:
+    '''
+    Reads the history of many items with a single Flux query and aggregates it with NumPy.
+    The response is streamed as CSV and converted to arrays a chunk at a time, so the rows are never
+    kept as Python objects.
+    The openHAB persistence layout is assumed: one measurement per item with the state in the field "value".
+    '''
+
+    def __init__(self, url: str, token: str, org: str, bucket: str):
+        self.url = url
+        self.query_url = f'{url.rstrip("/")}/api/v2/query'
+        self.org = org
+        self.bucket = bucket
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Token {token}',
+            'Content-Type': 'application/vnd.flux',
+            'Accept': 'application/csv'
+        })
+
+    def build_query(self, item_names: Iterable[str], start: Union[datetime, timedelta], stop: Optional[datetime] = None) -> str:
+        measurements = ' or '.join(f'r._measurement == {_flux_string(name)}' for name in item_names)
+        stop_argument = f', stop: {_flux_time(stop)}' if stop is not None else ''
+        return (
+            f'from(bucket: {_flux_string(self.bucket)})\n'
+            f'  |> range(start: {_flux_time(start)}{stop_argument})\n'
+            f'  |> filter(fn: (r) => {measurements})\n'
+            f'  |> filter(fn: (r) => r._field == "value")\n'
+            f'  |> keep(columns: ["_time", "_value", "_measurement"])'
+        )
+
+    def read_series(self, item_names: Sequence[str], start: Union[datetime, timedelta], stop: Optional[datetime] = None) -> Dict[str, tuple]:
+        '''
+        Returns {item name: (UTC times as datetime64[s], values as float64)} for the items that have values in the range.
+        Nothing is returned if no InfluxDB URL is configured.
+        '''
+        if not item_names or not self.url:
+            return {}
+        response = self.session.post(self.query_url, params={'org': self.org}, data=self.build_query(item_names, start, stop).encode(), stream=True, timeout=INFLUXDB_QUERY_TIMEOUT)
+        response.raise_for_status()
+        chunks: Dict[str, List[tuple]] = {}
+        pending: Dict[str, tuple] = {}
+        rows = 0
+        columns = None
+        for row in csv.reader(response.iter_lines(decode_unicode=True)):
+            if not row or len(row) < 3:
+                continue
+            if '_time' in row:
+                # Each table in the response starts with a header row
+                columns = (row.index('_time'), row.index('_value'), row.index('_measurement'))
+                continue
+            if columns is None:
+                continue
+            time_column, value_column, measurement_column = columns
+            times, values = pending.setdefault(row[measurement_column], ([], []))
+            times.append(row[time_column].rstrip('Z'))
+            values.append(row[value_column])
+            rows += 1
+            if rows >= INFLUXDB_CHUNK_ROWS:
+                self._flush(pending, chunks)
+                rows = 0
+        self._flush(pending, chunks)
+        return {name: (np.concatenate([c[0] for c in item_chunks]), np.concatenate([c[1] for c in item_chunks])) for name, item_chunks in chunks.items()}
+
+    @staticmethod
+    def _flush(pending: Dict[str, tuple], chunks: Dict[str, List[tuple]]):
+        for name, (times, values) in pending.items():
+            if times:
+                chunks.setdefault(name, []).append((np.array(times, dtype='datetime64[s]'), np.array(values, dtype=np.float64)))
+        pending.clear()
+
+    def read_aggregates(self, item_names: Sequence[str], start: Union[datetime, timedelta], stop: Optional[datetime] = None,
+                        percentiles: Sequence[float] = DEFAULT_PERCENTILES, every: Optional[timedelta] = None) -> Dict[str, SeriesAggregate]:
+        '''
+        Returns per item aggregates over the range: count, mean, min, max and the given percentiles.
+        If every is given the series is also downsampled to the mean of each interval of that length.
+        '''
+        return {name: aggregate(times, values, percentiles, every) for name, (times, values) in self.read_series(item_names, start, stop).items()}
+
+    def read_group_aggregates(self, group_name: str, start: Union[datetime, timedelta], stop: Optional[datetime] = None,
+                              percentiles: Sequence[float] = DEFAULT_PERCENTILES, every: Optional[timedelta] = None) -> Dict[str, SeriesAggregate]:
+        '''Same as read_aggregates for all members of an openHAB group, using one query.'''
+        item_names = [item.name for item in GroupItem.get_item(group_name).members]
+        return self.read_aggregates(item_names, start, stop, percentiles, every)
+
+def aggregate(times: np.ndarray, values: np.ndarray, percentiles: Sequence[float] = DEFAULT_PERCENTILES, every: Optional[timedelta] = None) -> SeriesAggregate:
+    if every is not None:
+        seconds = times.astype(np.int64)
+        step = int(every.total_seconds())
+        bins = (seconds - seconds.min()) // step
+        counts = np.bincount(bins)
+        sums = np.bincount(bins, weights=values)
+        filled = counts > 0
+        downsampled_times = (seconds.min() + np.nonzero(filled)[0] * step).astype('datetime64[s]')
+        downsampled_values = sums[filled] / counts[filled]
+    else:
+        downsampled_times, downsampled_values = times, values
+    return SeriesAggregate(
+        count=len(values),
+        mean=float(values.mean()),
+        min=float(values.min()),
+        max=float(values.max()),
+        percentiles=dict(zip(percentiles, np.percentile(values, percentiles).tolist())),
+        times=downsampled_times,
+        values=downsampled_values
+    )
+
+influxdb_reader = InfluxDBReader(config.influxdb.url, config.influxdb.token, config.influxdb.org, config.influxdb.bucket)
@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+import warnings
+from concurrent.futures import Future
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+from myconfig import LametricConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.mylametric')
+log.setLevel(logging.INFO)
+
+LAMETRIC_WORKERS = 2            # Number of sender threads, also the size of the connection pool
+LAMETRIC_QUEUE_SIZE = 50        # Notifications waiting to be sent before new ones are rejected
+LAMETRIC_DEFAULT_DEADLINE = 10  # Seconds from queuing until a notification is considered stale
+
+class LaMetricClient:
+    '''
+    Sends notifications to a LaMetric device.
+    A single keep-alive HTTPS session is shared by a few background threads so that the rule
+    thread never blocks and the TLS handshake is only paid when a pooled connection is opened.
+    '''
+
+    def __init__(self, host: str, port: int, api_key: str, workers: int = LAMETRIC_WORKERS, queue_size: int = LAMETRIC_QUEUE_SIZE):
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.configure(host, port, api_key)
+        self._queue = queue.Queue(maxsize=queue_size)
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'LaMetric-{i}', daemon=True).start()
+
+    def configure(self, host: str, port: int, api_key: str):
+        self.url = f'https://{host}:{port}/api/v2/device/notifications'
+        self.session.auth = ('dev', api_key)
+        warnings.filterwarnings('ignore', message=f".*'{host}'", category=InsecureRequestWarning)
+
+    def on_config_changed(self, old: LametricConfig, new: LametricConfig):
+        self.configure(new.host, new.port, new.api_key)
+
+    def send(self, payload: Dict, deadline: float = LAMETRIC_DEFAULT_DEADLINE) -> Future:
+        '''
+        Queues a notification payload for sending.
+        Returns a Future that resolves to True if the device accepted the notification, otherwise False.
+        A notification that can't be delivered within deadline seconds from now is given up.
+        '''
+        future = Future()
+        try:
+            self._queue.put_nowait((payload, time.monotonic() + deadline, future))
+        except queue.Full:
+            log.error('The LaMetric queue is full, dropping the notification')
+            future.set_result(False)
+        return future
+
+    def _worker(self):
+        while True:
+            payload, deadline, future = self._queue.get()
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._post(payload, deadline))
+
+    def _post(self, payload: Dict, deadline: float) -> bool:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            log.warning('The LaMetric notification passed its deadline while queued, dropping it')
+            return False
+        try:
+            # The device uses a self signed certificate. verify is passed per request, since requests prefers
+            # REQUESTS_CA_BUNDLE from the environment over the verify of the session
+            response = self.session.post(self.url, json=payload, timeout=remaining, verify=False)
+        except requests.RequestException as e:
+            log.error("Error sending notification to LaMetric: %s", e)
+            return False
+        if not response.ok:
+            log.error("LaMetric responded with status code: %s", response.status_code)
+            return False
+        return True
+
+lametric_client = LaMetricClient(config.lametric.host, config.lametric.port, config.lametric.api_key)
+config.subscribe('lametric', lametric_client.on_config_changed)
@@ -0,0 +1,166 @@
+import logging
+import math
+import threading
+from bisect import bisect_right
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from myconfig import LightingConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.mylightlevel')
+log.setLevel(logging.INFO)
+
+LIGHT_SENSOR_TIME_CONSTANT = 300 # Seconds; a sensor's smoothed value follows a step change by 63 % in this time
+LIGHT_SENSOR_STALE_SECS = 1800   # A sensor that hasn't reported for this long is left out
+LIGHT_SENSOR_MIN_VARIANCE = 1e-4 # Keeps a steady sensor from taking all the weight (log10 lux squared)
+
+class SensorStats:
+    '''
+    Exponentially weighted mean and variance of one sensor's log10 lux, updated in O(1) per sample.
+    The weight of a sample depends on the time since the previous one, so irregular reporting is fine.
+    '''
+    __slots__ = ('mean', 'variance', 'last_time', 'samples')
+
+    def __init__(self):
+        self.mean: Optional[float] = None
+        self.variance = 0.0
+        self.last_time = 0.0
+        self.samples = 0
+
+    def update(self, lux: float, now: float, time_constant: float = LIGHT_SENSOR_TIME_CONSTANT):
+        value = math.log10(max(lux, 0.0) + 1)
+        self.samples += 1
+        if self.mean is None:
+            self.mean, self.last_time = value, now
+            return
+        alpha = 1 - math.exp(-max(now - self.last_time, 0.0) / time_constant)
+        delta = value - self.mean
+        self.mean += alpha * delta
+        self.variance = (1 - alpha) * (self.variance + alpha * delta * delta)
+        self.last_time = now
+
+class LightLevelFusion:
+    '''
+    Derives the light level (LIGHT_LEVEL) from the light sensors. Each sensor is smoothed on its own,
+    the sensors are combined weighted by the inverse of their variance, so a noisy sensor counts less,
+    and the level only changes when the combined lux has gone past a band edge by the hysteresis and
+    the new level has held for the dwell time.
+    The counters show the posts avoided compared to posting the level on every sample, and compared to
+    posting every change of the level the smoothed lux is in without hysteresis and dwell.
+    '''
+
+    def __init__(self, lighting: LightingConfig, sensors: Tuple[str, ...]):
+        self.sensors: Dict[str, SensorStats] = {name: SensorStats() for name in sensors}
+        self.level: Optional[int] = None
+        self.lux: Optional[float] = None
+        self.candidate: Optional[int] = None
+        self.candidate_since = 0.0
+        self.samples = 0
+        self.posted = 0
+        self.raw_changes = 0 # Changes of the level without hysteresis and dwell
+        self._raw_level: Optional[int] = None
+        self._lock = threading.Lock()
+        self.configure(lighting)
+
+    def configure(self, lighting: LightingConfig):
+        bands = sorted((lux, lighting.light_level[name]) for name, lux in lighting.light_level_lux.items() if name in lighting.light_level)
+        self._edges: List[float] = [lux for lux, _ in bands]
+        self._levels: List[int] = [level for _, level in bands]
+        self._up_edges = [lux * (1 + lighting.hysteresis) for lux in self._edges]
+        self._down_edges = [lux / (1 + lighting.hysteresis) for lux in self._edges]
+        self.dwell_secs = lighting.dwell_secs
+
+    def on_config_changed(self, old: LightingConfig, new: LightingConfig):
+        with self._lock:
+            self.configure(new)
+
+    @property
+    def avoided(self) -> int:
+        '''Posts avoided compared to posting the level on every sample.'''
+        return self.samples - self.posted
+
+    @property
+    def avoided_changes(self) -> int:
+        '''Posts avoided compared to posting every change of the level without hysteresis and dwell.'''
+        return max(self.raw_changes - self.posted, 0)
+
+    def stats(self) -> dict:
+        return {'samples': self.samples, 'posted': self.posted, 'avoided': self.avoided, 'avoided_changes': self.avoided_changes}
+
+    def set_level(self, level: Optional[int]):
+        '''Sets the current level, e.g. from Sys_LightLevel at startup.'''
+        with self._lock:
+            self.level = level
+
+    def _combined_lux(self, now: float) -> Optional[float]:
+        weights = mean = 0.0
+        for stats in self.sensors.values():
+            if stats.mean is None or now - stats.last_time > LIGHT_SENSOR_STALE_SECS:
+                continue
+            weight = 1 / max(stats.variance, LIGHT_SENSOR_MIN_VARIANCE)
+            weights += weight
+            mean += weight * stats.mean
+        return 10 ** (mean / weights) - 1 if weights else None
+
+    def _band(self, lux: float) -> int:
+        '''The band index the lux is in, staying in the current band until the lux is past its edges by the hysteresis.'''
+        current = self._levels.index(self.level) if self.level in self._levels else None
+        if current is None:
+            return max(bisect_right(self._edges, lux) - 1, 0)
+        up = bisect_right(self._up_edges, lux) - 1
+        if up > current:
+            return up
+        down = max(bisect_right(self._down_edges, lux) - 1, 0)
+        return down if down < current else current
+
+    def update(self, sensor: str, lux: float, now: Optional[float] = None) -> Optional[int]:
+        '''Adds a sample of the sensor. Returns the new level if it should be posted, otherwise None.'''
+        now = datetime.now().timestamp() if now is None else now
+        with self._lock:
+            stats = self.sensors.get(sensor)
+            if stats is None:
+                return None
+            stats.update(lux, now)
+            self.samples += 1
+            self.lux = self._combined_lux(now)
+            if self.lux is None:
+                return None
+            raw_level = self._levels[max(bisect_right(self._edges, self.lux) - 1, 0)]
+            if raw_level != self._raw_level:
+                self.raw_changes += 1
+                self._raw_level = raw_level
+            level = self._levels[self._band(self.lux)]
+            if self.level is None:
+                return self._post(level)
+            if level == self.level:
+                self.candidate = None
+                return None
+            if level != self.candidate:
+                self.candidate, self.candidate_since = level, now
+            return self._evaluate(now)
+
+    def pending_secs(self, now: Optional[float] = None) -> Optional[float]:
+        '''The seconds until the candidate level has held for the dwell time, or None if there is no candidate.'''
+        if self.candidate is None:
+            return None
+        return max(self.candidate_since + self.dwell_secs - (datetime.now().timestamp() if now is None else now), 0.0)
+
+    def evaluate(self, now: Optional[float] = None) -> Optional[int]:
+        '''Returns the candidate level if it has held for the dwell time and should be posted, otherwise None.'''
+        with self._lock:
+            return self._evaluate(datetime.now().timestamp() if now is None else now)
+
+    def _evaluate(self, now: float) -> Optional[int]:
+        if self.candidate is None or now - self.candidate_since < self.dwell_secs:
+            return None
+        return self._post(self.candidate)
+
+    def _post(self, level: int) -> int:
+        log.debug('The light level changes from %s to %s at %.0f lux', self.level, level, self.lux)
+        self.level = level
+        self.candidate = None
+        self.posted += 1
+        return level
+
+light_level_fusion = LightLevelFusion(config.lighting, config.item_names.light_sensors)
+config.subscribe('lighting', light_level_fusion.on_config_changed)
@@ -0,0 +1,267 @@
+import logging
+import math
+import threading
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from myconfig import EnergyConfig, config
+from myprices import PriceIndex, epoch_hour, price_store
+
+log = logging.getLogger(f'{config.system.logger_name}.myloadplan')
+log.setLevel(logging.INFO)
+
+HEATING_BALANCE_TEMP = 17.0     # Outdoor temperature in °C above which the house needs no heating
+HEAT_PUMP_KW_PER_DEGREE = 0.12  # Electric power in kW the heat pump draws per degree below the balance temperature
+HEAT_STORAGE_LOSS = 0.1         # Share of the heat stored in the house during a Slösa hour that is lost before it's used
+BURN_PRICE = 0.0                # Hours priced at or below this (EUR/MWh) are Bränn, or Slösa when the addon is blocked
+FORECAST_TEMP_RESOLUTION = 0.5  # Temperatures are rounded to this before planning, so that small changes don't re-plan
+ELECTRICAL_ADDON_KW = 6.5       # Electric power in kW the heat pump's electrical addon draws in a Bränn hour
+BASE_LOAD_KW = 1.5              # Power in kW kept free in every hour for the household load besides heating and the EV
+DAY_SLOTS = 25                  # Hours of the longest day, when daylight saving time ends
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, time())
+
+class EvNeed(NamedTuple):
+    energy_kwh: float
+    deadline: datetime
+
+class DayPlan(NamedTuple):
+    day: date
+    first_hour: int    # Hours since the epoch of the first hour of the day
+    key: bytes         # The planning input the levels were computed from
+    levels: np.ndarray # The level value of each hour of the day
+    power: np.ndarray  # The power in kW the heating is planned to draw in each hour of the day
+
+class EvPlan(NamedTuple):
+    key: tuple
+    hours: np.ndarray  # Hours since the epoch to charge in, ascending
+    power: np.ndarray  # The charging power in kW of each of the hours
+    shortfall_kwh: float
+
+def heating_demand(temperatures: np.ndarray) -> np.ndarray:
+    '''The electric power in kW the heat pump needs at the given outdoor temperatures.'''
+    return np.maximum(HEATING_BALANCE_TEMP - temperatures, 0.0) * HEAT_PUMP_KW_PER_DEGREE
+
+def grid_budget(energy: EnergyConfig) -> float:
+    '''The power in kW the heating and the EV may draw together in an hour, unlimited if the grid has no limit.'''
+    if not energy.max_grid_feed_in_power:
+        return math.inf
+    return energy.max_grid_feed_in_power / 1000 - BASE_LOAD_KW
+
+def plan_heating(prices: np.ndarray, temperatures: np.ndarray, energy: EnergyConfig) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Plans the level of each hour for a batch of days at once, one day per row, padded with NaN prices.
+    Within a day the cheapest hours that need heating are paired with the most expensive ones, and a pair
+    becomes Slösa and Spara when heat stored at the cheap hour, with the storage loss, costs less than
+    heating at the expensive hour. Pairing the k-th cheapest with the k-th most expensive hour gives the
+    largest saving, and since the cheap prices rise and the expensive ones fall with k, the profitable pairs
+    are the first ones. Hours at or below BURN_PRICE are Bränn when the electrical addon may run.
+    A Slösa hour draws the heat of both hours of its pair and a Bränn hour also the addon, so pairs and
+    Bränn hours that would draw more than the grid budget are left out.
+    Returns the levels and the power in kW the heating draws in each hour.
+    '''
+    levels = energy.spending_levels
+    budget = grid_budget(energy)
+    rows, slots = prices.shape
+    demand = heating_demand(temperatures)
+    shiftable = ~np.isnan(prices) & (demand > 0)
+    order = np.argsort(np.where(shiftable, prices, np.inf), axis=1, kind='stable')
+    ascending = np.take_along_axis(np.where(shiftable, prices, np.inf), order, axis=1)
+    counts = shiftable.sum(axis=1)[:, None]
+    rank = np.arange(slots)[None, :]
+    mirror = np.clip(counts - 1 - rank, 0, slots - 1)
+    descending = np.take_along_axis(ascending, mirror, axis=1)
+    cheap_demand = np.take_along_axis(demand, order, axis=1)
+    stored_power = cheap_demand + np.take_along_axis(cheap_demand, mirror, axis=1) * (1 + HEAT_STORAGE_LOSS)
+    profitable = (rank < counts // 2) & (ascending * (1 + HEAT_STORAGE_LOSS) < descending) & (stored_power <= budget)
+    plan = np.full((rows, slots), levels['Normal'], dtype=np.int8)
+    power = demand.copy()
+    row, pair = np.nonzero(profitable)
+    plan[row, order[row, pair]] = levels['Slösa']
+    plan[row, order[row, mirror[row, pair]]] = levels['Spara']
+    power[row, order[row, pair]] = stored_power[row, pair]
+    power[row, order[row, mirror[row, pair]]] = 0.0
+    with np.errstate(invalid='ignore'):
+        cheap = prices <= BURN_PRICE
+    burn = cheap & (temperatures <= energy.block_electrical_addon_above_temp) & (power + ELECTRICAL_ADDON_KW <= budget)
+    plan[burn] = levels['Bränn']
+    power[burn] += ELECTRICAL_ADDON_KW
+    plan[cheap & ~burn] = np.maximum(plan[cheap & ~burn], levels['Slösa'])
+    return plan, power
+
+def plan_ev(index: PriceIndex, need: EvNeed, now: datetime, available: np.ndarray, energy: EnergyConfig) -> Tuple[np.ndarray, np.ndarray, float]:
+    '''
+    Picks the cheapest hours with known prices from now until the deadline to charge the needed energy in.
+    available is the power in kW left for the EV in each of those hours, which the charger can use from its
+    min to its max power. Taking the cheapest hours first, each at the most power it can use, is the cheapest
+    way to charge, and the last hour only gets the power that is still needed.
+    Returns the hours since the epoch, the charging power of each and the energy that doesn't fit in them.
+    '''
+    start = epoch_hour(now)
+    prices = index.hours(start, max(epoch_hour(need.deadline) - start, 0))
+    capacity = np.minimum(available[:len(prices)], energy.ev_charger_max_kw)
+    capacity[(capacity < energy.ev_charger_min_kw) | np.isnan(prices)] = 0.0
+    order = np.argsort(np.where(capacity > 0, prices, np.inf), kind='stable')[:np.count_nonzero(capacity)]
+    charged = np.cumsum(capacity[order])
+    hours_needed = int(np.searchsorted(charged, need.energy_kwh)) + 1 if need.energy_kwh > 0 else 0
+    chosen = order[:hours_needed]
+    power = capacity[chosen]
+    if len(chosen) and charged[len(chosen) - 1] > need.energy_kwh:
+        power[-1] = max(power[-1] - (charged[len(chosen) - 1] - need.energy_kwh), energy.ev_charger_min_kw)
+    shortfall = max(need.energy_kwh - float(power.sum()), 0.0)
+    ascending = np.argsort(chosen)
+    return chosen[ascending] + start, power[ascending], shortfall
+
+class LoadPlanner:
+    '''
+    Plans the energy spending level (Spara/Normal/Slösa/Bränn) of each hour with known day-ahead prices from
+    the prices and the temperature forecast, and the hours to charge the EV in.
+    Re-planning is incremental: each day is planned from its own prices and temperatures, and only the days
+    whose input has changed are planned again, together in one vectorized batch. The heating and the EV share
+    the power budget of each hour, the grid's limit less the household load: the EV gets what the planned
+    heating leaves, so the EV plan is redone when the prices, the EV need or the heating plan have changed.
+    '''
+
+    def __init__(self):
+        self.energy = config.energy
+        self.days: Dict[date, DayPlan] = {}
+        self.ev: Optional[EvPlan] = None
+        self.ev_need: Optional[EvNeed] = None
+        self.planned_days = 0
+        self.reused_days = 0
+        self._heating_version = 0
+        self._forecast_first_hour = 0
+        self._forecast = np.full(1, HEATING_BALANCE_TEMP)
+        self._names = {value: name for name, value in self.energy.spending_levels.items()}
+        self._lock = threading.RLock()
+
+    def on_config_changed(self, old: EnergyConfig, new: EnergyConfig):
+        with self._lock:
+            self.energy = new
+            self._names = {value: name for name, value in new.spending_levels.items()}
+            self.days.clear()
+            self.ev = None
+        self.replan()
+
+    def set_forecast(self, start: datetime, temperatures: Sequence[float]):
+        '''
+        Sets the outdoor temperature of each hour from start. Hours before the forecast have its first
+        temperature and hours after it its last, so a single temperature holds for all hours.
+        '''
+        with self._lock:
+            self._forecast_first_hour = epoch_hour(start)
+            self._forecast = np.round(np.asarray(temperatures, dtype=np.float64) / FORECAST_TEMP_RESOLUTION) * FORECAST_TEMP_RESOLUTION
+
+    def set_ev_need(self, need: Optional[EvNeed]):
+        with self._lock:
+            self.ev_need = need
+
+    def temperatures(self, start_hour: int, count: int) -> np.ndarray:
+        slots = np.clip(np.arange(start_hour, start_hour + count) - self._forecast_first_hour, 0, len(self._forecast) - 1)
+        return self._forecast[slots]
+
+    def replan(self, now: Optional[datetime] = None) -> bool:
+        '''
+        Plans the days whose prices or temperatures have changed, and the EV. Returns True if the plan changed.
+        The hours of today that have passed are left out of the pairing, since heat can't be stored in them any more.
+        '''
+        now = now or datetime.now()
+        today = now.date()
+        index = price_store.index
+        with self._lock:
+            changed = False
+            for day in [day for day in self.days if day < today]:
+                del self.days[day]
+            last_day = datetime.fromtimestamp(index.last_hour * 3600).date() if index.last_hour is not None else today - timedelta(days=1)
+            batch = []
+            for offset in range((last_day - today).days + 1):
+                day = today + timedelta(days=offset)
+                first_hour = epoch_hour(_midnight(day))
+                hours = epoch_hour(_midnight(day + timedelta(days=1))) - first_hour
+                prices = np.full(DAY_SLOTS, np.nan)
+                prices[:hours] = index.hours(first_hour, hours)
+                if day == today:
+                    prices[:epoch_hour(now) - first_hour] = np.nan
+                temperatures = np.full(DAY_SLOTS, HEATING_BALANCE_TEMP)
+                temperatures[:hours] = self.temperatures(first_hour, hours)
+                key = prices.tobytes() + temperatures.tobytes()
+                plan = self.days.get(day)
+                if plan is not None and plan.key == key:
+                    self.reused_days += 1
+                    continue
+                batch.append((day, first_hour, hours, key, prices, temperatures))
+            if batch:
+                levels, power = plan_heating(np.stack([entry[4] for entry in batch]), np.stack([entry[5] for entry in batch]), self.energy)
+                for (day, first_hour, hours, key, _, _), day_levels, day_power in zip(batch, levels, power):
+                    previous = self.days.get(day)
+                    self.days[day] = DayPlan(day, first_hour, key, day_levels[:hours], day_power[:hours])
+                    if previous is None or not np.array_equal(previous.power, day_power[:hours]):
+                        self._heating_version += 1
+                    changed = changed or previous is None or not np.array_equal(previous.levels, day_levels[:hours])
+                self.planned_days += len(batch)
+                log.debug('Planned %d days, reused %d', len(batch), len(self.days) - len(batch))
+            changed = self._replan_ev(index, now) or changed
+            return changed
+
+    def _replan_ev(self, index: PriceIndex, now: datetime) -> bool:
+        if self.ev_need is None or self.ev_need.deadline <= now:
+            changed, self.ev = self.ev is not None, None
+            return changed
+        key = (self.ev_need, id(index), self._heating_version)
+        if self.ev is not None and self.ev.key == key:
+            return False
+        start = epoch_hour(now)
+        hours, power, shortfall = plan_ev(index, self.ev_need, now, self.available(start, max(epoch_hour(self.ev_need.deadline) - start, 0)), self.energy)
+        if shortfall > 0:
+            log.info('%.1f kWh of the EV need does not fit in the hours with known prices before %s', shortfall, self.ev_need.deadline)
+        self.ev = EvPlan(key, hours, power, shortfall)
+        return True
+
+    def available(self, start_hour: int, count: int) -> np.ndarray:
+        '''The power in kW the planned heating leaves of the grid budget in each hour. Called with the lock held.'''
+        heating = heating_demand(self.temperatures(start_hour, count))
+        for plan in self.days.values():
+            first, last = max(plan.first_hour, start_hour), min(plan.first_hour + len(plan.power), start_hour + count)
+            if first < last:
+                heating[first - start_hour:last - start_hour] = plan.power[first - plan.first_hour:last - plan.first_hour]
+        return np.maximum(grid_budget(self.energy) - heating, 0.0)
+
+    def level_at(self, when: Optional[datetime] = None) -> Optional[str]:
+        '''The name of the planned level of the hour, None if the hour isn't planned.'''
+        when = when or datetime.now()
+        plan = self.days.get(when.date())
+        if plan is None:
+            return None
+        slot = epoch_hour(when) - plan.first_hour
+        return self._names.get(int(plan.levels[slot])) if 0 <= slot < len(plan.levels) else None
+
+    def ev_charging_at(self, when: Optional[datetime] = None) -> bool:
+        return self.ev_power_at(when) > 0
+
+    def ev_power_at(self, when: Optional[datetime] = None) -> float:
+        '''The planned charging power in kW of the hour, 0 if the EV isn't planned to charge in it.'''
+        ev = self.ev
+        if ev is None:
+            return 0.0
+        hour = epoch_hour(when or datetime.now())
+        position = int(np.searchsorted(ev.hours, hour))
+        return float(ev.power[position]) if position < len(ev.hours) and ev.hours[position] == hour else 0.0
+
+    def describe(self, now: Optional[datetime] = None) -> str:
+        '''The plan from the current hour, one entry per hour, e.g. "13 Normal, 14 Spara, 15 Spara EV".'''
+        now = now or datetime.now()
+        hour = epoch_hour(now)
+        with self._lock:
+            plans = sorted(self.days.values(), key=lambda plan: plan.first_hour)
+        entries: List[str] = []
+        for plan in plans:
+            for slot in range(max(hour - plan.first_hour, 0), len(plan.levels)):
+                start = datetime.fromtimestamp((plan.first_hour + slot) * 3600)
+                ev = ' EV' if self.ev_charging_at(start) else ''
+                entries.append(f'{start:%H} {self._names.get(int(plan.levels[slot]), "?")}{ev}')
+        return ', '.join(entries)
+
+load_planner = LoadPlanner()
+config.subscribe('energy', load_planner.on_config_changed)
@@ -0,0 +1,203 @@
+import atexit
+import logging
+import queue
+import threading
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Deque, Dict, List, Optional
+
+from myconfig import config
+
+LOG_QUEUE_SIZE = 10000 # Records waiting for the writer; records logged while the queue is full are dropped and counted
+RECENT_RECORDS = 50    # Records kept per logger, written as context when the logger logs an error
+RECENT_FORMAT = '%(asctime)s %(levelname)-8s %(message)s'
+
+class Fields:
+    '''
+    A log message with named fields that is only formatted when the record is written, e.g.
+    log.debug(Fields('Humidity', current=62, target=55)) is written as "Humidity current=62 target=55".
+    A handler that wants the fields themselves finds them in record.msg.fields.
+    '''
+    __slots__ = ('message', 'fields')
+
+    def __init__(self, message: str, **fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return ' '.join([self.message, *(f'{key}={value}' for key, value in self.fields.items())])
+
+class _DeferredQueueHandler(QueueHandler):
+    '''Puts the records on the queue unformatted, so that they are formatted by the writer, and drops them when the queue is full.'''
+
+    def __init__(self, log_queue: queue.SimpleQueue, pipeline: 'LogPipeline'):
+        super().__init__(log_queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # A SimpleQueue is unbounded but much cheaper to put on than a Queue, so the size is checked here
+        if self.queue.qsize() >= self.pipeline.queue_size:
+            self.pipeline.count_dropped()
+        else:
+            self.queue.put(record)
+
+class _RecentRecords(logging.Handler):
+    '''
+    Runs on the writer thread. Keeps the latest records of each logger and, when a logger logs an error,
+    writes the records before it that the output handlers left out, e.g. the info records when the console
+    handler only writes warnings. Only records the logger lets through are kept, so a logger set to INFO
+    leaves no debug records to write.
+    '''
+
+    def __init__(self, targets: List[logging.Handler], size: int):
+        super().__init__()
+        self.targets = targets
+        self.size = size
+        self.records: Dict[str, Deque[logging.LogRecord]] = {}
+        self.formatter = logging.Formatter(RECENT_FORMAT)
+
+    def _written(self, record: logging.LogRecord) -> bool:
+        return any(record.levelno >= target.level for target in self.targets)
+
+    def emit(self, record: logging.LogRecord):
+        recent = self.records.get(record.name)
+        if recent is None:
+            recent = self.records[record.name] = deque(maxlen=self.size)
+        if record.levelno >= logging.ERROR:
+            hidden = [self.format(previous) for previous in recent if not self._written(previous)]
+            if hidden:
+                context = logging.makeLogRecord({
+                    'name': record.name, 'levelno': record.levelno, 'levelname': record.levelname,
+                    'msg': 'The recent events before the error:\n    %s', 'args': ('\n    '.join(hidden),)})
+                for target in self.targets:
+                    if context.levelno >= target.level:
+                        target.handle(context)
+        recent.append(record)
+
+    def lines(self, logger_name: str) -> List[str]:
+        with self.lock:
+            return [self.format(record) for record in self.records.get(logger_name, ())]
+
+class _Writer(QueueListener):
+    '''Hands the records to the handlers, and sets the event of a flush marker instead of handing it on.'''
+
+    def handle(self, record: logging.LogRecord):
+        done = getattr(record, 'flushed', None)
+        if done is not None:
+            done.set()
+        else:
+            super().handle(record)
+
+class LogPipeline:
+    '''
+    Takes the writing of the log records of the rules and lib modules off the threads that log them. The
+    logger named MY_LOGGER_NAME, which the loggers of all rules and lib modules are children of, gets a queue
+    handler instead of its output handlers, and a writer thread formats the records and hands them to the
+    output handlers. A rule thread only pays for creating the record and putting it on the queue, and a
+    slow disk or console doesn't hold it up. If the queue is full, the records are dropped rather than waited for.
+    Pass the message arguments as arguments, or a Fields message, rather than an f-string, so that nothing is
+    formatted when the level is disabled, and don't change them after the call since they're formatted later.
+    '''
+
+    def __init__(self, logger_name: str, queue_size: int = LOG_QUEUE_SIZE, recent_records: int = RECENT_RECORDS):
+        self.logger = logging.getLogger(logger_name)
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.queue_size = queue_size
+        self.recent_records = recent_records
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._dropped_lock = threading.Lock()
+        self._listener: Optional[_Writer] = None
+        self._recent: Optional[_RecentRecords] = None
+        self._handler: Optional[_DeferredQueueHandler] = None
+        self._saved_handlers: List[logging.Handler] = []
+        self._saved_propagate = True
+
+    def count_dropped(self):
+        # Called from the threads that log, so the count is locked
+        with self._dropped_lock:
+            self.dropped += 1
+
+    @property
+    def installed(self) -> bool:
+        return self._listener is not None
+
+    def _output_handlers(self, own: List[logging.Handler], propagate: bool) -> List[logging.Handler]:
+        # The handlers the records would reach: the logger's own, or else those of the first ancestor that has any
+        if own:
+            return list(own)
+        logger = self.logger.parent if propagate else None
+        while logger is not None:
+            if logger.handlers:
+                return list(logger.handlers)
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        return [logging.lastResort] if logging.lastResort is not None else []
+
+    def install(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._saved_handlers, self._saved_propagate = list(self.logger.handlers), self.logger.propagate
+            targets = self._output_handlers(self._saved_handlers, self._saved_propagate)
+            for handler in self._saved_handlers:
+                self.logger.removeHandler(handler)
+            self._recent = _RecentRecords(targets, self.recent_records)
+            self._handler = _DeferredQueueHandler(self.queue, self)
+            self.logger.addHandler(self._handler)
+            self.logger.propagate = False
+            self._listener = _Writer(self.queue, self._recent, *targets, respect_handler_level=True)
+            self._listener.start()
+
+    def refresh(self):
+        '''
+        Resolves the output handlers again, e.g. after HABApp reloaded its logging configuration, which replaces
+        the handlers of the ancestors and may give the logger handlers of its own or take the queue handler away.
+        '''
+        with self._lock:
+            if self._listener is None:
+                return
+            added = [handler for handler in self.logger.handlers if handler is not self._handler]
+            for handler in added:
+                self.logger.removeHandler(handler)
+            if added:
+                self._saved_handlers = added
+            if self.logger.propagate:
+                self._saved_propagate = True
+            if self._handler not in self.logger.handlers:
+                self.logger.addHandler(self._handler)
+            self.logger.propagate = False
+            targets = self._output_handlers(self._saved_handlers, self._saved_propagate)
+            self._recent.targets = targets
+            self._listener.handlers = (self._recent, *targets)
+
+    def uninstall(self):
+        '''Writes the queued records and gives the logger its output handlers back.'''
+        with self._lock:
+            if self._listener is None:
+                return
+            self.logger.removeHandler(self._handler)
+            self._listener.stop()
+            self._listener = None
+            for handler in self._saved_handlers:
+                self.logger.addHandler(handler)
+            self.logger.propagate = self._saved_propagate
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        '''Waits until the writer has handled the records queued so far. Returns False on a timeout.'''
+        if self._listener is None:
+            return True
+        flushed = threading.Event()
+        self.queue.put(logging.makeLogRecord({'name': self.logger.name, 'flushed': flushed}))
+        return flushed.wait(timeout)
+
+    def recent(self, logger_name: str) -> List[str]:
+        '''The latest records of the logger, e.g. f'{MY_LOGGER_NAME}.HumControl', formatted.'''
+        return self._recent.lines(logger_name) if self._recent is not None else []
+
+log_pipeline = LogPipeline(config.system.logger_name)
+atexit.register(log_pipeline.uninstall)
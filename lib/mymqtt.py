@@ -0,0 +1,136 @@
+import json
+import logging
+import re
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Pattern
+
+from HABApp.core import Items
+from HABApp.mqtt.items import MqttItem
+from myconfig import MqttConfig, config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(f'{config.system.logger_name}.mymqtt')
+log.setLevel(logging.INFO)
+
+MQTT_BATCH_MAX = 100 # Max number of messages taken off the queue at a time
+
+def _encode_json(payload: Any) -> str:
+    return json.dumps(payload)
+
+def _encode_orjson(payload: Any) -> str:
+    return orjson.dumps(payload).decode()
+
+# Dicts and lists are published as JSON, with orjson when it's installed
+encode_json: Callable[[Any], str] = _encode_orjson if orjson is not None else _encode_json
+
+def encode(payload: Any) -> Any:
+    '''The payload as it's published: dicts and lists as JSON, anything else as it is.'''
+    return encode_json(payload) if isinstance(payload, (dict, list)) else payload
+
+def _topic_pattern(topics: Iterable[str]) -> Optional[Pattern]:
+    # MQTT wildcards: + is one level, # is all the levels below
+    patterns = ['/'.join('[^/]*' if level == '+' else '.*' if level == '#' else re.escape(level) for level in topic.split('/'))
+                for topic in topics]
+    return re.compile('|'.join(patterns)) if patterns else None
+
+class MqttPublisher:
+    '''
+    Publishes MQTT messages from a background thread, in the order they were published. The MQTT item of each
+    topic is looked up once and reused until the item is removed. The thread takes the waiting messages off the
+    queue in batches of up to MQTT_BATCH_MAX and encodes them, so the callers neither wait for the broker nor
+    pay for the JSON encoding. A message to one of the coalesced state topics replaces the one of the topic that
+    is still waiting, moving to the end of the queue, so only the latest value is published. All other topics,
+    e.g. commands like sonos/set/<room>/speak, keep every message.
+    '''
+
+    def __init__(self, coalesced_topics: Iterable[str] = config.mqtt.coalesced_topics):
+        self.published = 0
+        self.coalesced = 0
+        self.batches = 0
+        self._items: Dict[str, MqttItem] = {}
+        self._queue: Deque[List[Any]] = deque()      # [topic, payload, pending]
+        self._pending: Dict[str, List[Any]] = {}     # Coalesced topic -> its message in the queue
+        self._coalesced_by_topic: Dict[str, bool] = {}
+        self._condition = threading.Condition()
+        self.set_coalesced_topics(coalesced_topics)
+        threading.Thread(target=self._worker, name='MqttPublisher', daemon=True).start()
+
+    def set_coalesced_topics(self, topics: Iterable[str]):
+        '''The state topics to coalesce, with the MQTT wildcards + and #, e.g. 'sonos/set/+/volume'.'''
+        with self._condition:
+            self.coalesced_topics = tuple(topics)
+            self._pattern = _topic_pattern(self.coalesced_topics)
+            self._coalesced_by_topic.clear()
+
+    def on_config_changed(self, old: MqttConfig, new: MqttConfig):
+        self.set_coalesced_topics(new.coalesced_topics)
+
+    def publish(self, topic: str, payload: Any):
+        message = [topic, payload, True]
+        with self._condition:
+            if self._is_coalesced(topic):
+                previous = self._pending.get(topic)
+                if previous is not None:
+                    previous[2] = False
+                    self.coalesced += 1
+                self._pending[topic] = message
+            self._queue.append(message)
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        return {'published': self.published, 'coalesced': self.coalesced, 'batches': self.batches, 'pending': len(self._queue)}
+
+    def _is_coalesced(self, topic: str) -> bool:
+        # Called with the condition held
+        coalesced = self._coalesced_by_topic.get(topic)
+        if coalesced is None:
+            coalesced = self._coalesced_by_topic[topic] = self._pattern is not None and self._pattern.fullmatch(topic) is not None
+        return coalesced
+
+    def _item(self, topic: str) -> MqttItem:
+        item = self._items.get(topic)
+        if item is None:
+            item = self._items[topic] = MqttItem.get_create_item(topic)
+        return item
+
+    def _drop_removed_items(self, topics: Iterable[str]):
+        # Checked once per batch, so that an item that was removed is created again rather than published through
+        for topic in topics:
+            if topic in self._items and not Items.item_exists(topic):
+                del self._items[topic]
+
+    def _next_batch(self) -> List[List[Any]]:
+        with self._condition:
+            self._condition.wait_for(lambda: self._queue)
+            batch = []
+            while self._queue and len(batch) < MQTT_BATCH_MAX:
+                message = self._queue.popleft()
+                if message[2]:
+                    if self._pending.get(message[0]) is message:
+                        del self._pending[message[0]]
+                    batch.append(message)
+            return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            self.batches += 1
+            self._drop_removed_items({message[0] for message in batch})
+            for topic, payload, _ in batch:
+                try:
+                    payload = encode(payload)
+                    log.debug('%s <- %s', topic, payload)
+                    self._item(topic).publish(payload)
+                    self.published += 1
+                except Exception:
+                    log.exception('Failed to publish to [%s]', topic)
+
+mqtt_publisher = MqttPublisher()
+config.subscribe('mqtt', mqtt_publisher.on_config_changed)
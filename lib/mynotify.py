@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+
+from myconfig import config
+from mydedup import SUPPRESSED
+from mypushover import PUSHOVER_PRIO, send_pushover_message
+from mysms import send_sms
+from myutils import PRIO, NotificationPolicy, play_notification, queue_notification_to_lametric
+
+log = logging.getLogger(f'{config.system.logger_name}.mynotify')
+log.setLevel(logging.INFO)
+
+SONOS = 'sonos'
+LAMETRIC = 'lametric'
+PUSHOVER = 'pushover'
+SMS = 'sms'
+NOTIFY_CHANNELS = (SONOS, LAMETRIC, PUSHOVER, SMS)
+NOTIFY_DEFAULT_CHANNELS = (SONOS, LAMETRIC)
+# Seconds each channel gets to deliver a message before it's reported as timed out
+NOTIFY_CHANNEL_TIMEOUTS = {SONOS: 5, LAMETRIC: 10, PUSHOVER: 30, SMS: 30}
+NOTIFY_COLLECTORS = 4 # Threads collecting the delivery results
+# Pushover's EMERGENCY priority needs retry parameters and is reserved for direct calls, so EMERGENCY
+# notifications are sent as HIGH and skip the dedup explicitly, like on the other channels
+PUSHOVER_PRIO_BY_PRIO = {
+    PRIO['LOW']: PUSHOVER_PRIO['LOW'], PRIO['MODERATE']: PUSHOVER_PRIO['NORMAL'],
+    PRIO['HIGH']: PUSHOVER_PRIO['HIGH'], PRIO['EMERGENCY']: PUSHOVER_PRIO['HIGH']
+}
+
+class Delivery(NamedTuple):
+    channel: str
+    delivered: bool
+    detail: str             # 'delivered', 'suppressed', 'rejected', 'timed out' or the error
+    elapsed_secs: float
+
+class NotifyResult(NamedTuple):
+    message: str
+    policy: NotificationPolicy
+    deliveries: Dict[str, Delivery]
+
+    @property
+    def delivered(self) -> bool:
+        '''True if at least one channel delivered the message.'''
+        return any(delivery.delivered for delivery in self.deliveries.values())
+
+    @property
+    def failed_channels(self) -> tuple:
+        '''The channels that didn't deliver the message, other than those that suppressed it as a duplicate.'''
+        return tuple(channel for channel, delivery in self.deliveries.items()
+                     if not delivery.delivered and delivery.detail != 'suppressed')
+
+def _resolved(result: bool) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _send_sonos(message: str, prio: int, policy: NotificationPolicy, keywords: dict) -> Future:
+    # The speech scheduler takes it from here, so delivered means it was accepted for playing
+    return _resolved(play_notification(message, prio, policy=policy, **keywords))
+
+def _send_lametric(message: str, prio: int, policy: NotificationPolicy, keywords: dict) -> Future:
+    return queue_notification_to_lametric(message, prio, **{'deadline': NOTIFY_CHANNEL_TIMEOUTS[LAMETRIC], **keywords, 'policy': policy})
+
+def _send_pushover(message: str, prio: int, policy: NotificationPolicy, keywords: dict) -> Future:
+    return send_pushover_message(message, **{'priority': PUSHOVER_PRIO_BY_PRIO.get(prio, PUSHOVER_PRIO['NORMAL']), **keywords,
+                                             'dedup': prio < PRIO['EMERGENCY'] and keywords.get('dedup', True)})
+
+def _send_sms(message: str, prio: int, policy: NotificationPolicy, keywords: dict) -> Future:
+    return send_sms(message, **keywords)
+
+CHANNEL_SENDERS: Dict[str, Callable[[str, int, NotificationPolicy, dict], Future]] = {
+    SONOS: _send_sonos, LAMETRIC: _send_lametric, PUSHOVER: _send_pushover, SMS: _send_sms
+}
+
+class NotificationRouter:
+    '''
+    Sends a message to several channels at once. The sound policy is evaluated once per message and shared
+    by the channels. All channels are started before any result is waited for, and each channel is waited
+    for until its own deadline only, so a slow channel doesn't hold back the others or the calling rule.
+    '''
+
+    def __init__(self, collectors: int = NOTIFY_COLLECTORS):
+        self._collector = ThreadPoolExecutor(max_workers=collectors, thread_name_prefix='NotifyCollector')
+        self.sent = 0
+        self.timeouts = 0
+        self.suppressed = 0 # Channel sends skipped as duplicates of a recent message
+        self._lock = threading.Lock()
+
+    def notify(self, message: str, prio: int = PRIO['MODERATE'], channels: Iterable[str] = NOTIFY_DEFAULT_CHANNELS,
+               timeouts: Optional[Dict[str, float]] = None, channel_keywords: Optional[Dict[str, dict]] = None) -> Future:
+        '''
+        Sends the message to the channels and returns a Future that resolves to a NotifyResult when every
+        channel has delivered, failed or timed out. channel_keywords holds extra arguments per channel, e.g.
+        {'sonos': {'tts_room': 'Köket'}, 'pushover': {'title': 'Larm'}, 'sms': {'subscriber': 'Amanda'}}.
+        '''
+        policy = NotificationPolicy.now()
+        timeouts = {**NOTIFY_CHANNEL_TIMEOUTS, **(timeouts or {})}
+        channel_keywords = channel_keywords or {}
+        start = time.monotonic()
+        pending: Dict[str, Future] = {}
+        finished_at: Dict[str, float] = {}
+        deliveries: Dict[str, Delivery] = {}
+        for channel in channels:
+            sender = CHANNEL_SENDERS.get(channel)
+            if sender is None:
+                deliveries[channel] = Delivery(channel, False, 'unknown channel', 0.0)
+                continue
+            try:
+                pending[channel] = sender(message, prio, policy, channel_keywords.get(channel, {}))
+                pending[channel].add_done_callback(lambda _, channel=channel: finished_at.setdefault(channel, time.monotonic()))
+            except Exception as e:
+                log.exception('Failed to send the message to [%s]', channel)
+                deliveries[channel] = Delivery(channel, False, str(e), time.monotonic() - start)
+        with self._lock:
+            self.sent += 1
+        return self._collector.submit(self._collect, message, policy, start, pending, finished_at, deliveries, timeouts)
+
+    def _collect(self, message: str, policy: NotificationPolicy, start: float, pending: Dict[str, Future],
+                 finished_at: Dict[str, float], deliveries: Dict[str, Delivery], timeouts: Dict[str, float]) -> NotifyResult:
+        # Waited for in the order of their deadlines; a channel's deadline counts from the start, not from the previous wait
+        for channel, future in sorted(pending.items(), key=lambda entry: timeouts.get(entry[0], 0)):
+            remaining = start + timeouts.get(channel, 0) - time.monotonic()
+            try:
+                result = future.result(timeout=max(remaining, 0))
+                if result is SUPPRESSED:
+                    delivered, detail = False, 'suppressed'
+                    with self._lock:
+                        self.suppressed += 1
+                else:
+                    delivered = bool(result)
+                    detail = 'delivered' if delivered else 'rejected'
+            except FutureTimeoutError:
+                delivered, detail = False, 'timed out'
+                with self._lock:
+                    self.timeouts += 1
+            except Exception as e:
+                delivered, detail = False, str(e)
+            deliveries[channel] = Delivery(channel, delivered, detail, finished_at.get(channel, time.monotonic()) - start)
+        result = NotifyResult(message, policy, deliveries)
+        if result.failed_channels:
+            log.warning("'%s' was not delivered to %s: %s", message, list(result.failed_channels),
+                        ', '.join(f'{channel} {deliveries[channel].detail}' for channel in result.failed_channels))
+        return result
+
+router = NotificationRouter()
+
+def notify(message: str, prio: int = PRIO['MODERATE'], channels: Iterable[str] = NOTIFY_DEFAULT_CHANNELS, **keywords) -> Future:
+    '''
+    Sends a notification to several channels concurrently: 'sonos', 'lametric', 'pushover' and 'sms'.
+    Example: notify("Tvättmaskinen är klar")
+    Example: notify("Inbrottslarm!", PRIO['EMERGENCY'], channels=('sonos', 'pushover', 'sms'))
+    Keywords are passed on as router.notify() arguments: timeouts and channel_keywords.
+    Returns a Future that resolves to a NotifyResult with the delivery of each channel.
+    '''
+    return router.notify(message, prio, channels, **keywords)
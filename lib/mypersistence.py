@@ -0,0 +1,109 @@
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from HABApp.openhab.items import OpenhabItem
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.mypersistence')
+log.setLevel(logging.INFO)
+
+class CachedSeries:
+    '''
+    The persisted values of one item within a sliding time window, oldest first.
+    A running sum is kept so that the average of the whole window is available without iterating.
+    '''
+    __slots__ = ('window', 'timestamps', 'values', 'last_end', '_sum', '_lock')
+
+    def __init__(self, window: timedelta):
+        self.window = window
+        self.timestamps = deque()
+        self.values = deque()
+        self.last_end: Optional[datetime] = None
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def extend(self, data: Dict[float, float], end: datetime):
+        '''Appends the persisted values newer than the ones already cached and evicts the ones outside the window.'''
+        last_timestamp = self.timestamps[-1] if self.timestamps else float('-inf')
+        for timestamp in sorted(data):
+            value = data[timestamp]
+            if timestamp > last_timestamp and isinstance(value, (int, float)):
+                self.timestamps.append(timestamp)
+                self.values.append(value)
+                self._sum += value
+        oldest = (end - self.window).timestamp()
+        while self.timestamps and self.timestamps[0] < oldest:
+            self.timestamps.popleft()
+            self._sum -= self.values.popleft()
+        self.last_end = end
+
+    def _values(self, window: Optional[timedelta]):
+        if window is None or window >= self.window:
+            return self.values
+        oldest = (self.last_end - window).timestamp()
+        return [value for timestamp, value in zip(self.timestamps, self.values) if timestamp >= oldest]
+
+    def average(self, window: Optional[timedelta] = None) -> Optional[float]:
+        with self._lock:
+            if window is None or window >= self.window:
+                return self._sum / len(self.values) if self.values else None
+            values = self._values(window)
+            return sum(values) / len(values) if values else None
+
+    def min(self, window: Optional[timedelta] = None) -> Optional[float]:
+        with self._lock:
+            values = self._values(window)
+            return min(values) if values else None
+
+    def max(self, window: Optional[timedelta] = None) -> Optional[float]:
+        with self._lock:
+            values = self._values(window)
+            return max(values) if values else None
+
+class PersistenceCache:
+    '''
+    Caches persisted item values so that repeated queries over the same window only fetch what is new since
+    the previous query. The cache is shared by all rules: a query for a window that is shorter than the one
+    already cached for the item is served from the cached values.
+    '''
+
+    def __init__(self):
+        self._series: Dict[str, CachedSeries] = {}
+        self._lock = threading.Lock()
+
+    def series(self, item: OpenhabItem, window: timedelta) -> CachedSeries:
+        '''Returns the cached series of the item, updated up to now.'''
+        with self._lock:
+            series = self._series.get(item.name)
+            if series is None or series.window < window:
+                series = CachedSeries(window)
+                self._series[item.name] = series
+        with series._lock:
+            end = datetime.now()
+            start = series.last_end if series.last_end is not None else end - series.window
+            persistence_data = item.get_persistence_data(start_time=start, end_time=end)
+            series.extend(persistence_data.data, end)
+            log.debug('Fetched %d values for [%s] since %s, %d cached', len(persistence_data.data), item.name, start, len(series.values))
+        return series
+
+    def average(self, item: OpenhabItem, window: timedelta) -> Optional[float]:
+        return self.series(item, window).average(window)
+
+    def min(self, item: OpenhabItem, window: timedelta) -> Optional[float]:
+        return self.series(item, window).min(window)
+
+    def max(self, item: OpenhabItem, window: timedelta) -> Optional[float]:
+        return self.series(item, window).max(window)
+
+    def invalidate(self, item_name: Optional[str] = None):
+        '''Drops the cached values of one item, or of all items.'''
+        with self._lock:
+            if item_name is None:
+                self._series.clear()
+            else:
+                self._series.pop(item_name, None)
+
+persistence_cache = PersistenceCache()
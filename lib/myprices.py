@@ -0,0 +1,345 @@
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import requests
+from myconfig import EntsoeConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.myprices')
+log.setLevel(logging.INFO)
+
+PRICE_STORE_DAYS = 7        # Days of prices kept in the store, counting back from today
+PRICE_WINDOW_MAX_HOURS = 24 # The longest window the cheapest window index is built for
+PRICE_RETRY_SECS = 900      # Seconds between fetches while tomorrow's prices haven't been published
+ENTSOE_URL = 'https://web-api.tp.entsoe.eu/api'
+ENTSOE_TIMEOUT = 30
+# The EIC code of each bidding zone by country code and area
+ENTSOE_BIDDING_ZONES = {
+    ('SE', 1): '10Y1001A1001A44P', ('SE', 2): '10Y1001A1001A45N', ('SE', 3): '10Y1001A1001A46L', ('SE', 4): '10Y1001A1001A47J',
+    ('NO', 1): '10YNO-1--------2', ('NO', 2): '10YNO-2--------T', ('NO', 3): '10YNO-3--------J', ('NO', 4): '10YNO-4--------9',
+    ('NO', 5): '10Y1001A1001A48H', ('DK', 1): '10YDK-1--------W', ('DK', 2): '10YDK-2--------M', ('FI', 1): '10YFI-1--------U'
+}
+PRICE_RECORD = np.dtype([('hour', '<i8'), ('price', '<f4')]) # Hours since the epoch (UTC) and the price in EUR/MWh
+
+def epoch_hour(when: datetime) -> int:
+    '''The hour since the epoch that the time is in. Naive times are local time.'''
+    return int(when.timestamp() // 3600)
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, time())
+
+class PriceWindow(NamedTuple):
+    start: datetime
+    hours: int
+    average: float
+
+class PriceIndex:
+    '''
+    The hourly prices as one contiguous array from the first stored hour, with missing hours as NaN, and the
+    tables that answer the queries without scanning the prices:
+    - the prefix sums give the sum of any window in O(1),
+    - a sparse table per window length gives the cheapest window starting within any range of hours in O(1),
+    - the percentile of each hour within its day is precomputed.
+    The index is immutable and rebuilt when the store changes, so readers never need a lock.
+    '''
+
+    def __init__(self, first_hour: int, prices: np.ndarray, max_hours: int = PRICE_WINDOW_MAX_HOURS):
+        self.first_hour = first_hour
+        self.prices = prices
+        valid = ~np.isnan(prices)
+        self._sums = np.concatenate(([0.0], np.cumsum(np.where(valid, prices, 0.0))))
+        self._counts = np.concatenate(([0], np.cumsum(valid)))
+        self._window_sums: List[np.ndarray] = [np.empty(0)] # By window length
+        self._tables: List[List[np.ndarray]] = [[]]
+        for hours in range(1, min(max_hours, len(prices)) + 1):
+            sums = self._sums[hours:] - self._sums[:-hours]
+            sums[self._counts[hours:] - self._counts[:-hours] < hours] = np.inf # Windows with missing hours never win
+            self._window_sums.append(sums)
+            self._tables.append(self._sparse_table(sums))
+        self._percentiles = self._day_percentiles(prices, valid)
+
+    @classmethod
+    def from_records(cls, records: np.ndarray) -> 'PriceIndex':
+        if not len(records):
+            return cls(0, np.empty(0))
+        first_hour = int(records['hour'][0])
+        prices = np.full(int(records['hour'][-1]) - first_hour + 1, np.nan)
+        prices[records['hour'] - first_hour] = records['price']
+        return cls(first_hour, prices)
+
+    @staticmethod
+    def _sparse_table(sums: np.ndarray) -> List[np.ndarray]:
+        '''Level k holds the start of the cheapest window among the 2**k windows starting at each position.'''
+        levels = [np.arange(len(sums))]
+        span = 1
+        while span * 2 <= len(sums):
+            previous = levels[-1]
+            left, right = previous[:-span], previous[span:]
+            levels.append(np.where(sums[right] < sums[left], right, left)) # The earlier window wins a tie
+            span *= 2
+        return levels
+
+    def _day_percentiles(self, prices: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        days = np.array([datetime.fromtimestamp((self.first_hour + slot) * 3600).toordinal() for slot in range(len(prices))], dtype=np.int64)
+        percentiles = np.full(len(prices), np.nan)
+        for day in np.unique(days):
+            slots = np.flatnonzero((days == day) & valid)
+            if len(slots) < 2:
+                continue
+            ordered = np.sort(prices[slots])
+            # Ties share the average of their ranks
+            ranks = (np.searchsorted(ordered, prices[slots], 'left') + np.searchsorted(ordered, prices[slots], 'right') - 1) / 2
+            percentiles[slots] = 100 * ranks / (len(slots) - 1)
+        return percentiles
+
+    def _slot(self, hour: int) -> Optional[int]:
+        slot = hour - self.first_hour
+        return slot if 0 <= slot < len(self.prices) else None
+
+    def price_at(self, when: datetime) -> Optional[float]:
+        slot = self._slot(epoch_hour(when))
+        return None if slot is None or np.isnan(self.prices[slot]) else float(self.prices[slot])
+
+    def percentile(self, when: datetime) -> Optional[float]:
+        '''The percentile (0 = cheapest, 100 = most expensive) of the price of the hour among the hours of its day.'''
+        slot = self._slot(epoch_hour(when))
+        return None if slot is None or np.isnan(self._percentiles[slot]) else float(self._percentiles[slot])
+
+    def hours(self, start_hour: int, count: int) -> np.ndarray:
+        '''The prices of count hours from the given hour since the epoch, NaN where they aren't known.'''
+        prices = np.full(count, np.nan)
+        offset = start_hour - self.first_hour
+        first, last = max(offset, 0), min(offset + count, len(self.prices))
+        if first < last:
+            prices[first - offset:last - offset] = self.prices[first:last]
+        return prices
+
+    @property
+    def last_hour(self) -> Optional[int]:
+        return self.first_hour + len(self.prices) - 1 if len(self.prices) else None
+
+    def has_hours(self, start: datetime, end: datetime) -> bool:
+        '''True if the prices of all hours from start until end are known.'''
+        first, last = epoch_hour(start) - self.first_hour, epoch_hour(end) - self.first_hour
+        return 0 <= first <= last <= len(self.prices) and self._counts[last] - self._counts[first] == last - first
+
+    def average(self, start: datetime, hours: int) -> Optional[float]:
+        first = epoch_hour(start) - self.first_hour
+        if first < 0 or first + hours > len(self.prices) or self._counts[first + hours] - self._counts[first] < hours:
+            return None
+        return float(self._sums[first + hours] - self._sums[first]) / hours
+
+    def cheapest_window(self, hours: int, after: datetime, before: datetime) -> Optional[PriceWindow]:
+        '''The cheapest window of whole hours that starts at or after after and ends at or before before.'''
+        if not 0 < hours < len(self._tables):
+            return None
+        first = max(-(-int(after.timestamp()) // 3600) - self.first_hour, 0) # The first whole hour
+        last = min(epoch_hour(before) - hours - self.first_hour, len(self._window_sums[hours]) - 1)
+        if first > last:
+            return None
+        sums, levels = self._window_sums[hours], self._tables[hours]
+        level = (last - first + 1).bit_length() - 1
+        left, right = levels[level][first], levels[level][last - (1 << level) + 1]
+        best = right if sums[right] < sums[left] else left
+        if np.isinf(sums[best]):
+            return None
+        start = datetime.fromtimestamp((self.first_hour + int(best)) * 3600)
+        return PriceWindow(start, hours, float(sums[best]) / hours)
+
+def parse_day_ahead_prices(document: str) -> Dict[int, float]:
+    '''
+    Returns the prices of an ENTSO-E publication document (A44) by hours since the epoch.
+    Prices with a shorter resolution than an hour are averaged to hours, and positions left out of a period
+    (they repeat the previous price) are filled in.
+    '''
+    def local_name(element: ET.Element) -> str:
+        return element.tag.rpartition('}')[2]
+
+    def child(element: ET.Element, name: str) -> Optional[ET.Element]:
+        return next((sub for sub in element if local_name(sub) == name), None)
+
+    sums: Dict[int, float] = {}
+    counts: Dict[int, int] = {}
+    root = ET.fromstring(document)
+    if local_name(root) == 'Acknowledgement_MarketDocument':
+        reason = next((element.text for element in root.iter() if local_name(element) == 'text'), 'no reason given')
+        raise ValueError(f'No prices in the response: {reason}')
+    for period in (element for element in root.iter() if local_name(element) == 'Period'):
+        interval = child(period, 'timeInterval')
+        start = datetime.strptime(child(interval, 'start').text, '%Y-%m-%dT%H:%MZ').replace(tzinfo=timezone.utc)
+        end = datetime.strptime(child(interval, 'end').text, '%Y-%m-%dT%H:%MZ').replace(tzinfo=timezone.utc)
+        minutes = int(child(period, 'resolution').text.strip('PTM'))
+        positions = np.full(int((end - start).total_seconds() // 60 // minutes), np.nan)
+        for point in (sub for sub in period if local_name(sub) == 'Point'):
+            positions[int(child(point, 'position').text) - 1] = float(child(point, 'price.amount').text)
+        for position, price in enumerate(positions):
+            if np.isnan(price) and position:
+                price = positions[position] = positions[position - 1]
+            if not np.isnan(price):
+                hour = epoch_hour(start + timedelta(minutes=position * minutes))
+                sums[hour] = sums.get(hour, 0.0) + price
+                counts[hour] = counts.get(hour, 0) + 1
+    return {hour: sums[hour] / counts[hour] for hour in sums}
+
+class DayAheadPriceStore:
+    '''
+    Keeps the day-ahead prices of the last few days and tomorrow in a compact array of (hour, price) records,
+    saved to a file that is memory mapped when HABApp starts, so a restart doesn't refetch the prices.
+    The prices are only fetched from ENTSO-E when today's are missing, or after tomorrow's are due to arrive
+    and they are missing. Queries are answered from a PriceIndex built when the prices change.
+    '''
+
+    def __init__(self, entsoe: EntsoeConfig):
+        self.session = requests.Session()
+        self.fetches = 0
+        self._lock = threading.Lock()
+        self._records = np.empty(0, dtype=PRICE_RECORD)
+        self._index = PriceIndex.from_records(self._records)
+        self._subscribers: List[Callable[[PriceIndex], None]] = []
+        self.configure(entsoe)
+        self.load()
+
+    def configure(self, entsoe: EntsoeConfig):
+        self.entsoe = entsoe
+        # A relative file is kept in the HABApp configuration folder
+        self.path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), entsoe.store_file)
+
+    def on_config_changed(self, old: EntsoeConfig, new: EntsoeConfig):
+        self.configure(new)
+        if old.store_file != new.store_file or (old.country_code, old.area) != (new.country_code, new.area):
+            self.load()
+
+    @property
+    def index(self) -> PriceIndex:
+        return self._index
+
+    def subscribe(self, callback: Callable[[PriceIndex], None]):
+        '''Calls callback(new index) when the stored prices have changed.'''
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[PriceIndex], None]):
+        '''Stops calling a callback passed to subscribe(), e.g. when the rule that subscribed it is removed.'''
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def _notify(self):
+        for callback in self._subscribers:
+            try:
+                callback(self._index)
+            except Exception:
+                log.exception('Failed to notify a subscriber of the day-ahead prices')
+
+    def load(self) -> int:
+        '''Maps the stored prices, if any. Returns the number of hours loaded.'''
+        records = np.empty(0, dtype=PRICE_RECORD)
+        if os.path.exists(self.path):
+            try:
+                records = np.load(self.path, mmap_mode='r')
+                if records.dtype != PRICE_RECORD:
+                    raise ValueError(f'unexpected records {records.dtype}')
+            except Exception as e:
+                log.error('Ignoring the stored day-ahead prices in [%s]: %s', self.path, e)
+                records = np.empty(0, dtype=PRICE_RECORD)
+        with self._lock:
+            self._records = records
+            self._index = PriceIndex.from_records(records)
+        self._notify()
+        log.debug('Loaded %d hours of day-ahead prices from [%s]', len(records), self.path)
+        return len(records)
+
+    def arrival_time(self, day: date) -> datetime:
+        '''The time the prices of the day after the given day are normally published.'''
+        return datetime.combine(day, time(self.entsoe.arrive_time_hour, self.entsoe.arrive_time_minute))
+
+    def has_prices_for(self, day: date) -> bool:
+        return self._index.has_hours(_midnight(day), _midnight(day + timedelta(days=1)))
+
+    def needs_refresh(self, now: Optional[datetime] = None) -> bool:
+        now = now or datetime.now()
+        today = now.date()
+        if not self.has_prices_for(today):
+            return True
+        return now >= self.arrival_time(today) and not self.has_prices_for(today + timedelta(days=1))
+
+    def next_refresh_time(self, now: Optional[datetime] = None) -> datetime:
+        '''The time the prices should be fetched next, now if they are due.'''
+        now = now or datetime.now()
+        if self.needs_refresh(now):
+            return now
+        if self.has_prices_for(now.date() + timedelta(days=1)):
+            return self.arrival_time(now.date() + timedelta(days=1))
+        return self.arrival_time(now.date())
+
+    def refresh(self, now: Optional[datetime] = None) -> bool:
+        '''Fetches the missing prices if they are due. Returns True if no more prices are due.'''
+        now = now or datetime.now()
+        if not self.needs_refresh(now):
+            return True
+        if not self.entsoe.api_key:
+            log.debug('No ENTSO-E API key is configured, so no day-ahead prices are fetched')
+            return True
+        today = now.date()
+        start = today if not self.has_prices_for(today) else today + timedelta(days=1)
+        try:
+            prices = self.fetch(_midnight(start), _midnight(today + timedelta(days=2)))
+        except Exception as e:
+            log.warning('Failed to fetch the day-ahead prices from %s: %s', start, e)
+            return False
+        self.store(prices, now)
+        log.info('Fetched %d hours of day-ahead prices from %s', len(prices), start)
+        return not self.needs_refresh(now)
+
+    def fetch(self, start: datetime, end: datetime) -> Dict[int, float]:
+        '''Fetches the day-ahead prices from start until end from ENTSO-E.'''
+        zone = ENTSOE_BIDDING_ZONES[(self.entsoe.country_code, self.entsoe.area)]
+        api_time_zone = ZoneInfo(self.entsoe.api_time_tzinfo)
+        response = self.session.get(ENTSOE_URL, timeout=ENTSOE_TIMEOUT, params={
+            'securityToken': self.entsoe.api_key, 'documentType': 'A44', 'in_Domain': zone, 'out_Domain': zone,
+            'periodStart': start.astimezone(api_time_zone).strftime('%Y%m%d%H%M'),
+            'periodEnd': end.astimezone(api_time_zone).strftime('%Y%m%d%H%M')
+        })
+        self.fetches += 1
+        response.raise_for_status()
+        return parse_day_ahead_prices(response.text)
+
+    def store(self, prices: Dict[int, float], now: Optional[datetime] = None):
+        '''Merges the prices into the store, drops the hours older than PRICE_STORE_DAYS and saves the file.'''
+        oldest = epoch_hour(_midnight((now or datetime.now()).date() - timedelta(days=PRICE_STORE_DAYS)))
+        with self._lock:
+            merged = {int(hour): float(price) for hour, price in zip(self._records['hour'], self._records['price']) if hour >= oldest}
+            merged.update((hour, price) for hour, price in prices.items() if hour >= oldest)
+            records = np.array(sorted(merged.items()), dtype=PRICE_RECORD)
+            try:
+                temporary = f'{self.path}.tmp.npy'
+                np.save(temporary, records)
+                os.replace(temporary, self.path)
+                records = np.load(self.path, mmap_mode='r')
+            except OSError as e:
+                log.error('Failed to save the day-ahead prices to [%s]: %s', self.path, e)
+            self._records = records
+            self._index = PriceIndex.from_records(records)
+        self._notify()
+
+    def price_at(self, when: Optional[datetime] = None) -> Optional[float]:
+        '''The price in EUR/MWh of the hour, None if it isn't known.'''
+        return self._index.price_at(when or datetime.now())
+
+    def percentile(self, when: Optional[datetime] = None) -> Optional[float]:
+        '''The percentile of the price of the hour among the hours of its day, e.g. 0 for the cheapest hour.'''
+        return self._index.percentile(when or datetime.now())
+
+    def cheapest_window(self, hours: int, before: datetime, after: Optional[datetime] = None) -> Optional[PriceWindow]:
+        '''
+        The cheapest contiguous hours that end before the given time, starting from the next whole hour.
+        Example: price_store.cheapest_window(3, datetime.combine(tomorrow, time(7))) for the cheapest three hours before 07:00
+        Returns None if no window of known prices fits.
+        '''
+        return self._index.cheapest_window(hours, after or datetime.now(), before)
+
+price_store = DayAheadPriceStore(config.entsoe)
+config.subscribe('entsoe', price_store.on_config_changed)
@@ -1,13 +1,166 @@
+import logging
 import threading
+import time
+from collections import deque
+from concurrent.futures import Future
 from pushover import Client, Message
-from HABApp import DictParameter
+from myconfig import config
+from mydedup import notification_dedup, suppressed
 
-configuration = DictParameter('my_config', 'configuration', default_value=None).value
-pushover_configuration = configuration["pushover"]
-PUSHOVER_PRIO = configuration["pushover"]["PUSHOVER_PRIO"]
-PUSHOVER_DEF_DEV = configuration["pushover"]["PUSHOVER_DEF_DEV"]
+PUSHOVER_PRIO = config.pushover.prio
+PUSHOVER_DEF_DEV = config.pushover.default_device
 
-client = Client(pushover_configuration["user_token"], pushover_configuration["api_token"])
+log = logging.getLogger(f'{config.system.logger_name}.mypushover')
+log.setLevel(logging.INFO)
+
+OVERFLOW_POLICIES = ('drop-oldest', 'block', 'merge')
+PUSHOVER_WORKERS = config.pushover.workers
+PUSHOVER_QUEUE_SIZE = config.pushover.queue_size
+PUSHOVER_OVERFLOW_POLICY = config.pushover.overflow_policy
+PUSHOVER_RETRIES = 3         # Additional attempts after the first failed one
+PUSHOVER_RETRY_BACKOFF = 2   # Seconds to wait before the first retry, doubled for each retry
+PUSHOVER_MESSAGE_MAX = 1024  # Max characters of a message, Pushover rejects longer ones
+
+client = Client(config.pushover.user_token, config.pushover.api_token)
+
+def _resolve(future: Future, result: bool):
+    if not future.done():
+        future.set_result(result)
+
+class _PendingMessage:
+    __slots__ = ('message', 'title', 'device', 'priority', 'url', 'url_title', 'future', 'queued_at')
+
+    def __init__(self, message, title, device, priority, url, url_title):
+        self.message = message
+        self.title = title
+        self.device = device
+        self.priority = priority
+        self.url = url
+        self.url_title = url_title
+        self.future = Future()
+        self.queued_at = time.monotonic()
+
+    def can_merge(self, other: '_PendingMessage') -> bool:
+        return (self.title, self.device, self.priority, self.url) == (other.title, other.device, other.priority, other.url)
+
+class PushoverDispatcher:
+    '''
+    Sends Pushover messages from a fixed number of worker threads.
+    Messages wait in a bounded queue. When the queue is full the overflow policy decides what happens:
+    'drop-oldest' discards the oldest waiting message, 'block' makes the caller wait for a free slot and
+    'merge' appends the text to a waiting message with the same title, device and priority, cut at
+    PUSHOVER_MESSAGE_MAX characters (falling back to 'drop-oldest' when there is nothing with room to merge with).
+    '''
+
+    def __init__(self, pushover_client: Client, workers: int = PUSHOVER_WORKERS, queue_size: int = PUSHOVER_QUEUE_SIZE, overflow_policy: str = PUSHOVER_OVERFLOW_POLICY):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy [{overflow_policy}], expected one of {OVERFLOW_POLICIES}')
+        self.client = pushover_client
+        self.queue_size = queue_size
+        self.overflow_policy = overflow_policy
+        self._pending = deque()
+        self._condition = threading.Condition()
+        self._stats_lock = threading.Lock() # The counters updated by the workers
+        self.sent = 0
+        self.failures = 0
+        self.retries = 0
+        self.dropped = 0
+        self.merged = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f'Pushover-{i}', daemon=True).start()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def average_latency(self) -> float:
+        return self._total_latency / self.sent if self.sent else 0.0
+
+    def stats(self) -> dict:
+        '''Returns a snapshot of the dispatcher counters. Latencies are in seconds, from queuing until delivered.'''
+        with self._condition, self._stats_lock:
+            return {
+                'queue_depth': self.queue_depth, 'sent': self.sent, 'failures': self.failures, 'retries': self.retries,
+                'dropped': self.dropped, 'merged': self.merged, 'last_latency': self.last_latency,
+                'average_latency': self.average_latency, 'max_latency': self.max_latency
+            }
+
+    def submit(self, message, title, device, priority, url=None, url_title=None) -> Future:
+        '''
+        Queues a message for sending. Returns a Future that resolves to True when Pushover accepted the message,
+        or False if it was dropped or failed after all retries.
+        '''
+        pending = _PendingMessage(message, title, device, priority, url, url_title)
+        with self._condition:
+            if len(self._pending) >= self.queue_size:
+                if self.overflow_policy == 'block':
+                    self._condition.wait_for(lambda: len(self._pending) < self.queue_size)
+                elif self.overflow_policy == 'merge' and self._merge(pending):
+                    return pending.future
+                else:
+                    self._drop_oldest()
+            self._pending.append(pending)
+            self._condition.notify_all()
+        return pending.future
+
+    def _merge(self, pending: _PendingMessage) -> bool:
+        for waiting in reversed(self._pending):
+            if waiting.can_merge(pending) and len(waiting.message) < PUSHOVER_MESSAGE_MAX:
+                merged = f'{waiting.message}\n{pending.message}'
+                waiting.message = merged if len(merged) <= PUSHOVER_MESSAGE_MAX else merged[:PUSHOVER_MESSAGE_MAX - 1] + '…'
+                self.merged += 1
+                # The merged message is delivered together with the waiting one
+                waiting.future.add_done_callback(lambda f: _resolve(pending.future, not f.cancelled() and f.result()))
+                return True
+        return False
+
+    def _drop_oldest(self):
+        oldest = self._pending.popleft()
+        self.dropped += 1
+        log.warning("The Pushover queue is full, dropping the oldest message: '%s'", oldest.message)
+        _resolve(oldest.future, False)
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                pending = self._pending.popleft()
+                self._condition.notify_all()
+            if pending.future.set_running_or_notify_cancel():
+                pending.future.set_result(self._send(pending))
+
+    def _send(self, pending: _PendingMessage) -> bool:
+        backoff = PUSHOVER_RETRY_BACKOFF
+        for attempt in range(PUSHOVER_RETRIES + 1):
+            if attempt:
+                with self._stats_lock:
+                    self.retries += 1
+                time.sleep(backoff)
+                backoff *= 2
+            msg = Message(pending.message, title=pending.title, device=pending.device, priority=pending.priority, url=pending.url, url_title=pending.url_title)
+            try:
+                self.client.send(msg)
+            except Exception as e:
+                log.warning("Failed to send Pushover message (attempt %d of %d): %s", attempt + 1, PUSHOVER_RETRIES + 1, e)
+                continue
+            latency = time.monotonic() - pending.queued_at
+            with self._stats_lock:
+                self.sent += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self._total_latency += latency
+            return True
+        with self._stats_lock:
+            self.failures += 1
+        log.error("Giving up sending Pushover message: '%s'", pending.message)
+        return False
+
+dispatcher = PushoverDispatcher(client)
+notification_dedup.register_summary_sender('pushover', lambda summary, context: dispatcher.submit(summary, *context))
 
 def send_pushover_message(
     message,
@@ -16,11 +169,16 @@ def send_pushover_message(
     priority=PUSHOVER_PRIO['NORMAL'],
     url=None,
     url_title=None,
+    dedup=True,
     **keywords
 ):
     """
-    Sends a Pushover notification using threading to prevent the script from taking too long.
+    Sends a Pushover notification in the background through the dispatcher.
+    Messages similar to one sent within the dedup window are collapsed into a summary, except EMERGENCY ones
+    and those sent with dedup=False.
+    Returns a Future that resolves to True when the message was delivered, or to SUPPRESSED, which is falsy, when it was collapsed.
+    It can be waited for or ignored.
     """
-    msg = Message(message, title=title, device=device, priority=priority, url=url, url_title=url_title)
-    threading.Timer(0, client.send, [msg]).start()
-    return True  # if r.status_code == 200 else False
+    if dedup and priority < PUSHOVER_PRIO['EMERGENCY'] and not notification_dedup.admit('pushover', message, (title, device, priority, url, url_title)):
+        return suppressed()
+    return dispatcher.submit(message, title, device, priority, url, url_title)
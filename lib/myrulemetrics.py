@@ -0,0 +1,287 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from datetime import time as dt_time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from HABApp.core.errors import ItemNotFoundException
+from HABApp.core.events import ValueChangeEvent, ValueUpdateEvent
+from HABApp.core.items import BaseValueItem
+from HABApp.openhab.items import StringItem
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.myrulemetrics')
+log.setLevel(logging.INFO)
+
+# Histogram bucket upper bounds in seconds, the same as the Prometheus client defaults plus two finer ones
+RULE_METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RULE_METRICS_EXPORT_INTERVAL = 60 # Seconds between the exports
+RULE_METRICS_SUMMARY_SIZE = 5 # Number of callbacks, slowest first, in the summary posted to the metrics item
+
+# The scheduler methods whose callbacks are timed, and the positional index of their callback argument
+SCHEDULER_CALLBACK_INDEX = {
+    'soon': 0, 'at': 1, 'every': 2, 'countdown': 1, 'every_minute': 0, 'every_hour': 0,
+    'on_sunrise': 0, 'on_sunset': 0, 'on_sun_dawn': 0, 'on_sun_dusk': 0
+}
+
+class Histogram:
+    '''Counts observations in the RULE_METRICS_BUCKETS buckets. Not thread safe by itself.'''
+    __slots__ = ('counts', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(RULE_METRICS_BUCKETS) + 1) # The last bucket is +Inf
+        self.sum = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(RULE_METRICS_BUCKETS, value)] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction: float) -> float:
+        '''Returns the upper bound of the bucket that holds the quantile, or the max for the +Inf bucket.'''
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, count in zip(RULE_METRICS_BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative:
+                return min(bound, self.max)
+        return self.max
+
+class CallbackMetrics:
+    '''The duration, queue wait and exception count of one callback of one rule.'''
+    __slots__ = ('rule', 'callback', 'duration', 'wait', 'exceptions', '_lock')
+
+    def __init__(self, rule: str, callback: str):
+        self.rule = rule
+        self.callback = callback
+        self.duration = Histogram()
+        self.wait = Histogram()
+        self.exceptions = 0
+        self._lock = threading.Lock()
+
+    def record(self, wait: Optional[float], duration: float, failed: bool):
+        with self._lock:
+            self.duration.observe(duration)
+            if wait is not None:
+                self.wait.observe(max(wait, 0.0))
+            if failed:
+                self.exceptions += 1
+
+class RuleMetrics:
+    '''
+    Collects the metrics of the callbacks wrapped by RuleMetricsMixin, and exports them as a Prometheus text
+    file and as a summary of the slowest callbacks to an openHAB item. The number of callbacks running at the
+    same time is tracked too: when it stays at the size of HABApp's thread pool, rules are starving it.
+    '''
+
+    def __init__(self):
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._metrics: Dict[Tuple[str, str], CallbackMetrics] = {}
+        self._lock = threading.Lock()
+
+    def get(self, rule: str, callback: str) -> CallbackMetrics:
+        key = (rule, callback)
+        metrics = self._metrics.get(key)
+        if metrics is None:
+            with self._lock:
+                metrics = self._metrics.setdefault(key, CallbackMetrics(rule, callback))
+        return metrics
+
+    def all(self) -> List[CallbackMetrics]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def wrap(self, rule: str, callback: Callable, due: Callable[..., Optional[float]]) -> Callable:
+        '''
+        Returns callback wrapped so that each call is recorded. due is called with the arguments of the call and
+        returns the timestamp when the call became due, or None when that isn't known.
+        '''
+        metrics = self.get(rule, getattr(callback, '__name__', repr(callback)))
+
+        @wraps(callback)
+        def timed(*args, **kwargs):
+            try:
+                due_timestamp = due(*args, **kwargs)
+                wait = None if due_timestamp is None else datetime.now().timestamp() - due_timestamp
+            except Exception:
+                wait = None
+            with self._lock:
+                self.in_flight += 1
+                if self.in_flight > self.max_in_flight:
+                    self.max_in_flight = self.in_flight
+            failed = False
+            start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                metrics.record(wait, time.perf_counter() - start, failed)
+                with self._lock:
+                    self.in_flight -= 1
+        return timed
+
+    def prometheus_text(self) -> str:
+        lines = []
+        all_metrics = sorted(self.all(), key=lambda metrics: (metrics.rule, metrics.callback))
+        for name, attribute, help_text in (
+            ('habapp_rule_callback_duration_seconds', 'duration', 'Time spent running rule callbacks.'),
+            ('habapp_rule_callback_wait_seconds', 'wait', 'Time rule callbacks waited to run after they became due.')
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+            for metrics in all_metrics:
+                labels = f'rule="{metrics.rule}",callback="{metrics.callback}"'
+                with metrics._lock:
+                    histogram = getattr(metrics, attribute)
+                    cumulative = 0
+                    for bound, count in zip(RULE_METRICS_BUCKETS + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+                    lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        lines += ['# HELP habapp_rule_callback_exceptions_total Exceptions raised by rule callbacks.',
+                  '# TYPE habapp_rule_callback_exceptions_total counter']
+        for metrics in all_metrics:
+            lines.append(f'habapp_rule_callback_exceptions_total{{rule="{metrics.rule}",callback="{metrics.callback}"}} {metrics.exceptions}')
+        lines += ['# HELP habapp_rule_callbacks_in_flight Rule callbacks running right now.',
+                  '# TYPE habapp_rule_callbacks_in_flight gauge',
+                  f'habapp_rule_callbacks_in_flight {self.in_flight}',
+                  '# HELP habapp_rule_callbacks_in_flight_max The most rule callbacks that have been running at the same time.',
+                  '# TYPE habapp_rule_callbacks_in_flight_max gauge',
+                  f'habapp_rule_callbacks_in_flight_max {self.max_in_flight}']
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        '''The slowest callbacks by their 95th percentile duration, e.g. "HumControl.process_changes p95 2.5 ms wait 1.0 ms (12)"'''
+        def describe(metrics: CallbackMetrics) -> str:
+            with metrics._lock:
+                text = f'{metrics.rule}.{metrics.callback} p95 {metrics.duration.quantile(0.95) * 1000:.1f} ms'
+                if metrics.wait.count:
+                    text += f' wait {metrics.wait.quantile(0.95) * 1000:.1f} ms'
+                return text + f' ({metrics.duration.count}{f", {metrics.exceptions} failed" if metrics.exceptions else ""})'
+
+        slowest = sorted(self.all(), key=lambda metrics: metrics.duration.quantile(0.95), reverse=True)[:RULE_METRICS_SUMMARY_SIZE]
+        return '; '.join([describe(metrics) for metrics in slowest] + [f'max in flight {self.max_in_flight}'])
+
+    def export(self):
+        '''Writes the Prometheus text file and posts the summary to the metrics item, when they are configured.'''
+        metrics_file = config.system.metrics_file
+        if metrics_file:
+            # Written to a temporary file first, so that the collector never reads a partial file
+            temporary_file = f'{metrics_file}.tmp'
+            try:
+                with open(temporary_file, 'w', encoding='utf-8') as file:
+                    file.write(self.prometheus_text())
+                os.replace(temporary_file, metrics_file)
+            except OSError as e:
+                log.error('Failed to write the rule metrics to [%s]: %s', metrics_file, e)
+        metrics_item = config.system.metrics_item
+        if metrics_item:
+            try:
+                StringItem.get_item(metrics_item).oh_post_update(self.summary())
+            except ItemNotFoundException:
+                log.debug('The rule metrics item [%s] does not exist', metrics_item)
+
+rule_metrics = RuleMetrics()
+
+def _timestamp(when: Any) -> float:
+    '''Converts the time argument of a scheduler method to a timestamp.'''
+    now = datetime.now()
+    if when is None:
+        return now.timestamp()
+    if isinstance(when, (int, float)):
+        return now.timestamp() + when
+    if isinstance(when, timedelta):
+        return (now + when).timestamp()
+    if isinstance(when, dt_time):
+        at = datetime.combine(date.today(), when)
+        return (at if at >= now else at + timedelta(days=1)).timestamp()
+    return when.timestamp()
+
+def _periodic_due(start: float, interval: float) -> Callable[..., float]:
+    '''Returns the due timestamp of each run of a job that starts at start and repeats every interval seconds.'''
+    next_due = [start]
+
+    def due(*args, **kwargs) -> float:
+        now = datetime.now().timestamp()
+        expected = next_due[0]
+        if now - expected >= interval:
+            # Runs that were skipped altogether aren't counted as waiting
+            expected += (now - expected) // interval * interval
+        next_due[0] = expected + interval
+        return expected
+    return due
+
+def _event_due(event=None, *args, **kwargs) -> Optional[float]:
+    '''An event is due when the item was updated or changed, just before the event was posted.'''
+    if isinstance(event, (ValueChangeEvent, ValueUpdateEvent)):
+        item = BaseValueItem.get_item(event.name)
+        return (item.last_change if isinstance(event, ValueChangeEvent) else item.last_update).timestamp()
+    return None
+
+def _unknown_due(*args, **kwargs) -> None:
+    return None
+
+class _TimedScheduler:
+    '''Stands in for the scheduler of a rule and wraps the callbacks passed to it.'''
+
+    def __init__(self, scheduler, rule_name: str):
+        self._scheduler = scheduler
+        self._rule_name = rule_name
+
+    def __getattr__(self, name: str):
+        method = getattr(self._scheduler, name)
+        index = SCHEDULER_CALLBACK_INDEX.get(name)
+        if index is None:
+            return method
+
+        @wraps(method)
+        def schedule(*args, **kwargs):
+            args = list(args)
+            if 'callback' in kwargs:
+                kwargs['callback'] = self._wrap(name, kwargs['callback'], args, kwargs)
+            elif len(args) > index:
+                args[index] = self._wrap(name, args[index], args, kwargs)
+            return method(*args, **kwargs)
+        return schedule
+
+    def _wrap(self, name: str, callback: Callable, args: list, kwargs: dict) -> Callable:
+        if name == 'soon':
+            due = _timestamp(None)
+            return rule_metrics.wrap(self._rule_name, callback, lambda *a, **k: due)
+        if name == 'at':
+            due = _timestamp(args[0] if args else kwargs.get('time'))
+            return rule_metrics.wrap(self._rule_name, callback, lambda *a, **k: due)
+        if name == 'every':
+            start = args[0] if args else kwargs.get('start_time')
+            interval = args[1] if len(args) > 1 else kwargs.get('interval')
+            interval = interval.total_seconds() if isinstance(interval, timedelta) else interval
+            return rule_metrics.wrap(self._rule_name, callback, _periodic_due(_timestamp(start), interval))
+        return rule_metrics.wrap(self._rule_name, callback, _unknown_due)
+
+class RuleMetricsMixin:
+    '''
+    Records the duration, the queue wait and the exceptions of all scheduled and event callbacks of a rule.
+    Put it before Rule in the bases: class HumControl(RuleMetricsMixin, Rule)
+    Only listeners registered with self.listen_event(item, ...) are timed, item.listen_event(...) bypasses the rule.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.run = _TimedScheduler(self.run, self.rule_name)
+
+    def listen_event(self, name, callback, event_filter=None):
+        return super().listen_event(name, rule_metrics.wrap(self.rule_name, callback, _event_due), event_filter)
@@ -1,35 +1,100 @@
 import logging
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
 from clickatell.http import Http
-from HABApp import DictParameter
+from myconfig import config
 
-configuration = DictParameter('my_config', 'configuration', default_value=None).value
-clickatell_configuration = configuration["clickatell"]
+log = logging.getLogger(f'{config.system.logger_name}.mysms')
 
-log = logging.getLogger(f'{configuration["system"]["MY_LOGGER_NAME"]}.mysms')
+SMS_MERGE_WINDOW = 2 # Seconds to wait for more recipients of the same message before sending it
+
+@lru_cache(maxsize=64)
+def encode_unicode_message(message: str) -> str:
+    '''Encodes the message as the hex string of UTF-16 code units expected by the gateway when unicode is set.'''
+    return message.encode('utf-16-be').hex().upper()
+
+class SmsOutbox:
+    '''
+    Sends SMS messages from a background thread through one reused gateway client.
+    Identical messages queued within SMS_MERGE_WINDOW seconds are sent in one request with all recipients.
+    '''
+
+    def __init__(self, gateway: Http, merge_window: float = SMS_MERGE_WINDOW):
+        self.gateway = gateway
+        self.merge_window = merge_window
+        self._pending = {} # message -> (send at, [(phone_number, future)])
+        self._condition = threading.Condition()
+        threading.Thread(target=self._worker, name='SmsOutbox', daemon=True).start()
+
+    def send(self, message: str, phone_number: str) -> Future:
+        '''Queues the message. Returns a Future that resolves to True if the gateway accepted it.'''
+        future = Future()
+        with self._condition:
+            if message not in self._pending:
+                self._pending[message] = (time.monotonic() + self.merge_window, [])
+                self._condition.notify()
+            recipients = self._pending[message][1]
+            if all(queued_number != phone_number for queued_number, _ in recipients):
+                recipients.append((phone_number, future))
+            else:
+                # Already queued for this recipient, share the result instead of sending twice
+                existing = next(f for queued_number, f in recipients if queued_number == phone_number)
+                existing.add_done_callback(lambda f: future.set_result(f.result()))
+        return future
+
+    def _next_due(self):
+        with self._condition:
+            while True:
+                if self._pending:
+                    message, (send_at, _) = min(self._pending.items(), key=lambda entry: entry[1][0])
+                    delay = send_at - time.monotonic()
+                    if delay <= 0:
+                        return message, self._pending.pop(message)[1]
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+
+    def _worker(self):
+        while True:
+            message, recipients = self._next_due()
+            phone_numbers = [phone_number for phone_number, _ in recipients]
+            log.info("Sending SMS to: %s", phone_numbers)
+            success = False
+            try:
+                response = self.gateway.sendMessage(phone_numbers, encode_unicode_message(message), extra={'from': config.clickatell.sender, 'unicode': 1})
+                success = True
+                for entry in response:
+                    log.info(entry['error'])
+                    success = success and not entry['error']
+            except Exception as e:
+                log.error("Failed to send SMS to %s: %s", phone_numbers, e)
+            for _, future in recipients:
+                future.set_result(success)
+
+outbox = SmsOutbox(Http(config.clickatell.user, config.clickatell.password, config.clickatell.apiid))
 
 def send_sms(message, subscriber='Default'):
     """
     Sends an SMS message through the ClickaTell gateway.
+    The message is sent in the background and merged with identical messages to other subscribers.
     Example: send_sms("Hello")
     Example: send_sms("Hello", 'Amanda')
-    
+
     :param message: SMS text
     :param subscriber: Subscriber. A numeric phone number or a phonebook name entry (string)
+    :return: A Future that resolves to True if the gateway accepted the message
     """
 
-    phone_number = clickatell_configuration['phonebook'].get(subscriber, None)
+    phone_number = config.clickatell.phonebook.get(subscriber, None)
     if phone_number is None:
         if subscriber.isdigit():
             phone_number = subscriber
         else:
-            log.error(f'Subscriber [{subscriber}] was not found in the phone book')
-            return
-
-    clickatell = Http(clickatell_configuration['user'], clickatell_configuration['password'], clickatell_configuration['apiid'])
-    log.info(f"Sending SMS to: [{phone_number}]")
-
-    unicode_message = ''.join(r'{:04X}'.format(ord(chr)) for chr in message)
+            log.error('Subscriber [%s] was not found in the phone book', subscriber)
+            future = Future()
+            future.set_result(False)
+            return future
 
-    response = clickatell.sendMessage([phone_number], unicode_message, extra={'from': clickatell_configuration['sender'], 'unicode': 1})
-    for entry in response:
-        log.info(entry['error'])
+    return outbox.send(message, phone_number)
@@ -0,0 +1,244 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from HABApp.core.items import Item
+from myconfig import config
+
+log = logging.getLogger(f'{config.system.logger_name}.mystartup')
+log.setLevel(logging.INFO)
+
+STARTUP_WORKERS = 4   # Components initialized at the same time
+STARTUP_TIMEOUT = 120 # Seconds to wait for the components before the report is made anyway
+STARTUP_POLL_SECS = 1  # How often the init rule checks whether the components are done
+
+class LazyComponent:
+    '''
+    Stands in for a heavy object until it's first used. The object is created on first use, once, by whichever
+    thread gets there first; the time it took is recorded on the component. Attribute access, isinstance()
+    and the common operators are passed on to the object, so consumers can treat the stand-in as the object;
+    only type() tells them apart. repr() doesn't create the object.
+    '''
+    __slots__ = ('_component', '_instance', '_lock')
+
+    def __init__(self, component: 'StartupComponent'):
+        object.__setattr__(self, '_component', component)
+        object.__setattr__(self, '_instance', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def get(self) -> Any:
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    object.__setattr__(self, '_instance', self._component.create())
+        return self._instance
+
+    @property
+    def __class__(self):
+        return type(self.get())
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self.get(), name, value)
+
+    def __delattr__(self, name: str):
+        delattr(self.get(), name)
+
+    def __dir__(self):
+        return dir(self.get())
+
+    def __repr__(self) -> str:
+        if self._instance is None:
+            return f'<LazyComponent {self._component.name}>'
+        return repr(self._instance)
+
+    def __str__(self) -> str:
+        return str(self.get())
+
+    def __eq__(self, other: Any) -> bool:
+        return self.get() == other
+
+    def __hash__(self) -> int:
+        return hash(self.get())
+
+    def __bool__(self) -> bool:
+        return bool(self.get())
+
+    def __len__(self) -> int:
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __contains__(self, value: Any) -> bool:
+        return value in self.get()
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.get()[key]
+
+    def __call__(self, *args, **kwargs) -> Any:
+        return self.get()(*args, **kwargs)
+
+class StartupComponent:
+    __slots__ = ('name', 'factory', 'depends_on', 'item_name', 'lazy', 'started', 'finished', 'error', 'published', 'skipped')
+
+    def __init__(self, name: str, factory: Callable[[], Any], depends_on: Iterable[str], item_name: Optional[str], lazy: bool):
+        self.name = name
+        self.factory = factory
+        self.depends_on = tuple(depends_on)
+        self.item_name = item_name
+        self.lazy = lazy
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self.published = False # The object, or its stand-in if lazy, has been set on its item, if it has one
+        self.skipped = False
+
+    @property
+    def done(self) -> bool:
+        return self.published or self.skipped or self.error is not None
+
+    @property
+    def ok(self) -> bool:
+        return self.published and self.error is None
+
+    @property
+    def wall_secs(self) -> Optional[float]:
+        return None if self.finished is None or self.started is None else self.finished - self.started
+
+    def create(self) -> Any:
+        '''Runs the factory and records when it started and finished. Exceptions are recorded and raised.'''
+        self.started = time.perf_counter()
+        try:
+            return self.factory()
+        except BaseException as e:
+            self.error = e
+            raise
+        finally:
+            self.finished = time.perf_counter()
+
+class StartupRegistry:
+    '''
+    Initializes the components that the rules need at startup concurrently in a thread pool, each as soon as
+    the components it depends on are done. A component that fails is logged and the components depending on
+    it are skipped. Lazy components are published to their item right away and created on first use.
+    Components registered after start() are started as soon as their dependencies allow.
+    Registering a name again, e.g. when HABApp reloads the rule file that registers it, replaces the component
+    if it hasn't been started yet and is ignored otherwise.
+    '''
+
+    def __init__(self, workers: int = STARTUP_WORKERS):
+        self.workers = workers
+        self._components: Dict[str, StartupComponent] = {}
+        self._submitted = set()
+        self._condition = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._started_at: Optional[float] = None
+
+    def register(self, name: str, factory: Callable[[], Any], depends_on: Iterable[str] = (), item_name: Optional[str] = None, lazy: bool = False):
+        '''
+        Registers a component. The result of factory() is set as the value of the HABApp item item_name, if given.
+        With lazy, a LazyComponent that calls factory() on first use is set instead.
+        Dependencies that aren't registered yet are waited for.
+        '''
+        with self._condition:
+            if name in self._submitted:
+                log.debug('The startup component [%s] is already started, the new registration is ignored', name)
+                return
+            self._components[name] = StartupComponent(name, factory, depends_on, item_name, lazy)
+            if self._executor is not None:
+                self._submit_ready()
+
+    def start(self):
+        with self._condition:
+            if self._executor is not None:
+                return
+            self._started_at = time.perf_counter()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Startup')
+            self._submit_ready()
+
+    @property
+    def done(self) -> bool:
+        with self._condition:
+            return all(component.done for component in self._components.values())
+
+    def wait(self, timeout: float = STARTUP_TIMEOUT) -> bool:
+        '''Waits until all registered components are done. Returns False on timeout.'''
+        with self._condition:
+            return self._condition.wait_for(lambda: all(component.done for component in self._components.values()), timeout)
+
+    def _submit_ready(self):
+        # Called with the condition held
+        progress = True
+        while progress:
+            progress = False
+            for component in self._components.values():
+                if component.name in self._submitted:
+                    continue
+                dependencies = [self._components.get(name) for name in component.depends_on]
+                if any(dependency is not None and dependency.done and not dependency.ok for dependency in dependencies):
+                    component.skipped = True
+                    self._submitted.add(component.name)
+                    log.error('Skipped the startup component [%s] since a dependency failed', component.name)
+                    progress = True
+                elif all(dependency is not None and dependency.ok for dependency in dependencies):
+                    self._submitted.add(component.name)
+                    self._executor.submit(self._run, component)
+        self._condition.notify_all()
+
+    def _run(self, component: StartupComponent):
+        try:
+            value = LazyComponent(component) if component.lazy else component.create()
+            if component.item_name is not None:
+                Item.get_create_item(component.item_name, None).set_value(value)
+            component.published = True
+        except Exception as e:
+            log.exception('Failed to initialize the startup component [%s]', component.name)
+            component.error = component.error or e
+        with self._condition:
+            self._submit_ready()
+
+    def critical_path(self) -> List[StartupComponent]:
+        '''The chain of dependencies that ended last, i.e. the components that decided how long startup took.'''
+        with self._condition:
+            finished = [component for component in self._components.values() if component.finished is not None and not component.lazy]
+            path = []
+            component = max(finished, key=lambda component: component.finished, default=None)
+            while component is not None:
+                path.append(component)
+                dependencies = [self._components[name] for name in component.depends_on if name in self._components]
+                component = max((dependency for dependency in dependencies if dependency.finished is not None),
+                                key=lambda dependency: dependency.finished, default=None)
+            return path[::-1]
+
+    def report(self) -> str:
+        lines = []
+        with self._condition:
+            components = sorted(self._components.values(), key=lambda component: (component.started is None, component.started or 0))
+            total = max((component.finished for component in components if component.finished is not None and not component.lazy), default=None)
+        for component in components:
+            if component.skipped:
+                status = 'skipped'
+            elif component.name in self._submitted and not component.done:
+                status = 'running'
+            elif not component.done:
+                waiting_for = [name for name in component.depends_on if name not in self._components or not self._components[name].ok]
+                status = f'waiting for {", ".join(waiting_for)}'
+            elif component.error is not None:
+                status = f'failed: {component.error}'
+            elif component.lazy:
+                status = 'lazy, not used yet' if component.finished is None else f'lazy, created in {component.wall_secs * 1000:.1f} ms'
+            else:
+                status = f'{component.wall_secs * 1000:.1f} ms, done at {(component.finished - self._started_at) * 1000:.1f} ms'
+            lines.append(f'  {component.name}: {status}')
+        path = self.critical_path()
+        if path:
+            lines.append('  critical path: ' + ' -> '.join(f'{component.name} ({component.wall_secs * 1000:.1f} ms)' for component in path))
+        header = 'Startup' if total is None else f'Startup took {(total - self._started_at) * 1000:.1f} ms'
+        return '\n'.join([f'{header} with {len(components)} components:'] + lines)
+
+startup = StartupRegistry()
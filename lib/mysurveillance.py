@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+from myconfig import SurveillanceConfig, WebCam, config
+
+log = logging.getLogger(f'{config.system.logger_name}.mysurveillance')
+log.setLevel(logging.INFO)
+
+CAMERA_WORKERS = 8   # Cameras switched at the same time
+CAMERA_TIMEOUT = 10  # Seconds a camera gets to apply a profile
+CAMERA_PROTOCOL = 'http'
+
+class CameraProfile(NamedTuple):
+    video_in_mode: int   # The Dahua VideoInMode configuration: 0 day, 1 night
+    privacy_masks: bool  # Whether the privacy masks are shown, on the cameras that use them
+
+CAMERA_PROFILES = {
+    'day': CameraProfile(0, True),
+    'night': CameraProfile(1, True),
+    'day_armed': CameraProfile(0, False),
+    'night_armed': CameraProfile(1, False)
+}
+
+class CameraResult(NamedTuple):
+    camera: str
+    outcome: str        # 'switched', 'skipped' (already had the profile) or 'failed'
+    detail: str
+    elapsed_secs: float
+
+class SwitchReport(NamedTuple):
+    profile: str
+    results: Dict[str, CameraResult]
+    elapsed_secs: float # From the switch until the last camera was done
+
+    def cameras(self, outcome: str) -> Tuple[str, ...]:
+        return tuple(camera for camera, result in self.results.items() if result.outcome == outcome)
+
+    def __str__(self) -> str:
+        counts = ', '.join(f'{len(self.cameras(outcome))} {outcome}' for outcome in ('switched', 'skipped', 'failed'))
+        return f'Switched the cameras to [{self.profile}] in {self.elapsed_secs * 1000:.0f} ms: {counts}'
+
+class CameraSwitcher:
+    '''
+    Switches the profile of all enabled cameras that follow the profiles, concurrently. Each camera host has
+    its own keep-alive session with digest authentication, so the connection and the authentication
+    handshake are only paid the first time and after the camera has dropped the connection. A camera is
+    always switched by the same worker, since the digest state of a session is kept per thread, which also
+    keeps the switches of one camera in order. Cameras whose last known profile is the requested one are skipped.
+    '''
+
+    def __init__(self, surveillance: SurveillanceConfig, workers: int = CAMERA_WORKERS):
+        self._workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'CameraSwitcher-{n}') for n in range(workers)]
+        self._worker_of: Dict[str, ThreadPoolExecutor] = {}
+        self._collector = ThreadPoolExecutor(max_workers=1, thread_name_prefix='CameraCollector')
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+        self.last_report: Optional[SwitchReport] = None
+        self.configure(surveillance)
+
+    def configure(self, surveillance: SurveillanceConfig):
+        with self._lock:
+            self.surveillance = surveillance
+            self.last_profiles = {cam.hostname: cam.last_profile for cam in surveillance.web_cams if cam.last_profile}
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def on_config_changed(self, old: SurveillanceConfig, new: SurveillanceConfig):
+        self.configure(new)
+
+    def base_url(self, cam: WebCam) -> str:
+        return f'{CAMERA_PROTOCOL}://{cam.hostname}.{self.surveillance.cam_domain}'
+
+    def _session(self, cam: WebCam) -> requests.Session:
+        with self._lock:
+            session = self._sessions.get(cam.hostname)
+            if session is None:
+                session = self._sessions[cam.hostname] = requests.Session()
+                session.auth = HTTPDigestAuth(self.surveillance.cam_user, self.surveillance.cam_login)
+                session.mount(f'{CAMERA_PROTOCOL}://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            return session
+
+    def switch_profile(self, profile_name: str, force: bool = False) -> Future:
+        '''
+        Switches the cameras to the profile, one of CAMERA_PROFILES. With force the cameras that seem to have the
+        profile already are switched too. Returns a Future that resolves to a SwitchReport when all are done.
+        '''
+        profile = CAMERA_PROFILES[profile_name]
+        start = time.monotonic()
+        pending: Dict[str, Future] = {}
+        results: Dict[str, CameraResult] = {}
+        for cam in self.surveillance.profile_cams:
+            if not force and self.last_profiles.get(cam.hostname) == profile_name:
+                results[cam.shortname] = CameraResult(cam.shortname, 'skipped', profile_name, 0.0)
+            else:
+                worker = self._worker_of.setdefault(cam.hostname, self._workers[len(self._worker_of) % len(self._workers)])
+                pending[cam.shortname] = worker.submit(self._apply, cam, profile_name, profile, start)
+        return self._collector.submit(self._collect, profile_name, start, pending, results)
+
+    def _apply(self, cam: WebCam, profile_name: str, profile: CameraProfile, start: float) -> CameraResult:
+        settings = [f'VideoInMode[0].Config[0]={profile.video_in_mode}']
+        if cam.use_sec_mask:
+            blend = str(profile.privacy_masks).lower()
+            settings += [f'VideoWidget[0].Covers[0].EncodeBlend={blend}', f'VideoWidget[0].Covers[0].PreviewBlend={blend}']
+        # The camera wants the brackets unencoded, so the query isn't built by requests
+        url = f'{self.base_url(cam)}/cgi-bin/configManager.cgi?action=setConfig&' + '&'.join(settings)
+        try:
+            response = self._session(cam).get(url, timeout=CAMERA_TIMEOUT)
+            response.raise_for_status()
+            if response.text.strip() != 'OK':
+                raise ValueError(f'unexpected response {response.text.strip()[:40]!r}')
+        except Exception as e:
+            self.last_profiles.pop(cam.hostname, None)
+            return CameraResult(cam.shortname, 'failed', str(e), time.monotonic() - start)
+        self.last_profiles[cam.hostname] = profile_name
+        return CameraResult(cam.shortname, 'switched', profile_name, time.monotonic() - start)
+
+    def _collect(self, profile_name: str, start: float, pending: Dict[str, Future], results: Dict[str, CameraResult]) -> SwitchReport:
+        for camera, future in pending.items():
+            results[camera] = future.result()
+        report = SwitchReport(profile_name, results, time.monotonic() - start)
+        self.last_report = report
+        if report.cameras('failed'):
+            log.warning('%s: %s', report, ', '.join(f'{camera} {results[camera].detail}' for camera in report.cameras('failed')))
+        elif pending:
+            log.info('%s', report)
+        return report
+
+camera_switcher = CameraSwitcher(config.surveillance)
+config.subscribe('surveillance', camera_switcher.on_config_changed)
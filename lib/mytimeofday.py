@@ -0,0 +1,179 @@
+import logging
+import threading
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from HABApp import Rule
+from HABApp.core.events import ValueChangeEventFilter
+from HABApp.openhab.definitions import OnOffValue
+from HABApp.openhab.items import DatetimeItem, StringItem, SwitchItem
+from myconfig import TimeOfDayConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.mytimeofday')
+log.setLevel(logging.INFO)
+
+CLOCK_PERIOD_START_HOURS = (6, 10, 18, 23) # The hour each of the CLOCK_TIME_OF_DAY periods starts
+EARLY_MORNING_HOURS = (4, 9)               # Its_Not_Early_Morning is OFF from the first hour until the second
+EARLY_MORNING_ITEM_NAME = 'Its_Not_Early_Morning'
+# The items holding the time each of the SOLAR_TIME_OF_DAY periods starts, kept up to date by the astro binding
+SOLAR_PERIOD_START_ITEM_NAMES = ('V_CivilDawn', 'V_Sunrise', 'V_CivilDuskStart', 'V_CivilDuskEnd')
+
+class Transition(NamedTuple):
+    at: datetime
+    item_name: str
+    value: str
+
+class DaySchedule:
+    '''
+    The time of day transitions of one day, computed once. The period of each item at any time of the day is
+    found by bisecting its transition times. Before the first transition of the day the period is the last
+    one of the day, since the periods wrap around midnight.
+    '''
+
+    def __init__(self, day: date, transitions: List[Transition]):
+        self.day = day
+        self.transitions = sorted(transitions)
+        self._times = [transition.at for transition in self.transitions]
+        self._tables: Dict[str, Tuple[List[datetime], List[str]]] = {}
+        for transition in self.transitions:
+            times, values = self._tables.setdefault(transition.item_name, ([], []))
+            times.append(transition.at)
+            values.append(transition.value)
+
+    @property
+    def item_names(self) -> Tuple[str, ...]:
+        return tuple(self._tables)
+
+    def period_at(self, item_name: str, when: datetime) -> Optional[str]:
+        '''
+        Returns the value the item has at the given time. A time on another day is looked up by its time of day,
+        which is exact for the clock periods and within a few minutes for the solar ones.
+        '''
+        table = self._tables.get(item_name)
+        if table is None:
+            return None
+        if when.date() != self.day:
+            when = datetime.combine(self.day, when.time())
+        times, values = table
+        return values[bisect_right(times, when) - 1] # Index -1 is the last period of the day
+
+    def next_transition_time(self, after: datetime) -> Optional[datetime]:
+        index = bisect_right(self._times, after)
+        return self._times[index] if index < len(self._times) else None
+
+def _at_hour(day: date, hour: int) -> datetime:
+    return datetime(day.year, day.month, day.day, hour)
+
+def build_day_schedule(day: date, time_of_day: TimeOfDayConfig, solar_starts: Tuple[Optional[datetime], ...]) -> DaySchedule:
+    '''Builds the schedule of the day. Solar periods whose start time isn't known are left out.'''
+    transitions = [
+        Transition(_at_hour(day, hour), config.item_names.clock_time_of_day, period)
+        for hour, period in zip(CLOCK_PERIOD_START_HOURS, time_of_day.clock)
+    ]
+    early_morning_start, early_morning_end = EARLY_MORNING_HOURS
+    transitions.append(Transition(_at_hour(day, early_morning_start), EARLY_MORNING_ITEM_NAME, OnOffValue.OFF))
+    transitions.append(Transition(_at_hour(day, early_morning_end), EARLY_MORNING_ITEM_NAME, OnOffValue.ON))
+    for start, period in zip(solar_starts, time_of_day.solar):
+        if start is not None:
+            transitions.append(Transition(datetime.combine(day, start.time()), config.item_names.solar_time_of_day, period))
+    return DaySchedule(day, transitions)
+
+class TimeOfDay:
+    '''
+    Keeps the clock and solar time of day items, and Its_Not_Early_Morning, up to date from a schedule of the
+    day's transitions. Only one timer is pending at a time, for the next transition, and items are only
+    updated when their value actually changes. The schedule is rebuilt at midnight, when the astro binding
+    changes one of the solar period start items and when the time of day configuration changes.
+    '''
+
+    def __init__(self):
+        self._rule: Optional[Rule] = None
+        self._schedule: Optional[DaySchedule] = None
+        self._job = None
+        self._next_time: Optional[datetime] = None
+        self._lock = threading.RLock()
+
+    @property
+    def schedule(self) -> DaySchedule:
+        if self._schedule is None:
+            self._schedule = self._build(datetime.now().date())
+        return self._schedule
+
+    def attach(self, rule: Rule):
+        '''Subscribes to the solar period start items through the given rule, updates the items and schedules the next transition.'''
+        self._rule = rule
+        for item_name in SOLAR_PERIOD_START_ITEM_NAMES:
+            rule.listen_event(item_name, self._on_solar_start_change, ValueChangeEventFilter())
+        self.rebuild()
+
+    def on_config_changed(self, old: TimeOfDayConfig, new: TimeOfDayConfig):
+        self.rebuild()
+
+    def period_at(self, item_name: str, when: Optional[datetime] = None) -> Optional[str]:
+        return self.schedule.period_at(item_name, when or datetime.now())
+
+    def clock_period_at(self, when: Optional[datetime] = None) -> Optional[str]:
+        return self.period_at(config.item_names.clock_time_of_day, when)
+
+    def solar_period_at(self, when: Optional[datetime] = None) -> Optional[str]:
+        return self.period_at(config.item_names.solar_time_of_day, when)
+
+    def is_early_morning(self, when: Optional[datetime] = None) -> bool:
+        return self.period_at(EARLY_MORNING_ITEM_NAME, when) == OnOffValue.OFF
+
+    def rebuild(self):
+        '''Builds today's schedule, brings the items up to date and schedules the next transition.'''
+        with self._lock:
+            now = datetime.now()
+            self._schedule = self._build(now.date())
+            self._apply(now)
+            self._schedule_next(now)
+
+    def _build(self, day: date) -> DaySchedule:
+        solar_starts = tuple(DatetimeItem.get_item(item_name).value for item_name in SOLAR_PERIOD_START_ITEM_NAMES)
+        schedule = build_day_schedule(day, config.time_of_day, solar_starts)
+        log.debug('Built the schedule of %s with %d transitions', day, len(schedule.transitions))
+        return schedule
+
+    def _apply(self, now: datetime):
+        for item_name in self._schedule.item_names:
+            value = self._schedule.period_at(item_name, now)
+            if item_name == config.item_names.solar_time_of_day:
+                item = StringItem.get_item(item_name)
+                if item.value != value:
+                    log.info('The solar time of day is [%s]', value)
+                    item.oh_send_command(value)
+            elif item_name == EARLY_MORNING_ITEM_NAME:
+                SwitchItem.get_item(item_name).oh_post_update_if(value, not_equal=value)
+            elif StringItem.get_item(item_name).oh_post_update_if(value, not_equal=value):
+                log.info('The time of day (according to the clock) is [%s]', value)
+
+    def _schedule_next(self, now: datetime):
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+        if self._rule is None:
+            return
+        next_time = self._schedule.next_transition_time(now)
+        if next_time is None:
+            # The next transition is tomorrow, after the schedule has been rebuilt at midnight
+            next_time = _at_hour(now.date() + timedelta(days=1), 0)
+        self._next_time = next_time
+        self._job = self._rule.run.at(next_time, self._on_transition)
+
+    def _on_transition(self):
+        with self._lock:
+            # A timer that fires a little early still counts as the transition it was scheduled for
+            now = max(datetime.now(), self._next_time or datetime.min)
+            if now.date() != self._schedule.day:
+                self._schedule = self._build(now.date())
+            self._apply(now)
+            self._schedule_next(now)
+
+    def _on_solar_start_change(self, event):
+        log.debug('[%s] changed to [%s], rebuilding the schedule', event.name, event.value)
+        self.rebuild()
+
+time_of_day = TimeOfDay()
+config.subscribe('time_of_day', time_of_day.on_config_changed)
@@ -0,0 +1,146 @@
+import logging
+import queue
+import threading
+from collections import Counter, OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+import requests
+from myconfig import SonosConfig, config
+
+log = logging.getLogger(f'{config.system.logger_name}.myttscache')
+log.setLevel(logging.INFO)
+
+TTS_CACHE_SIZE = config.sonos.tts_cache_size # Max number of rendered phrases to keep
+TTS_HOT_THRESHOLD = 2    # A phrase is rendered to the cache after it has been spoken this many times
+TTS_RENDER_TIMEOUT = 30  # Seconds to wait for the generator
+TTS_SEEN_MAX = 1000      # Max number of uncached phrases to count before the counts are reset
+
+class TtsKey(NamedTuple):
+    text: str
+    language: str
+    voice: Optional[str]
+    engine: str
+    gender: str
+
+class RenderedSpeech(NamedTuple):
+    uri: str
+    duration_secs: Optional[int]
+
+class TtsCache:
+    '''
+    Keeps the mp3 files rendered by the TTS generator, so that recurring phrases can be played as sounds
+    instead of being synthesized again. Only phrases that recur are kept: they are rendered by a background
+    thread of the cache, never by the caller, when they are prerendered or have been looked up
+    TTS_HOT_THRESHOLD times, so one-off texts with times or values in them don't take up the cache.
+    The least recently used entry is evicted when the cache is full.
+    '''
+
+    def __init__(self, generator_url: str, max_entries: int = TTS_CACHE_SIZE):
+        self.generator_url = generator_url
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: 'OrderedDict[TtsKey, RenderedSpeech]' = OrderedDict()
+        self._seen = Counter()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.session = requests.Session()
+        threading.Thread(target=self._worker, name='TtsCache', daemon=True).start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+    def on_config_changed(self, old: SonosConfig, new: SonosConfig):
+        if new.generator_url != old.generator_url:
+            # Rendered files are served by the generator, so they go with it
+            with self._lock:
+                self.generator_url = new.generator_url
+                self._entries.clear()
+        with self._lock:
+            self.max_entries = new.tts_cache_size
+            self._evict()
+
+    def peek(self, key: TtsKey) -> Optional[RenderedSpeech]:
+        '''Returns the cached entry without touching the statistics or the eviction order.'''
+        return self._entries.get(key)
+
+    def lookup(self, key: TtsKey) -> Optional[RenderedSpeech]:
+        '''
+        Returns the cached entry for the phrase, or None if it has to be synthesized as usual.
+        A phrase missed TTS_HOT_THRESHOLD times is queued for rendering in the background; the lookup never
+        waits for the generator.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if len(self._seen) >= TTS_SEEN_MAX:
+                self._seen.clear()
+            self._seen[key] += 1
+            hot = self._seen[key] >= TTS_HOT_THRESHOLD
+        if hot:
+            self.prerender([key])
+        return None
+
+    def prerender(self, keys: Iterable[TtsKey]):
+        '''Queues phrases to be rendered in the background.'''
+        for key in keys:
+            with self._lock:
+                if key in self._entries or key in self._queued:
+                    continue
+                self._queued.add(key)
+            self._queue.put(key)
+
+    def _store(self, key: TtsKey, entry: Optional[RenderedSpeech]):
+        with self._lock:
+            self._queued.discard(key)
+            if entry is None:
+                return
+            self._seen.pop(key, None)
+            self._entries[key] = entry
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _worker(self):
+        while True:
+            key = self._queue.get()
+            self._store(key, self._render(key))
+
+    def _render(self, key: TtsKey) -> Optional[RenderedSpeech]:
+        request = {"text": key.text, "lang": key.language, "gender": key.gender, "engine": key.engine}
+        if key.voice is not None:
+            request['name'] = key.voice
+        try:
+            response = self.session.post(self.generator_url, json=request, timeout=TTS_RENDER_TIMEOUT)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            log.error("Failed to render '%s': %s", key.text, e)
+            return None
+        uri = result.get('cdnUri') or result.get('uri')
+        if not uri:
+            log.error("The TTS generator returned no uri for '%s'", key.text)
+            return None
+        duration_ms = result.get('duration')
+        log.debug("Rendered '%s' to %s", key.text, uri)
+        return RenderedSpeech(uri, round(duration_ms / 1000) + 1 if duration_ms else None)
+
+tts_cache = TtsCache(config.sonos.generator_url)
+config.subscribe('sonos', tts_cache.on_config_changed)
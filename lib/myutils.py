@@ -1,24 +1,28 @@
-import json
+import heapq
+import itertools
 import logging
-import subprocess
+import threading
+import time
+from concurrent.futures import Future
 from datetime import date, datetime
-from typing import Dict, Optional, Union
+from typing import Dict, List, NamedTuple, Optional, Union
 
-from HABApp import DictParameter
-from HABApp.mqtt.items import MqttItem
 from HABApp.openhab.definitions import OnOffValue, OpenClosedValue, UpDownValue
-from HABApp.openhab.items import NumberItem, StringItem
-
-configuration = DictParameter('my_config', 'configuration', default_value=None).value
-lighting_configuration = DictParameter('lighting_config', 'configuration', default_value=None).value
-LIGHT_LEVEL = lighting_configuration["lighting"]["LIGHT_LEVEL"]
-SOLAR_TIME_OF_DAY = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"]
-CLOCK_TIME_OF_DAY = configuration["time_of_day"]["CLOCK_TIME_OF_DAY"]
-lametric_configuration = configuration["lametric"]
-customItemNames = configuration["custom_item_names"]
-sonos = configuration["sonos"]
-
-log = logging.getLogger(f'{configuration["system"]["MY_LOGGER_NAME"]}.myutils')
+from HABApp.openhab.items import StringItem
+from myconfig import DEFAULT_TTS_PROFILE, SonosConfig, config
+from mydedup import SUPPRESSED, notification_dedup, suppressed
+# SPC_AREA_MODE was defined here before myhousestate, so it is re-exported for the rules that import it from here
+from myhousestate import SPC_AREA_MODE, house_state # noqa: F401
+from mylametric import LAMETRIC_DEFAULT_DEADLINE, lametric_client
+from mymqtt import mqtt_publisher
+from myttscache import TtsKey, tts_cache
+from myweather import compass_direction
+
+LIGHT_LEVEL = config.lighting.light_level
+SOLAR_TIME_OF_DAY = config.time_of_day.solar
+CLOCK_TIME_OF_DAY = config.time_of_day.clock
+
+log = logging.getLogger(f'{config.system.logger_name}.myutils')
 log.setLevel(logging.INFO)
 
 # Some useful constants
@@ -29,7 +33,6 @@ CLOSED = OpenClosedValue.CLOSED
 UP = UpDownValue.UP
 DOWN = UpDownValue.DOWN
 
-SPC_AREA_MODE = {'unset': 0, 'partset_a': 1, 'partset_b': 2, 'set': 3}
 PRIO = {'LOW': 0, 'MODERATE': 1, 'HIGH': 2, 'EMERGENCY': 3}
 
 def calendar_days_between(start_date_or_datetime: Union[date, datetime], end_date_or_datetime: Union[date, datetime]) -> int:
@@ -59,80 +62,49 @@ def spc_area_is_set():
     '''
     Returns True if the SPC alarm area 1 is either partial or fully set otherwise returns False
     '''
-    item_value = StringItem.get_item('SPC_Area_1_Mode').value
-    if item_value is not None:
-        return SPC_AREA_MODE.get(item_value, 0) > 0
-    else:
-        return False
+    return house_state.spc_area_is_set
 
 def spc_area_is_fully_set():
     '''
     Returns True if the SPC alarm area 1 is fully set otherwise returns False
     '''
-    item_value = StringItem.get_item('SPC_Area_1_Mode').value
-    if item_value is not None:
-        return SPC_AREA_MODE.get(item_value, 0) == 3
-    else:
-        return False
+    return house_state.spc_area_is_fully_set
 
 def spc_area_is_partially_set():
     '''
     Returns True if the SPC alarm area 1 is fully set otherwise returns False
     '''
-    item_value = StringItem.get_item('SPC_Area_1_Mode').value
-    if item_value is not None:
-        return SPC_AREA_MODE.get(item_value, 0) == 1
-    else:
-        return False
+    return house_state.spc_area_is_partially_set
 
 def get_compass_direction(degrees):
     '''
     Returns the compass direction abbreviation (Swedish) for the given compass degree
     '''
-    COMPASS_DIRECTIONS = {
-        (0, 22.5): 'N',
-        (22.5, 67.5): 'NNO',
-        (67.5, 112.5): 'O',
-        (112.5, 157.5): 'OSO',
-        (157.5, 202.5): 'S',
-        (202.5, 247.5): 'SSO',
-        (247.5, 292.5): 'V',
-        (292.5, 337.5): 'VNV',
-        (337.5, 360): 'N'
-    }
-    for degree_range, direction in COMPASS_DIRECTIONS.items():
-        if degree_range[0] <= degrees < degree_range[1]:
-            return direction
+    return compass_direction(degrees)
 
 def is_light_level_bright() -> bool:
     """Checks if the light level is bright."""
-    light_level_item = NumberItem.get_item(customItemNames['sysLightLevel'])
-    return light_level_item.value == LIGHT_LEVEL['BRIGHT'] if light_level_item.value is not None else False
+    return house_state.is_light_level_bright
 
 def is_light_level_shady() -> bool:
     """Checks if the light level is shady."""
-    light_level_item = NumberItem.get_item(customItemNames['sysLightLevel'])
-    return light_level_item.value <= LIGHT_LEVEL['SHADY'] if light_level_item.value is not None else False
+    return house_state.is_light_level_shady
 
 def is_light_level_dark() -> bool:
     """Checks if the light level is dark."""
-    light_level_item = NumberItem.get_item(customItemNames['sysLightLevel'])
-    return light_level_item.value <= LIGHT_LEVEL['DARK'] if light_level_item.value is not None else False
+    return house_state.is_light_level_dark
 
 def is_light_level_black() -> bool:
     """Checks if the light level is black."""
-    light_level_item = NumberItem.get_item(customItemNames['sysLightLevel'])
-    return light_level_item.value <= LIGHT_LEVEL['BLACK'] if light_level_item.value is not None else False
+    return house_state.is_light_level_black
 
 def is_clock_night() -> bool:
     """Checks if the clock indicates night."""
-    clock_time_item = StringItem.get_item(customItemNames['clock_time_of_day_item'])
-    return clock_time_item.value == CLOCK_TIME_OF_DAY[3] if clock_time_item.value is not None else False
+    return house_state.is_clock_night
 
 def is_solar_night() -> bool:
     """Checks if the solar position indicates night."""
-    solar_time_item = StringItem.get_item(customItemNames['solar_time_of_day_item'])
-    return solar_time_item.value == SOLAR_TIME_OF_DAY[3] if solar_time_item.value is not None else False
+    return house_state.is_solar_night
 
 def calculate_speech_time_secs(text: str) -> int:
     '''Calculates the delay required for speaking a text string based on the character length and speaking speed.'''
@@ -142,14 +114,39 @@ def calculate_speech_time_secs(text: str) -> int:
     character_count = len(text)
     return int((character_count / CHARACTERS_PER_SECOND) * CHARACTER_LENGTH_ADJUSTMENT_FACTOR + ADDITIONAL_DELAY_SECONDS)
 
-NOTIFICATION_DEFAULT_LANGUAGE = "sv-SE"
-NOTIFICATION_DEFAULT_ENGINE = "neural"
+NOTIFICATION_DEFAULT_LANGUAGE = DEFAULT_TTS_PROFILE.language
+NOTIFICATION_DEFAULT_ENGINE = DEFAULT_TTS_PROFILE.engine
 NOTIFICATION_DEFAULT_ROOM = "Vardagsrummet"
-NOTIFICATION_DEFAULT_GENDER = "female"
-NOTIFICATION_DEFAULT_VOICE = "Elin"
+NOTIFICATION_DEFAULT_GENDER = DEFAULT_TTS_PROFILE.gender
+NOTIFICATION_DEFAULT_VOICE = DEFAULT_TTS_PROFILE.voice
 NOTIFICATION_DEFAULT_ONLY_WHEN_PLAYING = False
 NOTIFICATION_DEFAULT_TIMEOUT = 0
 NOTIFICATION_DEFAULT_MP3_TIMEOUT = 15
+NOTIFICATION_DEFAULT_MP3_DURATION = 5 # Seconds a sound file is assumed to play when scheduling the next notification
+NOTIFICATION_MERGE_MAX_PRIO = PRIO['MODERATE'] # Queued texts up to this priority may be merged into one utterance
+NOTIFICATION_QUIET_HOURS = (7, 21) # Low priority notifications make no sound before the first or after the last hour
+
+class NotificationPolicy(NamedTuple):
+    '''
+    The conditions that decide whether a notification may make a sound, evaluated once per message
+    so that all channels delivering it see the same conditions. Each channel keeps its own rule.
+    '''
+    quiet_hours: bool
+    alarm_set: bool
+
+    @classmethod
+    def now(cls) -> 'NotificationPolicy':
+        hour = datetime.now().hour
+        first_hour, last_hour = NOTIFICATION_QUIET_HOURS
+        return cls(quiet_hours=hour < first_hour or hour > last_hour, alarm_set=spc_area_is_set())
+
+    def allows_sound(self, priority: int) -> bool:
+        '''The Sonos rule: HIGH and EMERGENCY notifications are played during the quiet hours too.'''
+        return priority > PRIO['MODERATE'] or not (self.quiet_hours or self.alarm_set)
+
+    def allows_lametric_sound(self, priority: int) -> bool:
+        '''The LaMetric rule: never a sound during the quiet hours, whatever the priority.'''
+        return not self.quiet_hours and (priority > PRIO['MODERATE'] or not self.alarm_set)
 
 class Notification:
     def __init__(self, notification_or_url, priority=PRIO['MODERATE'], **kwargs):
@@ -157,15 +154,16 @@ class Notification:
         self.priority = priority
         self.room = kwargs.get('tts_room', NOTIFICATION_DEFAULT_ROOM)
         self.volume = kwargs.get('tts_volume', None)
-        self.language = kwargs.get('tts_lang', sonos.get("rooms", {}).get(self.room, {}).get("tts_lang", NOTIFICATION_DEFAULT_LANGUAGE)) # Use param if exist, else config, else default
-        self.voice = kwargs.get('tts_voice', sonos.get("rooms", {}).get(self.room, {}).get("tts_voice", NOTIFICATION_DEFAULT_VOICE))
-        self.gender = kwargs.get('tts_gender', sonos.get("rooms", {}).get(self.room, {}).get("tts_gender", NOTIFICATION_DEFAULT_GENDER))
-        self.engine = kwargs.get('tts_engine', sonos.get("rooms", {}).get(self.room, {}).get("tts_engine", NOTIFICATION_DEFAULT_ENGINE))
+        profile = config.sonos.profile(self.room) # The room profile from the config, else the default profile
+        self.language = kwargs.get('tts_lang', profile.language)
+        self.voice = kwargs.get('tts_voice', profile.voice)
+        self.gender = kwargs.get('tts_gender', profile.gender)
+        self.engine = kwargs.get('tts_engine', profile.engine)
         self.only_when_playing = kwargs.get('only_when_palying', NOTIFICATION_DEFAULT_ONLY_WHEN_PLAYING)
         self.delay_ms = kwargs.get('delay_ms', 0) if 1 <= kwargs.get('delay_ms', 0) <= 1000 else 500
         self.timeout = kwargs.get('timeout', NOTIFICATION_DEFAULT_TIMEOUT)
         self.mp3_timeout = NOTIFICATION_DEFAULT_MP3_TIMEOUT
-        self.language_server = f'http://{sonos["TTS_HOST"]}:5601/api/generate'
+        self.language_server = config.sonos.generator_url
         self.mqtt_topic = ""
         self.payload = ""
 
@@ -188,17 +186,11 @@ class Notification:
     def volume(self, value):
         self._volume = value
 
-    def should_play(self):
-        # Get current hour
-        current_hour = datetime.now().hour
-
-        # Check if current hour is outside the range of 7 AM to 9 PM
-        is_outside_range = current_hour < 7 or current_hour > 21
-
-        # Check if outside range or if the SPC alarm is set and priority level is low
-        if (is_outside_range or spc_area_is_set()) and self.priority <= PRIO['MODERATE']:
-            log_message = f"Message priority [{get_key_for_value(PRIO, self.priority)}] is too low to play the notification '{self.notification_or_url}' at this moment."
-            log.info(log_message)
+    def should_play(self, policy: Optional['NotificationPolicy'] = None):
+        # Low priority notifications are not played during the quiet hours or when the SPC alarm is set
+        if not (policy or NotificationPolicy.now()).allows_sound(self.priority):
+            log.info("Message priority [%s] is too low to play the notification '%s' at this moment.",
+                     get_key_for_value(PRIO, self.priority), self.notification_or_url)
             return False
         return True
 
@@ -226,12 +218,7 @@ class Notification:
     @payload.setter
     def payload(self, value):
         if self.play_mp3():
-            track_uri = f'http://{sonos["TTS_HOST"]}:5601/cache/sounds/{self.notification_or_url}'
-            self._payload = { "trackUri": track_uri, "volume": self.volume, "timeout": self.mp3_timeout, "onlyWhenPlaying": self.only_when_playing }
-            if self.delay_ms and 0 < self.delay_ms < 2001:
-                self._payload['delayMs'] = self.delay_ms
-            if self.timeout and 0 < self.timeout < 250:
-                self._payload['timeout'] = self.timeout
+            self._payload = self.sound_payload(f'http://{config.sonos.tts_host}:5601/cache/sounds/{self.notification_or_url}')
         else:
             self._payload = { "text": self.notification_or_url, "endpoint": self.language_server, "lang": self.language, "gender": self.gender, "engine": self.engine, "volume": self.volume, "onlyWhenPlaying": self.only_when_playing }
             if self.voice is not None:
@@ -241,20 +228,148 @@ class Notification:
             if self.timeout and 0 < self.timeout < 250:
                 self._payload['timeout'] = self.timeout
 
-    def play(self):
-        # Play the notification
-        if not self.should_play():
+    def sound_payload(self, track_uri, mp3_timeout=NOTIFICATION_DEFAULT_MP3_TIMEOUT):
+        # Get the payload for playing an mp3 file
+        payload = { "trackUri": track_uri, "volume": self.volume, "timeout": mp3_timeout, "onlyWhenPlaying": self.only_when_playing }
+        if self.delay_ms and 0 < self.delay_ms < 2001:
+            payload['delayMs'] = self.delay_ms
+        if self.timeout and 0 < self.timeout < 250:
+            payload['timeout'] = self.timeout
+        return payload
+
+    @property
+    def tts_key(self) -> TtsKey:
+        # Get the key of the text in the TTS cache
+        return TtsKey(self.notification_or_url, self.language, self.voice, self.engine, self.gender)
+
+    @property
+    def duration_secs(self) -> int:
+        # Estimated time it takes to play the notification. The measured duration is used for rendered texts.
+        if self.play_mp3():
+            return NOTIFICATION_DEFAULT_MP3_DURATION
+        rendered = tts_cache.peek(self.tts_key)
+        if rendered is not None and rendered.duration_secs:
+            return rendered.duration_secs
+        return calculate_speech_time_secs(self.notification_or_url)
+
+    def can_merge(self, other: 'Notification') -> bool:
+        # Only low priority texts spoken with the same voice in the same room are merged
+        return (
+            not self.play_mp3() and not other.play_mp3()
+            and self.priority <= NOTIFICATION_MERGE_MAX_PRIO and other.priority <= NOTIFICATION_MERGE_MAX_PRIO
+            and (self.room, self.language, self.voice, self.gender, self.engine) == (other.room, other.language, other.voice, other.gender, other.engine)
+        )
+
+    def merge(self, other: 'Notification'):
+        # Append the text of another notification so that both are spoken in one utterance
+        separator = ' ' if self.notification_or_url.rstrip().endswith(('.', '!', '?')) else '. '
+        self.notification_or_url = f'{self.notification_or_url.rstrip()}{separator}{other.notification_or_url}'
+        self.priority = max(self.priority, other.priority)
+        self.payload = None # Rebuild the payload from the merged text
+
+    def publish(self):
+        # Publish the notification to the Sonos system right away. Texts already rendered in the TTS cache are played
+        # as sounds, others are spoken by live TTS while the cache renders them in the background.
+        rendered = None if self.play_mp3() else tts_cache.lookup(self.tts_key)
+        if rendered is None:
+            mqtt_pub(self.mqtt_topic, self.payload)
+        else:
+            topic = 'sonos/set/notify' if self.room == "All" else f'sonos/set/{self.room}/notify'
+            mqtt_pub(topic, self.sound_payload(rendered.uri, max(self.mp3_timeout, self.duration_secs)))
+
+    def play(self, policy: Optional['NotificationPolicy'] = None):
+        # Play the notification when the room is free
+        if not self.should_play(policy):
             return False
-        mqtt_pub(self.mqtt_topic, json.dumps(self.payload))
+        speech_scheduler.submit(self)
         return True
 
+class SpeechScheduler:
+    '''
+    Serializes the notifications played in each room.
+    A notification is published when the previous one in the same room is estimated to have finished.
+    Pending notifications are played in priority order and queued low priority texts are merged into one utterance.
+    EMERGENCY notifications are published immediately.
+    '''
+
+    def __init__(self):
+        self._queues: Dict[str, List] = {} # room -> heap of (-priority, sequence number, notification)
+        self._busy_until: Dict[str, float] = {} # room -> monotonic time when the room is free again
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        threading.Thread(target=self._worker, name='SpeechScheduler', daemon=True).start()
+
+    def submit(self, notification: Notification):
+        if notification.priority >= PRIO['EMERGENCY']:
+            self._publish(notification)
+            return
+        with self._condition:
+            heapq.heappush(self._queues.setdefault(notification.room, []), (-notification.priority, next(self._sequence), notification))
+            self._condition.notify()
+
+    def pending(self, room: str) -> int:
+        return len(self._queues.get(room, ()))
+
+    def _publish(self, notification: Notification):
+        with self._condition:
+            self._busy_until[notification.room] = time.monotonic() + notification.duration_secs
+        notification.publish()
+
+    def _next_notification(self) -> Notification:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wake_up = None
+                for room, queue in self._queues.items():
+                    if not queue:
+                        continue
+                    free_at = self._busy_until.get(room, now)
+                    if free_at <= now:
+                        return self._pop(queue)
+                    wake_up = free_at if wake_up is None else min(wake_up, free_at)
+                self._condition.wait(None if wake_up is None else wake_up - now)
+
+    def _pop(self, queue: List) -> Notification:
+        first = heapq.heappop(queue)
+        mergeable = [entry for entry in queue if first[2].can_merge(entry[2])]
+        if not mergeable:
+            return first[2]
+        queue[:] = [entry for entry in queue if entry not in mergeable]
+        heapq.heapify(queue)
+        # Speak the merged texts in the order they were queued
+        entries = sorted([first] + mergeable, key=lambda entry: entry[1])
+        notification = entries[0][2]
+        for entry in entries[1:]:
+            notification.merge(entry[2])
+        log.debug('Merged %d queued notifications in [%s]', len(mergeable), notification.room)
+        return notification
+
+    def _worker(self):
+        while True:
+            self._publish(self._next_notification())
+
+speech_scheduler = SpeechScheduler()
+
+def prerender_greetings(sonos: SonosConfig):
+    '''The greetings are spoken every day, so have them rendered in advance in the voice of every room.'''
+    profiles = {sonos.profile(NOTIFICATION_DEFAULT_ROOM), *sonos.rooms.values()}
+    tts_cache.prerender(TtsKey(f'God{time_of_day.lower()}', profile.language, profile.voice, profile.engine, profile.gender)
+                        for time_of_day in CLOCK_TIME_OF_DAY for profile in profiles)
+
+prerender_greetings(config.sonos)
+config.subscribe('sonos', lambda old, new: prerender_greetings(new))
+
 def play_notification(notification_or_url, priority=PRIO['MODERATE'], **kwargs):
     '''
     Plays a notification on the Sonos system.
     The notification can be either a text string or an URL to an mp3 file.
+    A notification similar to one played in the same room within the dedup window is skipped, unless it's an EMERGENCY,
+    and SUPPRESSED, which is falsy, is returned.
     '''
     notification = Notification(notification_or_url, priority, **kwargs)
-    return notification.play()
+    if priority < PRIO['EMERGENCY'] and not notification_dedup.admit('sonos', f'{notification.room}: {notification_or_url}'):
+        return SUPPRESSED
+    return notification.play(kwargs.get('policy'))
 
 def speak_text(text_to_speak, priority=PRIO['MODERATE'], **keywords):
     '''
@@ -277,39 +392,30 @@ def play_sound(play_file, ttsPrio=PRIO['MODERATE'], **keywords):
 
 def mqtt_pub(topic, payload):
     '''
-    Publishes a MQTT message on the default brooker
+    Publishes a MQTT message on the default brooker.
+    The message is published in the background, in order. Dicts and lists are published as JSON.
     '''
-    log.debug('%s <- %s', topic, payload)
-    MqttItem.get_create_item(topic).publish(payload)
+    mqtt_publisher.publish(topic, payload)
 
-def send_notification_to_lametric(notification_text: str = 'HELLO!', notification_prio: int = PRIO['MODERATE'], **keywords: Dict) -> bool:
+def queue_notification_to_lametric(notification_text: str = 'HELLO!', notification_prio: int = PRIO['MODERATE'], **keywords: Dict) -> Future:
     '''
-    Sends a notification to the LaMetric device.
+    Queues a notification for the LaMetric device, to be sent in the background.
     Documentation @ https://lametric-documentation.readthedocs.io/en/latest/reference-docs/device-notifications.html
-    Possible keywords: sound, icon, autoDismiss, lifeTime, iconType
+    Possible keywords: sound, icon, autoDismiss, lifeTime, iconType, deadline, policy
+    Returns a Future that resolves to True when the device accepted the notification, False when it didn't,
+    or SUPPRESSED, which is falsy, when a similar notification was sent within the dedup window.
     '''
     log.debug('Sending a notification to LaMetric')
+    if notification_prio < PRIO['EMERGENCY'] and not notification_dedup.admit('lametric', notification_text, (notification_prio, keywords)):
+        return suppressed()
+    policy = keywords.get('policy') or NotificationPolicy.now()
 
-    def is_quiet_hours(start_hour, end_hour):
-        """Returns True if the current time is within the quiet hours."""
-        now_hour = datetime.now().hour
-        return ((now_hour < start_hour) or (now_hour > end_hour))
-
-    def should_play_sound(notification_prio):
-        """Returns True if a sound should be played with the notification."""
-        if notification_prio <= PRIO['MODERATE'] and spc_area_is_set():
-            return False
-        if is_quiet_hours(7, 21):
-            return False
-        return True    
-
-    sound = lametric_configuration.get('DEFAULT_NOTIFICATION_SOUND') if 'sound' not in keywords else keywords['sound']
-    icon = lametric_configuration.get('DEFAULT_ICON') if 'icon' not in keywords else keywords['icon']
+    sound = config.lametric.default_notification_sound if 'sound' not in keywords else keywords['sound']
+    icon = config.lametric.default_icon if 'icon' not in keywords else keywords['icon']
     auto_dismiss = True if 'autoDismiss' not in keywords else keywords['autoDismiss']
-    life_time = lametric_configuration.get('DEFAULT_LIFETIME') if 'lifeTime' not in keywords else keywords['lifeTime']
+    life_time = config.lametric.default_lifetime if 'lifeTime' not in keywords else keywords['lifeTime']
     icon_type = 'info' if 'iconType' not in keywords else keywords['iconType'] # [none|info|alert]
 
-    url = f'https://{lametric_configuration["HOST"]}:{lametric_configuration["PORT"]}/api/v2/device/notifications'
     priority = 'critical' #"priority": "[info|warning|critical]" Must be critical to break through the app
     #"icon_type":"[none|info|alert]",
     #"lifeTime":<milliseconds>,
@@ -317,33 +423,26 @@ def send_notification_to_lametric(notification_text: str = 'HELLO!', notificatio
 
     cycles = 1 if auto_dismiss else 0 # cycles – the number of times message should be displayed. If cycles is set to 0, notification will stay on the screen until user dismisses it manually or you can dismiss it via the API (DELETE /api/v2/device/notifications/:id). By default it is set to 1.
     payload = { 'priority': priority, 'icon_type': icon_type, 'lifeTime': life_time, 'model': { 'frames': [ { 'icon': icon, 'text': notification_text} ], 'cycles': cycles } }
-    if should_play_sound(notification_prio):
+    if policy.allows_lametric_sound(notification_prio):
         payload['model']['sound'] = { 'category': 'notifications', 'id': sound, 'repeat': 1 }
     else:
-        log.info(f"The notification_prio argument {notification_prio} is too low to play a sound together with the notification at this moment")
-
-    args_list = [
-        'curl',
-        '-X',
-        'POST',
-        '-u',
-        f'dev:{lametric_configuration["API_KEY"]}',
-        '-H',
-        'Content-Type: application/json',
-        '-d',
-        json.dumps(payload),
-        url,
-        '--insecure'
-    ]
-
-    result = subprocess.run(args_list, capture_output=True)
-    if result.returncode != 0:
-        log.error(f"Error executing command: {result.returncode}")
-        return False
-    return True
+        log.info("The notification_prio argument %s is too low to play a sound together with the notification at this moment", notification_prio)
+
+    deadline = LAMETRIC_DEFAULT_DEADLINE if 'deadline' not in keywords else keywords['deadline']
+    return lametric_client.send(payload, deadline)
+
+def send_notification_to_lametric(notification_text: str = 'HELLO!', notification_prio: int = PRIO['MODERATE'], **keywords: Dict) -> bool:
+    '''
+    Sends a notification to the LaMetric device and waits for the answer, at most the deadline.
+    Takes the keywords of queue_notification_to_lametric, which returns without waiting.
+    Returns True if the device accepted the notification, and False if it didn't or it was suppressed as a duplicate.
+    '''
+    return queue_notification_to_lametric(notification_text, notification_prio, **keywords).result() is True
+
+notification_dedup.register_summary_sender('lametric', lambda summary, context: queue_notification_to_lametric(summary, context[0], **context[1]))
 
 def greeting():
-    return f'God{StringItem.get_item(customItemNames["clock_time_of_day_item"]).value.lower()}'
+    return f'God{StringItem.get_item(config.item_names.clock_time_of_day).value.lower()}'
 
 r'''
                                  Safety pig has arrived!
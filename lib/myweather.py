@@ -0,0 +1,79 @@
+from bisect import bisect_right
+from typing import Optional, Union
+
+import numpy as np
+from myconfig import WeatherConfig, config
+
+# The compass sectors and their direction abbreviation (Swedish). A sector starts at its lower edge.
+COMPASS_EDGES = (22.5, 67.5, 112.5, 157.5, 202.5, 247.5, 292.5, 337.5)
+COMPASS_DIRECTIONS = ('N', 'NNO', 'O', 'OSO', 'S', 'SSO', 'V', 'VNV', 'N')
+
+ScalarOrArray = Union[float, np.ndarray]
+
+class WeatherTables:
+    '''
+    Lookup tables for converting weather values, built once from the weather configuration.
+    All conversions accept a scalar or a NumPy array (or anything np.asarray accepts) and return
+    the same shape, so a whole forecast series is converted in one call.
+    '''
+
+    def __init__(self, weather: WeatherConfig):
+        self._build(weather)
+
+    def _build(self, weather: WeatherConfig):
+        # Without a weather configuration every wind class and weather symbol has an empty text
+        self.wind_speed_limits = weather.wind_speed_limits
+        self.wind_texts = weather.wind_texts or ('',)
+        self.smhi_weather = weather.smhi_weather or ('',)
+        self._compass_edges = np.array(COMPASS_EDGES)
+        self._compass_directions = np.array(COMPASS_DIRECTIONS + ('',))
+        self._wind_speed_limits = np.array(weather.wind_speed_limits)
+        self._wind_texts = np.array(self.wind_texts)
+        self._smhi_weather = np.array(self.smhi_weather)
+
+    def compass_direction(self, degrees: ScalarOrArray) -> Union[Optional[str], np.ndarray]:
+        '''
+        Returns the compass direction abbreviation for the given compass degrees.
+        Degrees outside 0 <= degrees < 360 give None, or an empty string in arrays.
+        '''
+        if np.ndim(degrees) == 0:
+            if not 0 <= degrees < 360:
+                return None
+            return COMPASS_DIRECTIONS[bisect_right(COMPASS_EDGES, degrees)]
+        degrees = np.asarray(degrees, dtype=np.float64)
+        sectors = np.searchsorted(self._compass_edges, degrees, side='right')
+        sectors[(degrees < 0) | (degrees >= 360) | np.isnan(degrees)] = len(COMPASS_DIRECTIONS)
+        return self._compass_directions[sectors]
+
+    def wind_class(self, speed: ScalarOrArray) -> ScalarOrArray:
+        '''Returns the wind class (0 = calm to light breeze ... 10 = hurricane) for the wind speed in m/s.'''
+        last_class = max(len(self.wind_speed_limits) - 1, 0)
+        if np.ndim(speed) == 0:
+            return min(bisect_right(self.wind_speed_limits, speed), last_class)
+        return np.minimum(np.searchsorted(self._wind_speed_limits, np.asarray(speed, dtype=np.float64), side='right'), last_class)
+
+    def wind_text(self, speed: ScalarOrArray) -> Union[str, np.ndarray]:
+        '''Returns the description of the wind class for the wind speed in m/s.'''
+        wind_class = self.wind_class(speed)
+        if np.ndim(wind_class) == 0:
+            return self.wind_texts[wind_class]
+        return self._wind_texts[wind_class]
+
+    def smhi_weather_text(self, code: ScalarOrArray) -> Union[str, np.ndarray]:
+        '''Returns the description of the SMHI weather symbol code. Unknown codes give the text of code 0.'''
+        if np.ndim(code) == 0:
+            code = int(code) # The forecasts give the codes as floats, e.g. 3.0
+            return self.smhi_weather[code] if 0 <= code < len(self.smhi_weather) else self.smhi_weather[0]
+        codes = np.asarray(code, dtype=np.int64)
+        return self._smhi_weather[np.where((codes >= 0) & (codes < len(self.smhi_weather)), codes, 0)]
+
+    def on_config_changed(self, old: WeatherConfig, new: WeatherConfig):
+        self._build(new)
+
+weather_tables = WeatherTables(config.weather)
+config.subscribe('weather', weather_tables.on_config_changed)
+
+compass_direction = weather_tables.compass_direction
+wind_class = weather_tables.wind_class
+wind_text = weather_tables.wind_text
+smhi_weather_text = weather_tables.smhi_weather_text
@@ -3,39 +3,45 @@
 #    - params/my_config.yml
 
 import logging
-from datetime import datetime, timedelta
 
-from HABApp import DictParameter, Rule
-from HABApp.core.items import Item
+from HABApp import Rule
+from HABApp.core.events import EventFilter
+from HABApp.core.events.habapp_events import RequestFileLoadEvent
 from HABApp.openhab.definitions import OnOffValue
 from HABApp.openhab.items import DatetimeItem, StringItem, SwitchItem
+from myconfig import config
+from myhousestate import house_state
+from mylogging import log_pipeline
+from myrulemetrics import RULE_METRICS_EXPORT_INTERVAL, RuleMetricsMixin, rule_metrics
+from mystartup import STARTUP_POLL_SECS, STARTUP_TIMEOUT, startup
+from mytimeofday import time_of_day
 from nibe_f750_heat_pump import NibeF750HeatPump
 from nord_pool_market_data import NordPoolMarketData
 
+# Write the log records of the rules and lib modules on a background thread
+log_pipeline.install()
+
 # Some useful constants
 ON = OnOffValue.ON
 OFF = OnOffValue.OFF
 
-# Get the configurations parameters stored in the my_config.yml file
-configuration = DictParameter('my_config', 'configuration', default_value=None).value
-
 # Defining the following items here will detect any errors early in the development process.
-clock_time_of_day_item = StringItem.get_item(configuration["custom_item_names"]['clock_time_of_day_item'])
+clock_time_of_day_item = StringItem.get_item(config.item_names.clock_time_of_day)
 its_not_early_morning_item = SwitchItem.get_item("Its_Not_Early_Morning")
-solar_time_of_day_item = StringItem.get_item(configuration["custom_item_names"]['solar_time_of_day_item'])
+solar_time_of_day_item = StringItem.get_item(config.item_names.solar_time_of_day)
 v_civil_dawn_item = DatetimeItem.get_item('V_CivilDawn')
 v_sunrise_item = DatetimeItem.get_item('V_Sunrise')
 v_civil_dusk_start_item = DatetimeItem.get_item('V_CivilDuskStart')
 v_civil_dusk_end_item =DatetimeItem.get_item('V_CivilDuskEnd')
 
-class RunAtHABAppStart(Rule):
+class RunAtHABAppStart(RuleMetricsMixin, Rule):
     """
     A rule that runs at HABApp start.
     """
 
     def __init__(self):
         super().__init__()
-        logger_name = configuration["system"]["MY_LOGGER_NAME"]
+        logger_name = config.system.logger_name
         self.log = logging.getLogger(f"{logger_name}.{self.rule_name}")
         self.log.setLevel(logging.INFO)
         self.run.soon(self.init_routine)
@@ -45,97 +51,76 @@ class RunAtHABAppStart(Rule):
         Initialization routine that is executed at HABApp start.
         """
         self.log.info(f"[{self.rule_name}]: HABApp has started.")
-        my_nord_pool_item = Item.get_create_item("MyNordPool", None)
-        my_f750_item = Item.get_create_item("MyNibeF750", None)
-        my_nord_pool_item.set_value(NordPoolMarketData())
-        my_f750_item.set_value(NibeF750HeatPump())
+        startup.start()
+        # Don't hold a worker thread while the components are created; they are polled on the rule's own scheduler
+        self.startup_polls = 0
+        self.startup_job = self.run.every(STARTUP_POLL_SECS, STARTUP_POLL_SECS, self.check_startup)
+
+    def check_startup(self):
+        self.startup_polls += 1
+        if startup.done:
+            self.startup_job.cancel()
+            self.log.info('%s', startup.report())
+        elif self.startup_polls * STARTUP_POLL_SECS >= STARTUP_TIMEOUT:
+            self.startup_job.cancel()
+            self.log.warning("[%s]: Not all startup components were done within %d seconds.", self.rule_name, STARTUP_TIMEOUT)
+            self.log.warning('%s', startup.report())
+
+# The heavy objects are created on first use, by whichever rule gets the item value first
+startup.register('nord_pool', NordPoolMarketData, item_name='MyNordPool', lazy=True)
+startup.register('nibe_f750', NibeF750HeatPump, item_name='MyNibeF750', lazy=True)
 
 RunAtHABAppStart()
 
-class ClockTimeOfDay(Rule):
+class HouseStateTracker(RuleMetricsMixin, Rule):
     """
-    A rule that determines the time of day based on the current hour.
+    A rule that keeps the shared house state up to date with the items it is derived from.
     """
 
     def __init__(self):
         super().__init__()
-        logger_name = configuration["system"]["MY_LOGGER_NAME"]
-        self.log = logging.getLogger(f"{logger_name}.{self.rule_name}")
-        self.log.setLevel(logging.INFO)
-        self.run.soon(self.process_changes)
-        next_hour = (datetime.now() + timedelta(hours=1)).replace(minute=0, second=7)
-        self.run.every(next_hour, timedelta(hours=1), self.process_changes)
+        house_state.attach(self)
 
-    def process_changes(self):
-        """
-        Process changes and update items based on the current hour.
-        """
-        hour = datetime.now().hour
-        clock_time_of_day = (
-            configuration["time_of_day"]["CLOCK_TIME_OF_DAY"][0]
-            if 6 <= hour <= 9
-            else configuration["time_of_day"]["CLOCK_TIME_OF_DAY"][1]
-            if 9 <= hour <= 17
-            else configuration["time_of_day"]["CLOCK_TIME_OF_DAY"][2]
-            if 18 <= hour <= 22
-            else configuration["time_of_day"]["CLOCK_TIME_OF_DAY"][3]
-        )
-        self.log.info("[%s]: The time of day (according to the clock) is [%s]", self.rule_name, clock_time_of_day)
-        clock_time_of_day_item.oh_post_update_if(clock_time_of_day, not_equal=clock_time_of_day)
-        target_value = OFF if 3 < hour < 9 else ON
-        its_not_early_morning_item.oh_post_update_if(target_value, not_equal=target_value)
-
-ClockTimeOfDay()
-
-class SolarTimeOfDay(Rule):
+HouseStateTracker()
+
+class ConfigReloader(RuleMetricsMixin, Rule):
     """
-    A rule that determines the solar time of day based on various events.
+    A rule that reloads the shared configuration when a parameter file it is compiled from has changed,
+    and has the log writer pick up the log handlers when HABApp has reloaded its logging configuration.
     """
 
     def __init__(self):
         super().__init__()
-        logger_name = configuration["system"]["MY_LOGGER_NAME"]
-        self.log = logging.getLogger(f"{logger_name}.{self.rule_name}")
-        self.log.setLevel(logging.INFO)
-        self.run.soon(self.update_time_of_day, type_of_job='InitJob')
-        self.run.on_sun_dawn(callback=self.update_time_of_day, type_of_job='DawnJob')
-        self.run.on_sunrise(callback=self.update_time_of_day, type_of_job='SunriseJob')
-        self.run.on_sun_dusk(callback=self.update_time_of_day, type_of_job='DuskJob')
-        self.run.on_sunset(callback=self.update_time_of_day, type_of_job='SunsetJob')
+        self.listen_event('HABApp.Files', self.on_file_load, EventFilter(RequestFileLoadEvent))
 
-    def update_time_of_day(self, type_of_job):
-        """
-        Update the solar time of day based on the given type of job.
-        """
-        solar_time_of_day = None
-        if type_of_job == 'DawnJob':
-            solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][0]
-        elif type_of_job == 'SunriseJob':
-            solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][1]
-        elif type_of_job == 'SunsetJob':
-            solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][2]
-        elif type_of_job == 'DuskJob':
-            solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][3]
-        else:
-            # Not triggered by a channel. Probably because the system just started.
-            # Let's find out manually where we are then...
-            datetime_now = datetime.now()
-
-            dawn_start = v_civil_dawn_item.get_value(datetime_now)
-            day_start = v_sunrise_item.get_value(datetime_now)
-            dusk_start = v_civil_dusk_start_item.get_value(datetime_now)
-            night_start = v_civil_dusk_end_item.get_value(datetime_now)
-
-            if dawn_start <= datetime_now < day_start:
-                solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][0]
-            elif day_start <= datetime_now < dusk_start:
-                solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][1]
-            elif dusk_start <= datetime_now < night_start:
-                solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][2]
-            else:
-                solar_time_of_day = configuration["time_of_day"]["SOLAR_TIME_OF_DAY"][3]
-
-        self.log.info("[%s]: The solar time of day is [%s]", self.rule_name, solar_time_of_day)
-        solar_time_of_day_item.oh_send_command(solar_time_of_day)
-
-SolarTimeOfDay()
+    def on_file_load(self, event: RequestFileLoadEvent):
+        if event.name.endswith(('my_config.yml', 'lighting_config.yml')):
+            # Give HABApp a moment to load the file before it's parsed again
+            self.run.at(2, config.reload)
+        elif event.name.endswith('logging.yml'):
+            # HABApp replaces the log handlers, so the log writer has to pick up the new ones
+            self.run.at(2, log_pipeline.refresh)
+
+ConfigReloader()
+
+class RuleMetricsExporter(Rule):
+    """
+    A rule that periodically exports the callback metrics of the rules to a Prometheus text file and an item.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.run.every(RULE_METRICS_EXPORT_INTERVAL, RULE_METRICS_EXPORT_INTERVAL, rule_metrics.export)
+
+RuleMetricsExporter()
+
+class TimeOfDayTracker(RuleMetricsMixin, Rule):
+    """
+    A rule that keeps the clock and solar time of day items up to date from a precomputed schedule of the day.
+    """
+
+    def __init__(self):
+        super().__init__()
+        time_of_day.attach(self)
+
+TimeOfDayTracker()
@@ -8,11 +8,17 @@
 import logging
 from datetime import datetime, timedelta
 
-from HABApp import DictParameter, Rule
+from HABApp import Rule
 from HABApp.core.events import ValueChangeEventFilter
 from HABApp.openhab.definitions import OnOffValue, OpenClosedValue, UpDownValue
 from HABApp.openhab.items import (NumberItem, SwitchItem, GroupItem, DatetimeItem)
+from myconfig import config
+from mydebounce import DebouncedTrigger
+from mylogging import Fields
+from mypersistence import persistence_cache
 from mypushover import send_pushover_message, PUSHOVER_PRIO
+from myrulemetrics import RuleMetricsMixin
+from mystartup import startup
 from myutils import PRIO, play_sound
 
 # Some useful constants
@@ -29,22 +35,27 @@ NEVER_TRY_PUSH_BELOW = 50
 HUMIDITY_ACCEPTABLE = 41
 HUM_HYSTERESIS = 5
 BLOCK_FAN_MINS_AFTER_TIMEOUT = 30 # Minutes to block restarting of the fan in case FAN_MAX_TIME was reached
+HUM_AVERAGE_WINDOW = timedelta(hours=48) # The humidity average is calculated over this period
+HUM_QUIET_SECS = 10 # The humidity is evaluated when the sensors have been quiet for this long
+HUM_MAX_DELAY_SECS = 60 # ... but not later than this after the first change
+HUM_POLL_INTERVAL = timedelta(minutes=30) # Safety net for changes that were missed
+SUMMER_QUIET_SECS = 60
+SUMMER_MAX_DELAY_SECS = 600
+SUMMER_POLL_INTERVAL = timedelta(hours=6)
+SUMMER_ITEM_NAMES = ('Particle_Concentration_PM2_5', 'Temp_Hallway', 'Nibe_40004')
 DEBUGGING = False
 
-# Get the configurations parameters stored in the my_config.yml file
-configuration = DictParameter('my_config', 'configuration', default_value=None).value
-
 flatulence_extra_vent_item = SwitchItem.get_item('Flatulence_Extra_Vent')
 flatulence_button_item = SwitchItem.get_item('Flatulence_Button')
 excess_hum_extra_vent_item = SwitchItem.get_item("Excess_Hum_Extra_Vent")
 bathroom_block_fan_until_item = DatetimeItem.get_item("Bathroom_Block_Fan_Until")
 
-class FlatulenceRule(Rule):
+class FlatulenceRule(RuleMetricsMixin, Rule):
     def __init__(self):
         super().__init__()
-        self.log = logging.getLogger(f'{configuration["system"]["MY_LOGGER_NAME"]}.{self.rule_name}')
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
         self.log.setLevel(logging.INFO)
-        flatulence_button_item.listen_event(self.process_changes, ValueChangeEventFilter(value=ON))
+        self.listen_event(flatulence_button_item, self.process_changes, ValueChangeEventFilter(value=ON))
 
     def process_changes(self, event=None):
         """
@@ -59,16 +70,18 @@ FlatulenceRule()
 import logging
 from datetime import datetime, timedelta
 
-class HumControl(Rule):
+class HumControl(RuleMetricsMixin, Rule):
     def __init__(self):
         """
         The bathroom ventilation rule
         """
         super().__init__()
-        self.log = logging.getLogger(f"{configuration['system']['MY_LOGGER_NAME']}.{self.rule_name}")
+        self.log = logging.getLogger(f"{config.system.logger_name}.{self.rule_name}")
         self.log.setLevel(logging.INFO)
-        self.run.every(timedelta(seconds=10), 300, self.process_changes)  # Wait for 10 seconds and then run with 5-minute intervals
-        excess_hum_extra_vent_item.listen_event(self.timer_timed_out, ValueChangeEventFilter(value=OFF))
+        self.run.every(timedelta(seconds=10), HUM_POLL_INTERVAL, self.process_changes)  # Wait for 10 seconds and then poll as a safety net
+        self.trigger = DebouncedTrigger(self, self.process_changes, [item.name for item in GroupItem.get_item(SENSOR_GROUP).members],
+                                        HUM_QUIET_SECS, HUM_MAX_DELAY_SECS)
+        self.listen_event(excess_hum_extra_vent_item, self.timer_timed_out, ValueChangeEventFilter(value=OFF))
 
     def process_changes(self, event=None):
         hum_items = []
@@ -79,9 +92,11 @@ class HumControl(Rule):
             bathroom_block_fan_until_item.oh_post_update(block_until)
             return
 
-        for hum_item in GroupItem.get_item("G_Bathroom_Hum_Control").members:
+        for hum_item in GroupItem.get_item(SENSOR_GROUP).members:
             hum_items.append(hum_item)
             hum_values.append(hum_item.value if hum_item.value is not None else 0)
+        # The group members are resolved on every run, so sensors added to or removed from the group are followed
+        self.trigger.set_item_names(hum_item.name for hum_item in hum_items)
 
         current_humidity = max(hum_values)
 
@@ -93,8 +108,7 @@ class HumControl(Rule):
         highest_value = 0
 
         for hum_item in hum_items:
-            now = datetime.now()
-            avg_hum = hum_item.get_persistence_data(start_time=datetime.today() - timedelta(hours=48), end_time=now).average()
+            avg_hum = persistence_cache.average(hum_item, HUM_AVERAGE_WINDOW)
 
             if avg_hum is None:
                 self.log.error("Failed to get persistence data for sensor: [%s]", hum_item.name)
@@ -112,7 +126,7 @@ class HumControl(Rule):
             avg_hum = 0
 
         target_hum = max([avg_hum + HUM_HYSTERESIS, NEVER_TRY_PUSH_BELOW])
-        stats = f"Current hum: {current_humidity}, Avg hum: {avg_hum}, Target hum: {target_hum}"
+        stats = Fields("Humidity", current=current_humidity, average=avg_hum, target=target_hum)
         self.log.debug(stats)
 
         if current_humidity <= target_hum:
@@ -123,25 +137,23 @@ class HumControl(Rule):
             earliest_start = bathroom_block_fan_until_item.value
 
             if earliest_start < datetime.now():
-                message = f"{earliest_start} is in the past, so we start the fan now. {stats}"
-                self.log.debug(message)
+                self.log.debug("%s is in the past, so we start the fan now. %s", earliest_start, stats)
 
                 if DEBUGGING:
-                    send_pushover_message(message, title="BATHROOM VENTILATION")
+                    send_pushover_message(f"{earliest_start} is in the past, so we start the fan now. {stats}", title="BATHROOM VENTILATION")
 
                 excess_hum_extra_vent_item.on()
             else:
-                self.log.debug(f"{earliest_start} is in the future, so we'll have to wait")
+                self.log.debug("%s is in the future, so we'll have to wait", earliest_start)
         else:
             self.log.debug("We are currently in the process of ventilating the bathroom")
 
     def timer_timed_out(self, event=None):
         block_until = datetime.today() + timedelta(minutes=BLOCK_FAN_MINS_AFTER_TIMEOUT)
         bathroom_block_fan_until_item.oh_post_update(block_until)
-        message = f"Timer timed out. We may start the fan again after: {block_until}."
-        self.log.debug(message)
+        self.log.debug("Timer timed out. We may start the fan again after: %s.", block_until)
         if DEBUGGING:
-            send_pushover_message(message, title="BATHROOM VENTILATION")
+            send_pushover_message(f"Timer timed out. We may start the fan again after: {block_until}.", title="BATHROOM VENTILATION")
 
     def target_hum_reached(self):
         """
@@ -158,19 +170,25 @@ class HumControl(Rule):
 
 HumControl()
 
-class SummerVentilation(Rule):
+# Fetch the humidity history while the rest of the rules start, rather than on the first HumControl run
+startup.register('bathroom_humidity_history', lambda: [
+    persistence_cache.series(hum_item, HUM_AVERAGE_WINDOW) for hum_item in GroupItem.get_item(SENSOR_GROUP).members
+])
+
+class SummerVentilation(RuleMetricsMixin, Rule):
     def __init__(self):
         super().__init__()
-        self.log = logging.getLogger(f"{configuration['system']['MY_LOGGER_NAME']}.{self.rule_name}")
+        self.log = logging.getLogger(f"{config.system.logger_name}.{self.rule_name}")
         self.log.setLevel(logging.INFO)
 
-        self.run.soon(self.process_changes)
-        self.run.every_hour(self.process_changes)
-
         self.summer_extra_vent_item = SwitchItem.get_item("Summer_Extra_Vent")
-        self.particle_concentration_pm2_5_item = NumberItem.get_item("Particle_Concentration_PM2_5")
-        self.indoor_temp_item = NumberItem.get_item("Temp_Hallway")
-        self.outdoor_temp_item = NumberItem.get_item("Nibe_40004")
+        self.particle_concentration_pm2_5_item = NumberItem.get_item(SUMMER_ITEM_NAMES[0])
+        self.indoor_temp_item = NumberItem.get_item(SUMMER_ITEM_NAMES[1])
+        self.outdoor_temp_item = NumberItem.get_item(SUMMER_ITEM_NAMES[2])
+
+        self.run.soon(self.process_changes)
+        self.run.every(SUMMER_POLL_INTERVAL, SUMMER_POLL_INTERVAL, self.process_changes) # Safety net for changes that were missed
+        self.trigger = DebouncedTrigger(self, self.process_changes, SUMMER_ITEM_NAMES, SUMMER_QUIET_SECS, SUMMER_MAX_DELAY_SECS)
 
     def process_changes(self, event=None):
         # Check if it's summer
@@ -186,7 +204,7 @@ class SummerVentilation(Rule):
         message = f"Extra summer ventilation. PM2.5: {pm2_5_concentration}, Outdoor: {outdoor_temp}, Indoor: {indoor_temp}"
 
         if pm2_5_concentration <= 10 and indoor_temp >= 25 and outdoor_temp < indoor_temp - 2:
-            if self.summer_extra_vent_item.is_off:
+            if self.summer_extra_vent_item.is_off():
                 self.summer_extra_vent_item.on()
                 self.log.debug(message)
                 send_pushover_message(message, title="SUMMER VENTILATION", priority=PUSHOVER_PRIO["LOW"])
@@ -0,0 +1,139 @@
+# HABApp:
+#   depends on:
+#    - rules/001_init.py
+#    - params/my_config.yml
+
+import logging
+from datetime import datetime, timedelta
+
+from typing import List
+
+from HABApp import Rule
+from HABApp.core import Items
+from HABApp.core.events import ValueChangeEventFilter
+from HABApp.openhab.definitions import OnOffValue
+from HABApp.openhab.items import DatetimeItem, NumberItem, StringItem, SwitchItem
+from myconfig import config
+from mydebounce import DebouncedTrigger
+from myloadplan import EvNeed, load_planner
+from myprices import PRICE_RETRY_SECS, price_store
+from myrulemetrics import RuleMetricsMixin
+
+# Some useful constants
+ON = OnOffValue.ON
+OFF = OnOffValue.OFF
+
+FORECAST_QUIET_SECS = 10 # The forecast items are updated together, so the plan is redone once they have been quiet for this long
+
+energy_spending_level_item = StringItem.get_item(config.item_names.all['energySpendingLevel'])
+energy_spending_plan_item = StringItem.get_item(config.item_names.all['energySpendingPlan'])
+ev_charge_planned_item = SwitchItem.get_item(config.item_names.all['evChargePlanned'])
+ev_charge_need_item = NumberItem.get_item(config.item_names.all['evChargeNeed'])          # kWh left to charge
+ev_charge_deadline_item = DatetimeItem.get_item(config.item_names.all['evChargeDeadline'])
+outdoor_temp_item = NumberItem.get_item(config.item_names.all['odTemp'])
+
+class DayAheadPrices(RuleMetricsMixin, Rule):
+    """
+    Keeps the stored day-ahead prices up to date. The prices are fetched when HABApp starts only if the store
+    lacks today's prices, and then once a day after tomorrow's prices are due to arrive, retrying every
+    PRICE_RETRY_SECS seconds until they have been published.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
+        self.log.setLevel(logging.INFO)
+        self.job = None
+        self.run.soon(self.refresh)
+
+    def refresh(self):
+        now = datetime.now()
+        if price_store.refresh(now):
+            next_time = price_store.next_refresh_time(now)
+        else:
+            next_time = now + timedelta(seconds=PRICE_RETRY_SECS)
+        self.log.debug('The day-ahead prices are fetched next at %s', next_time)
+        self.job = self.run.at(next_time, self.refresh)
+
+DayAheadPrices()
+
+class EnergyPlanner(RuleMetricsMixin, Rule):
+    """
+    Plans the energy spending level of each hour, and the EV charging hours, against the day-ahead prices.
+    The plan is redone, incrementally, when the prices, the outdoor temperature or its forecast or the EV need
+    change, and every hour today's plan is redone without the hours that have passed and the level of the current
+    hour and the plan from it are written.
+    The temperature of the current hour is the measured one and the coming hours have the hourly forecast of
+    the items named by energy.TEMP_FORECAST_ITEM. Without forecast items the current temperature holds for all hours.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
+        self.log.setLevel(logging.INFO)
+        price_store.subscribe(self.on_prices_changed)
+        self.forecast_item_names = self.find_forecast_items()
+        self.temperature_trigger = DebouncedTrigger(self, self.on_temperature_change, [outdoor_temp_item.name, *self.forecast_item_names],
+                                                    FORECAST_QUIET_SECS)
+        self.listen_event(ev_charge_need_item, self.on_ev_need_change, ValueChangeEventFilter())
+        self.listen_event(ev_charge_deadline_item, self.on_ev_need_change, ValueChangeEventFilter())
+        self.run.every_hour(self.on_new_hour)
+        self.run.soon(self.on_temperature_change)
+
+    def on_prices_changed(self, index):
+        self.run.soon(self.replan)
+
+    def find_forecast_items(self) -> List[str]:
+        pattern, hours = config.energy.temp_forecast_item, config.energy.temp_forecast_hours
+        names = [pattern.format(hour=hour) for hour in range(hours)] if pattern else []
+        missing = [name for name in names if not Items.item_exists(name)]
+        if missing:
+            self.log.warning('The forecast items %s are missing, planning with the current temperature for all hours', missing)
+            return []
+        return names
+
+    def forecast(self) -> List[float]:
+        '''The measured temperature followed by the forecast of the coming hours, up to the first hour without one.'''
+        values = [NumberItem.get_item(name).value for name in self.forecast_item_names]
+        if outdoor_temp_item.value is not None:
+            values[:1] = [outdoor_temp_item.value]
+        temperatures = []
+        for value in values:
+            if value is None:
+                break
+            temperatures.append(value)
+        return temperatures
+
+    def on_temperature_change(self, event=None):
+        temperatures = self.forecast()
+        if temperatures:
+            load_planner.set_forecast(datetime.now(), temperatures)
+        self.on_ev_need_change()
+
+    def on_ev_need_change(self, event=None):
+        need, deadline = ev_charge_need_item.value, ev_charge_deadline_item.value
+        load_planner.set_ev_need(EvNeed(need, deadline) if need and deadline is not None else None)
+        self.replan()
+
+    def replan(self):
+        if load_planner.replan():
+            self.publish()
+
+    def on_new_hour(self):
+        # Today's plan is redone without the hour that has passed
+        load_planner.replan()
+        self.publish()
+
+    def publish(self):
+        level = load_planner.level_at()
+        if level is not None and energy_spending_level_item.oh_post_update_if(level, not_equal=level):
+            self.log.info('The energy spending level is [%s]', level)
+        charging = ON if load_planner.ev_charging_at() else OFF
+        ev_charge_planned_item.oh_post_update_if(charging, not_equal=charging)
+        plan = load_planner.describe()
+        energy_spending_plan_item.oh_post_update_if(plan, not_equal=plan)
+
+    def on_rule_removed(self):
+        price_store.unsubscribe(self.on_prices_changed)
+
+EnergyPlanner()
@@ -0,0 +1,43 @@
+# HABApp:
+#   depends on:
+#    - rules/001_init.py
+#    - params/my_config.yml
+
+import logging
+import os
+
+from HABApp import Rule
+from HABApp.core.events import ValueUpdateEventFilter
+from HABApp.openhab.items import OpenhabItem
+from myconfig import config
+from myeventlog import EventLogWriter
+from myrulemetrics import RuleMetricsMixin
+
+EVENT_LOG_FLUSH_SECS = 60 # The recorded events are written to disk at this interval
+
+class EventRecorder(RuleMetricsMixin, Rule):
+    """
+    Records the value updates of the items, all openHAB items unless event_log.ITEMS lists them, to the event
+    log, so that an incident can be reproduced by replaying them offline with bench/replay.py.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
+        self.log.setLevel(logging.INFO)
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), config.event_log.file)
+        self.writer = EventLogWriter(path, config.event_log.max_mb * 1024 * 1024)
+        item_names = config.event_log.item_names or [item.name for item in self.get_items(type=OpenhabItem)]
+        for item_name in item_names:
+            self.listen_event(item_name, self.on_update, ValueUpdateEventFilter())
+        self.run.every(EVENT_LOG_FLUSH_SECS, EVENT_LOG_FLUSH_SECS, self.writer.flush)
+        self.log.info('Recording the events of %d items to %s, %d events so far', len(item_names), path, self.writer.count)
+
+    def on_update(self, event):
+        self.writer.append(event.name, event.value)
+
+    def on_rule_removed(self):
+        self.writer.close()
+
+if config.event_log.enabled:
+    EventRecorder()
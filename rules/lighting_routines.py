@@ -0,0 +1,71 @@
+# HABApp:
+#   depends on:
+#    - rules/001_init.py
+#    - params/my_config.yml
+
+import logging
+from datetime import timedelta
+
+from HABApp import Rule
+from HABApp.core.events import ValueUpdateEventFilter
+from HABApp.openhab.items import NumberItem
+from myareatriggers import area_trigger_engine
+from myconfig import config
+from mylightlevel import light_level_fusion
+from myrulemetrics import RuleMetricsMixin
+
+sys_light_level_item = NumberItem.get_item(config.item_names.sys_light_level)
+
+class AreaTriggers(RuleMetricsMixin, Rule):
+    """
+    A rule that lets the area trigger engine act on the areas when their trigger items, the lux or the
+    lighting mode change.
+    """
+
+    def __init__(self):
+        super().__init__()
+        area_trigger_engine.attach(self)
+
+AreaTriggers()
+
+class LightLevel(RuleMetricsMixin, Rule):
+    """
+    Derives Sys_LightLevel from the light sensors and posts it only when the level really changes, i.e. when
+    the smoothed lux has gone past a band edge by the hysteresis and the new level has held for the dwell time.
+    Only runs when light_level.ENABLED is set in my_config.yml, with the lux of each level from light_level.LUX.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
+        self.log.setLevel(logging.INFO)
+        self.dwell_job = None
+        light_level_fusion.set_level(sys_light_level_item.value)
+        for sensor in config.item_names.light_sensors:
+            self.listen_event(sensor, self.on_sensor_update, ValueUpdateEventFilter())
+        self.run.every_hour(self.log_stats)
+
+    def on_sensor_update(self, event):
+        if event.value is None:
+            return
+        self.post(light_level_fusion.update(event.name, event.value))
+
+    def on_dwell_passed(self):
+        self.dwell_job = None
+        self.post(light_level_fusion.evaluate())
+
+    def post(self, level):
+        if level is not None:
+            self.log.debug('The light level is %s at %.0f lux', level, light_level_fusion.lux)
+            sys_light_level_item.oh_post_update_if(level, not_equal=level)
+        pending_secs = light_level_fusion.pending_secs()
+        if pending_secs is not None and self.dwell_job is None:
+            self.dwell_job = self.run.at(timedelta(seconds=pending_secs), self.on_dwell_passed)
+
+    def log_stats(self):
+        stats = light_level_fusion.stats()
+        self.log.info('Posted the light level %d times for %d sensor samples, %d level changes were held back by the hysteresis '
+                      'and dwell time', stats['posted'], stats['samples'], stats['avoided_changes'])
+
+if config.lighting.light_level_enabled:
+    LightLevel()
@@ -0,0 +1,40 @@
+# HABApp:
+#   depends on:
+#    - rules/001_init.py
+#    - params/my_config.yml
+
+import logging
+
+from HABApp import Rule
+from HABApp.core.events import ValueChangeEventFilter
+from HABApp.openhab.items import StringItem
+from myconfig import config
+from myhousestate import SPC_AREA_ITEM_NAME
+from myrulemetrics import RuleMetricsMixin
+from mysurveillance import camera_switcher
+
+solar_time_of_day_item = StringItem.get_item(config.item_names.solar_time_of_day)
+spc_area_item = StringItem.get_item(SPC_AREA_ITEM_NAME)
+
+class CameraProfiles(RuleMetricsMixin, Rule):
+    """
+    Switches the camera profiles between day and night at solar night, and to the armed profiles while the
+    alarm is set, which also lifts the privacy masks.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log = logging.getLogger(f'{config.system.logger_name}.{self.rule_name}')
+        self.log.setLevel(logging.INFO)
+        self.listen_event(solar_time_of_day_item, self.switch_profile, ValueChangeEventFilter())
+        self.listen_event(spc_area_item, self.switch_profile, ValueChangeEventFilter())
+        self.run.soon(self.switch_profile)
+
+    def switch_profile(self, event=None):
+        profile = 'night' if solar_time_of_day_item.value == config.time_of_day.solar[3] else 'day'
+        if spc_area_item.value not in (None, 'unset'):
+            profile += '_armed'
+        self.log.debug('The camera profile is [%s]', profile)
+        camera_switcher.switch_profile(profile)
+
+CameraProfiles()